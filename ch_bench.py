@@ -0,0 +1,612 @@
+import bisect
+import itertools
+import json
+import logging as log
+import math
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import timeit
+import plac
+from concurrent.futures import ThreadPoolExecutor
+from ch_cache import ReadCache
+from ch_coord import ChordCoordinator, LiveNodeSet
+from ch_node import ChordNode, FingerTable, SuccessorList
+from ch_storage import MemoryStorage, LogStorage
+from ch_transport import InProcessTransport
+
+class LegacyFingerTable:
+    """
+    Finger table as it was implemented before FingerTable, a list of entry objects scanned  
+    from the last entry with modular arithmetic through operate_id. Kept as benchmark baseline.
+    """
+    
+    class Entry:
+        def __init__(self, start, successor):
+            self.start = start
+            self.successor = successor
+    
+    def __init__(self, node_id:int, bits:int):
+        self.id = node_id
+        self.bits = bits
+        self.max_nodes = 1 << bits
+        self.finger_table = [LegacyFingerTable.Entry(self.sum_id(node_id, 1 << max(i - 1, 0)), None) for i in range(bits + 1)]
+    
+    def operate_id(self, id1, id2, operator):
+        return operator(id1, id2) % (1 << self.bits)
+    
+    def sum_id(self, id1, id2):
+        return self.operate_id(id1, id2, lambda x,y: x + y)
+    
+    def in_between(self, key, lwb, upb, equals=True):
+        if lwb == upb:
+            return equals
+        elif lwb < upb:
+            return lwb <= key and key < upb
+        else:
+            return (lwb <= key and key < upb + self.max_nodes) or (lwb <= key + self.max_nodes and key < upb)
+    
+    def closest_preceding_finger(self, key):
+        for i in range(self.bits,0,-1):
+            if self.finger_table[i].successor != None and self.in_between(self.finger_table[i].successor, self.sum_id(self.id, 1), key):
+                return self.finger_table[i].successor
+        return self.id
+
+def ring_successor(ids:list, key:int):
+    """
+    Returns the first id of the sorted ids at or after key
+    """
+    for node_id in ids:
+        if node_id >= key:
+            return node_id
+    return ids[0]
+
+def bench_finger_table(bits_list=(5, 8, 16, 32, 64, 128, 160), nodes:int=1000, lookups:int=20000, seed:int=0):
+    """
+    Times closest_preceding_finger of LegacyFingerTable and FingerTable on the same ring.  
+    Returns a list with the results of each bits value.
+    """
+    rng = random.Random(seed)
+    results = []
+    for bits in bits_list:
+        max_nodes = 1 << bits
+        ids = sorted({rng.randrange(max_nodes) for _ in range(min(nodes, max_nodes))})
+        node_id = ids[0]
+        legacy = LegacyFingerTable(node_id, bits)
+        compact = FingerTable(node_id, bits)
+        for i in range(1, bits + 1):
+            successor = ring_successor(ids, compact.starts[i])
+            legacy.finger_table[i].successor = successor
+            compact.set(i, successor)
+        keys = [rng.randrange(max_nodes) for _ in range(lookups)]
+        
+        legacy_seconds = timeit.timeit(lambda: [legacy.closest_preceding_finger(x) for x in keys], number=1)
+        compact_seconds = timeit.timeit(lambda: [compact.closest_preceding(x) for x in keys], number=1)
+        results.append({
+            "bits": bits,
+            "ring_nodes": len(ids),
+            "lookups": lookups,
+            "legacy_ns_per_lookup": legacy_seconds / lookups * 1e9,
+            "compact_ns_per_lookup": compact_seconds / lookups * 1e9,
+            "speedup": legacy_seconds / compact_seconds if compact_seconds else None
+        })
+    return results
+
+def percentiles(values:list):
+    """
+    Returns the mean, p50, p90, p99 and max of values
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    pick = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))]
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": values[-1]
+    }
+
+class SimulatedRing:
+    """
+    Ring of ChordNode objects in this process connected by an InProcessTransport.  
+    Nodes don't run maintenance threads, stabilization runs in explicit rounds over every node and 
+    the failure detectors read a logical clock that advances a ping interval each round and the 
+    coordinator samples nodes with the seed, so the results depend only on the seed unless calls 
+    have jitter or fail.
+    """
+    
+    def __init__(self, bits:int=32, seed:int=0, hash_algorithm:str="sha1", replication_factor:int=1,
+                 latency:float=0, jitter:float=0, failure_rate:float=0, stabilization:bool=True):
+        """
+        latency, jitter, failure_rate: injected in every call, see InProcessTransport  
+        stabilization: if the nodes join with stabilization or with full finger table initialization
+        """
+        self.bits = bits
+        self.max_nodes = 1 << bits
+        self.stabilization = stabilization
+        self.rng = random.Random(seed)
+        self.transport = InProcessTransport(latency, jitter, failure_rate, seed)
+        self.coordinator = ChordCoordinator(bits, None, 0, None, None, hash_algorithm, replication_factor, transport="inprocess")
+        self.coordinator.node_transport = self.transport
+        self.coordinator.nodes = LiveNodeSet(seed)
+        self.transport.publish(ChordCoordinator.ADDRESS, self.transport.register(self.coordinator))
+        self.executor = ThreadPoolExecutor(4)
+        self.nodes = {} # Id -> alive node
+        self.keys = [] # Keys stored by insert_keys
+        self.departed_counters = {} # Metrics counters of the nodes that left or failed
+        self.now = 0 # Logical time of the failure detectors in seconds
+    
+    def __len__(self):
+        return len(self.nodes)
+    
+    def new_id(self):
+        while True:
+            node_id = self.rng.randrange(self.max_nodes)
+            if node_id not in self.nodes:
+                return node_id
+    
+    def new_node(self, node_id:int=None):
+        """
+        Creates a node registered in the transport but not in the ring
+        """
+        node = ChordNode(forced_id=self.new_id() if node_id is None else node_id, stabilization=self.stabilization,
+                         executor=self.executor, transport=self.transport, metrics=True)
+        node.configure(node.get_coordinator_proxy())
+        node.failure_detector.clock = lambda: self.now
+        node.dir = self.transport.register(node)
+        node.local_nodes[node.id] = node
+        self.transport.publish(ChordNode.node_name(node.id), node.dir)
+        return node
+    
+    def build(self, count:int):
+        """
+        Adds count nodes with already correct finger tables, successor lists and predecessors
+        """
+        for _ in range(count):
+            node = self.new_node()
+            self.nodes[node.id] = node
+        ids = sorted(self.nodes)
+        for index, node_id in enumerate(ids):
+            node = self.nodes[node_id]
+            node.finger_table = FingerTable(node_id, self.bits)
+            for i in range(1, self.bits + 1):
+                node.finger_table.set(i, self.successor_of(node.finger_table.starts[i], ids))
+            node.predecessor = ids[index - 1]
+            node.successor_list = SuccessorList(node_id, self.bits, node.max_successor_list_count)
+            node.successor_list.update([ids[(index + i) % len(ids)] for i in range(1, min(len(ids), node.max_successor_list_count + 1))])
+            self.coordinator.register(node_id, node.dir)
+    
+    def successor_of(self, key:int, ids:list=None):
+        """
+        Returns the id of the alive node responsible for key
+        """
+        ids = sorted(self.nodes) if ids is None else ids
+        index = bisect.bisect_left(ids, key)
+        return ids[index % len(ids)]
+    
+    def predecessor_of(self, node_id:int):
+        """
+        Returns the id of the alive node preceding node_id
+        """
+        ids = sorted(self.nodes)
+        return ids[bisect.bisect_left(ids, node_id) - 1]
+    
+    def random_node(self):
+        return self.nodes[self.rng.choice(list(self.nodes))]
+    
+    def join(self, placement:str="hash"):
+        """
+        Joins a new node through the protocol from a random node, returns the node.  
+        placement: hash places the node at a random id, load asks a random node for the id splitting 
+        the most loaded range of a sample, like a node started with that placement
+        """
+        node_id = self.random_node().choose_load_id() if placement == "load" and self.nodes else None
+        node = self.new_node(node_id)
+        initial_node = node.get_node_proxy(self.random_node().id) if self.nodes else None
+        try:
+            node.join(initial_node)
+        except Exception:
+            self.transport.unregister(ChordNode.node_name(node.id))
+            self.coordinator.nodes.remove(node.id)
+            raise
+        self.nodes[node.id] = node
+        return node
+    
+    def leave(self, node):
+        """
+        The node leaves through the protocol
+        """
+        node.leave()
+        self.fail(node)
+    
+    def fail(self, node):
+        """
+        The node stops answering without leaving
+        """
+        self.nodes.pop(node.id)
+        self.transport.unregister(ChordNode.node_name(node.id))
+        for name, value in node.metrics.counters.items():
+            self.departed_counters[name] = self.departed_counters.get(name, 0) + value
+    
+    def stabilize_round(self):
+        """
+        Runs stabilize, fix_fingers and the failure detector pings once in every node in random order.  
+        Returns (nodes with changes, failed calls)
+        """
+        changed, failures = 0, 0
+        nodes = list(self.nodes.values())
+        self.rng.shuffle(nodes)
+        self.now += nodes[0].ping_interval if nodes else 0
+        for node in nodes:
+            node.ping_neighbours()
+            for task in (node.stabilize, node.fix_fingers):
+                try:
+                    changed += bool(task())
+                except Exception:
+                    failures += 1
+        return changed, failures
+    
+    def consistency(self):
+        """
+        Returns the fractions of nodes with correct successor, predecessor and finger table
+        """
+        ids = sorted(self.nodes)
+        successors = predecessors = fingers = 0
+        for index, node_id in enumerate(ids):
+            node = self.nodes[node_id]
+            successors += node.successor == ids[(index + 1) % len(ids)]
+            predecessors += node.predecessor == ids[index - 1]
+            fingers += all(node.finger_table.successors[i] == self.successor_of(node.finger_table.starts[i], ids) for i in range(1, self.bits + 1))
+        return {x: y / len(ids) for x, y in [("successors", successors), ("predecessors", predecessors), ("fingers", fingers)]}
+    
+    def converge(self, max_rounds:int=100):
+        """
+        Runs stabilization rounds until successors and predecessors are correct.  
+        Returns the stats of the convergence
+        """
+        start = time.perf_counter()
+        calls = self.transport.total_calls()
+        rounds = failures = 0
+        consistency = self.consistency()
+        while rounds < max_rounds and (consistency["successors"] < 1 or consistency["predecessors"] < 1):
+            failures += self.stabilize_round()[1]
+            rounds += 1
+            consistency = self.consistency()
+        return {
+            "rounds": rounds,
+            "converged": consistency["successors"] == 1 and consistency["predecessors"] == 1,
+            "seconds": time.perf_counter() - start,
+            "rpcs": self.transport.total_calls() - calls,
+            "failed_tasks": failures,
+            "consistency": consistency
+        }
+    
+    def lookups(self, count:int):
+        """
+        Routes count random keys from random nodes.  
+        Returns the hops, RPCs and latency percentiles and the amount of wrong or failed routes
+        """
+        ids = sorted(self.nodes)
+        hops, rpcs, latencies = [], [], []
+        wrong = failed = 0
+        for _ in range(count):
+            node = self.random_node()
+            key = self.rng.randrange(self.max_nodes)
+            route_steps, calls = self.transport.calls["route_step"], self.transport.total_calls()
+            start = time.perf_counter()
+            try:
+                owner_id = node.find_successor(key)
+            except Exception:
+                failed += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1e6)
+            hops.append(self.transport.calls["route_step"] - route_steps)
+            rpcs.append(self.transport.total_calls() - calls)
+            wrong += owner_id != self.successor_of(key, ids)
+        return {"hops": percentiles(hops), "rpcs": percentiles(rpcs), "latency_us": percentiles(latencies), "wrong": wrong, "failed": failed}
+    
+    def insert_keys(self, count:int):
+        """
+        Stores count random keys directly in their owners
+        """
+        ids = sorted(self.nodes)
+        for _ in range(count):
+            key = self.rng.randrange(self.max_nodes)
+            self.nodes[self.successor_of(key, ids)].storage[key] = key
+            self.keys.append(key)
+    
+    def gets(self, count:int, routing:str="iterative", skew:float=0, cache_size:int=0):
+        """
+        Looks up count stored keys from random nodes with the routing mode.  
+        skew: exponent of the Zipf distribution of the keys, 0 picks them uniformly  
+        cache_size: read cache of every node, the caches start empty  
+        Returns the RPCs and latency percentiles, the amount of wrong or failed lookups and the cache hit rate
+        """
+        for node in self.nodes.values():
+            node.routing = routing
+            node.read_cache = ReadCache(cache_size)
+        weights = list(itertools.accumulate(1 / (x + 1) ** skew for x in range(len(self.keys)))) if skew else None
+        rpcs, latencies = [], []
+        wrong = failed = 0
+        for _ in range(count):
+            node = self.random_node()
+            key = self.rng.choices(self.keys, cum_weights=weights)[0] if weights else self.rng.choice(self.keys)
+            calls, start = self.transport.total_calls(), time.perf_counter()
+            try:
+                value = node.lookup(key)
+            except Exception:
+                failed += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1e6)
+            rpcs.append(self.transport.total_calls() - calls)
+            wrong += value != key
+        hits = sum(x.read_cache.hits for x in self.nodes.values())
+        return {"rpcs": percentiles(rpcs), "latency_us": percentiles(latencies), "wrong": wrong, "failed": failed,
+                "cache_hit_rate": hits / count if cache_size else 0}
+    
+    def owned_keys(self):
+        """
+        Returns the percentiles of the keys stored by each node
+        """
+        return percentiles([len(x.storage) for x in self.nodes.values()])
+    
+    def transferred(self):
+        """
+        Returns the keys and bytes moved by transfers so far
+        """
+        nodes = list(self.nodes.values())
+        return {x: sum(node.metrics.counters.get(x, 0) for node in nodes) + self.departed_counters.get(x, 0) for x in ("transfer_keys", "transfer_bytes")}
+    
+    def close(self):
+        self.executor.shutdown()
+
+def bench_ring(sizes=(10, 100, 1000), bits:int=32, lookups:int=2000, keys:int=10000, joins:int=10, seed:int=0, latency:float=0):
+    """
+    Builds rings of each size and measures lookups, joins and leaves with their key transfers.  
+    Join cost counts the join call and the stabilization of the new node and its predecessor, 
+    plus the fix_fingers calls needed to fill the new node's finger table.
+    """
+    results = []
+    for size in sizes:
+        ring = SimulatedRing(bits, seed, latency=latency)
+        start = time.perf_counter()
+        ring.build(size)
+        build_seconds = time.perf_counter() - start
+        ring.insert_keys(keys)
+        result = {"nodes": size, "bits": bits, "keys": keys, "build_seconds": build_seconds, "lookups": ring.lookups(lookups)}
+        result["gets"] = {x: ring.gets(lookups, x) for x in ChordNode.ROUTING_MODES}
+        result["zipf_gets"] = {x: ring.gets(lookups, skew=1.1, cache_size=y) for x, y in (("uncached", 0), ("cached", 1000))}
+        calls, start = ring.transport.total_calls(), time.perf_counter()
+        scanned = sum(len(x) for x in ring.random_node().scan())
+        result["scan"] = {"keys": scanned, "seconds": time.perf_counter() - start, "rpcs": ring.transport.total_calls() - calls}
+        
+        join_rpcs, join_seconds, leave_rpcs, leave_seconds = [], [], [], []
+        transferred = ring.transferred()
+        for _ in range(joins):
+            calls, start = ring.transport.total_calls(), time.perf_counter()
+            node = ring.join()
+            predecessor = ring.nodes[ring.predecessor_of(node.id)]
+            for _ in range(10):
+                # The last stabilize of the new node pulls its keys once it knows its predecessor
+                node.stabilize()
+                if predecessor.successor == node.id and node.predecessor == predecessor.id:
+                    break
+                predecessor.stabilize()
+            for _ in range(math.ceil((bits - 1) / node.fix_fingers_batch)):
+                node.fix_fingers()
+            join_seconds.append(time.perf_counter() - start)
+            join_rpcs.append(ring.transport.total_calls() - calls)
+        result["join"] = {"rpcs": percentiles(join_rpcs), "seconds": percentiles(join_seconds)}
+        result["join_transfer"] = {x: ring.transferred()[x] - y for x, y in transferred.items()}
+        
+        transferred = ring.transferred()
+        for _ in range(joins):
+            if len(ring) < 2:
+                break
+            node = ring.random_node()
+            calls, start = ring.transport.total_calls(), time.perf_counter()
+            ring.leave(node)
+            leave_seconds.append(time.perf_counter() - start)
+            leave_rpcs.append(ring.transport.total_calls() - calls)
+        result["leave"] = {"rpcs": percentiles(leave_rpcs), "seconds": percentiles(leave_seconds)}
+        result["leave_transfer"] = {x: ring.transferred()[x] - y for x, y in transferred.items()}
+        result["after_churn"] = ring.converge()
+        ring.close()
+        results.append(result)
+    return results
+
+def bench_churn(sizes=(10, 100, 1000), bits:int=32, churn:float=0.1, lookups:int=2000, max_rounds:int=50, seed:int=0, latency:float=0):
+    """
+    Fails a churn fraction of the nodes of each ring size, joins the same amount of new nodes and 
+    measures the stabilization rounds until successors and predecessors are correct again, 
+    and the lookups right after the churn and after the convergence.
+    """
+    results = []
+    for size in sizes:
+        ring = SimulatedRing(bits, seed, latency=latency)
+        ring.build(size)
+        changes = max(1, int(size * churn))
+        for node in ring.rng.sample(list(ring.nodes.values()), min(changes, size - 1)):
+            ring.fail(node)
+        joined = 0
+        for _ in range(changes):
+            try:
+                ring.join()
+                joined += 1
+            except Exception:
+                pass
+        result = {"nodes": size, "bits": bits, "failed": changes, "joined": joined}
+        result["lookups_after_churn"] = ring.lookups(lookups)
+        result["convergence"] = ring.converge(max_rounds)
+        result["lookups_after_convergence"] = ring.lookups(lookups)
+        ring.close()
+        results.append(result)
+    return results
+
+def bench_membership(sizes=(10, 100, 1000), bits:int=32, joins:int=10, seed:int=0, latency:float=0):
+    """
+    Measures joins and leaves with full finger table initialization, without stabilization.  
+    A join ends when the new node updated the other finger tables and took its keys.
+    """
+    results = []
+    for size in sizes:
+        ring = SimulatedRing(bits, seed, latency=latency, stabilization=False)
+        ring.build(size)
+        join_rpcs, join_seconds, looked_up = [], [], []
+        for _ in range(joins):
+            calls = ring.transport.total_calls()
+            node = ring.join()
+            node.join_task.result()
+            join_seconds.append(node.membership_stats["join_seconds"])
+            join_rpcs.append(ring.transport.total_calls() - calls)
+            looked_up.append(node.membership_stats["join_looked_up_fingers"])
+        result = {"nodes": size, "bits": bits, "joins": joins}
+        result["join"] = {"rpcs": percentiles(join_rpcs), "seconds": percentiles(join_seconds), "looked_up_fingers": percentiles(looked_up)}
+        result["after_joins"] = ring.consistency()
+        leave_rpcs, leave_seconds = [], []
+        for _ in range(joins):
+            if len(ring) < 2:
+                break
+            node = ring.random_node()
+            calls = ring.transport.total_calls()
+            ring.leave(node)
+            leave_seconds.append(node.membership_stats["leave_seconds"])
+            leave_rpcs.append(ring.transport.total_calls() - calls)
+        result["leave"] = {"rpcs": percentiles(leave_rpcs), "seconds": percentiles(leave_seconds)}
+        result["after_leaves"] = ring.consistency()
+        ring.close()
+        results.append(result)
+    return results
+
+def bench_placement(sizes=(10, 100, 1000), bits:int=32, keys:int=10000, seed:int=0):
+    """
+    Grows rings from 2 nodes to each size with every placement, without stabilization, and measures 
+    how many keys the most loaded node stores over the mean, and the moves suggested by the coordinator.
+    """
+    results = []
+    for size in sizes:
+        result = {"nodes": size, "bits": bits, "keys": keys}
+        for placement in ChordNode.PLACEMENTS:
+            ring = SimulatedRing(bits, seed, stabilization=False)
+            ring.build(min(size, 2))
+            ring.insert_keys(keys)
+            calls = ring.transport.total_calls()
+            while len(ring) < size:
+                ring.join(placement).join_task.result()
+            owned = ring.owned_keys()
+            result[placement] = {"owned_keys": owned, "max_over_mean": owned["max"] / owned["mean"], "rpcs": ring.transport.total_calls() - calls,
+                                 "consistency": ring.consistency(), "suggested_moves": len(ring.coordinator.suggest_moves(size))}
+            ring.close()
+        results.append(result)
+    return results
+
+def bench_storage(keys:int=100000, arcs:int=100, seed:int=0):
+    """
+    Measures the throughput of batched inserts, range pops and pop_keys of the storages
+    """
+    rng = random.Random(seed)
+    bits = 32
+    max_nodes = 1 << bits
+    items = {rng.randrange(max_nodes): x for x in range(keys)}
+    bounds = sorted(rng.randrange(max_nodes) for _ in range(arcs))
+    results = []
+    
+    def measure(name, storage, pop):
+        batch = list(items.items())
+        start = time.perf_counter()
+        for i in range(0, len(batch), 1000):
+            storage.update(dict(batch[i:i + 1000]))
+        insert_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        popped = sum(len(pop(bounds[i - 1], bounds[i])) for i in range(len(bounds)))
+        pop_seconds = time.perf_counter() - start
+        results.append({
+            "storage": name,
+            "keys": len(items),
+            "insert_keys_per_second": len(items) / insert_seconds,
+            "popped_keys": popped,
+            "pop_keys_per_second": popped / pop_seconds if pop_seconds else None
+        })
+    
+    storage = MemoryStorage()
+    measure("memory pop_range", storage, storage.pop_range)
+    ring = SimulatedRing(bits, seed)
+    ring.build(1)
+    node = ring.random_node()
+    measure("node pop_keys", node.storage, lambda x, y: node.pop_keys(x, node.sub_id(y, 1)))
+    ring.close()
+    with tempfile.TemporaryDirectory() as path:
+        storage = LogStorage(path)
+        measure("log pop_range", storage, storage.pop_range)
+        storage.close()
+    return results
+
+def commit_id():
+    """
+    Returns the git commit of the benchmarked code, None outside a git repository
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+# plac annotation (description, type of arg [option, flag, positional], abrev, type, choices)
+def main(benchmark:("Benchmark to run","positional",None,str,["fingers","ring","churn","membership","placement","storage"]),
+         output:("Write the JSON results to this file","option","o",str)=None,
+         seed:("Random seed","option","s",int)=0,
+         sizes:("Comma separated ring sizes","option","n",str)="10,100,1000",
+         bits:("Ring hash bits","option","b",int)=32,
+         lookups:("Lookups per ring","option","l",int)=2000,
+         keys:("Stored keys","option","k",int)=10000,
+         churn:("Fraction of failed and joined nodes","option","c",float)=0.1,
+         max_rounds:("Max stabilization rounds after churn","option","r",int)=50,
+         latency:("Latency injected in every call in seconds","option","lt",float)=0,
+         verbose:("Show the nodes log","flag","v",bool)=False):
+    log.basicConfig(level=log.INFO if verbose else log.CRITICAL, format='[%(asctime)s] %(levelname)s - %(message)s')
+    sizes = [int(x) for x in sizes.split(",")]
+    if benchmark == "fingers":
+        results = bench_finger_table(seed=seed)
+        for result in results:
+            print(f"bits {result['bits']:>3}: legacy {result['legacy_ns_per_lookup']:8.0f} ns  compact {result['compact_ns_per_lookup']:8.0f} ns  x{result['speedup']:.1f}")
+    elif benchmark == "ring":
+        results = bench_ring(sizes, bits, lookups, keys, seed=seed, latency=latency)
+        for result in results:
+            print(f"nodes {result['nodes']:>6}: hops p50 {result['lookups']['hops']['p50']} p99 {result['lookups']['hops']['p99']}  "
+                  f"latency p50 {result['lookups']['latency_us']['p50']:.0f} us  "
+                  f"get p50 iterative {result['gets']['iterative']['latency_us']['p50']:.0f} us recursive {result['gets']['recursive']['latency_us']['p50']:.0f} us  "
+                  f"zipf get {result['zipf_gets']['uncached']['rpcs']['mean']:.1f} -> {result['zipf_gets']['cached']['rpcs']['mean']:.1f} rpcs cached  "
+                  f"scan {result['scan']['keys']} keys {result['scan']['rpcs']} rpcs  join {result['join']['rpcs']['mean']:.0f} rpcs  "
+                  f"leave {result['leave']['rpcs']['mean']:.0f} rpcs  moved {result['join_transfer']['transfer_keys']} keys")
+    elif benchmark == "churn":
+        results = bench_churn(sizes, bits, churn, lookups, max_rounds, seed, latency)
+        for result in results:
+            print(f"nodes {result['nodes']:>6}: converged {result['convergence']['converged']} in {result['convergence']['rounds']} rounds "
+                  f"{result['convergence']['seconds']:.2f} s  failed lookups {result['lookups_after_churn']['failed']} -> {result['lookups_after_convergence']['failed']}")
+    elif benchmark == "membership":
+        results = bench_membership(sizes, bits, seed=seed, latency=latency)
+        for result in results:
+            print(f"nodes {result['nodes']:>6}: join p50 {result['join']['seconds']['p50'] * 1000:.1f} ms {result['join']['rpcs']['mean']:.0f} rpcs  "
+                  f"leave p50 {result['leave']['seconds']['p50'] * 1000:.1f} ms {result['leave']['rpcs']['mean']:.0f} rpcs  "
+                  f"fingers ok {result['after_joins']['fingers']:.2f} / {result['after_leaves']['fingers']:.2f}")
+    elif benchmark == "placement":
+        results = bench_placement(sizes, bits, keys, seed)
+        for result in results:
+            print(f"nodes {result['nodes']:>6}: max keys over mean hash {result['hash']['max_over_mean']:.1f} load {result['load']['max_over_mean']:.1f}  "
+                  f"suggested moves hash {result['hash']['suggested_moves']} load {result['load']['suggested_moves']}")
+    else:
+        results = bench_storage(keys, seed=seed)
+        for result in results:
+            print(f"{result['storage']:>16}: insert {result['insert_keys_per_second']:10.0f} keys/s  pop {result['pop_keys_per_second']:10.0f} keys/s")
+    if output:
+        with open(output, "w") as file:
+            json.dump({"benchmark": benchmark, "commit": commit_id(), "python": platform.python_version(), "seed": seed, "results": results}, file, indent=2)
+
+if __name__ == "__main__":
+    plac.call(main)
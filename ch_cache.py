@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+class ReadCache:
+    """
+    Bounded LRU cache of values read from other nodes.  
+    Every value is kept for the lease given by its owner at most, the owner also invalidates 
+    the leases it knows about when the value changes. A capacity of 0 disables the cache.
+    """
+    
+    def __init__(self, capacity:int=0):
+        self.capacity = capacity
+        self._entries = OrderedDict() # Key -> (value, lease expiration)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    @property
+    def enabled(self):
+        return self.capacity > 0
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key:int):
+        """
+        Returns (True, value, seconds left of the lease) if key is cached, (False, None, 0) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                left = entry[1] - time.monotonic()
+                if left > 0:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[0], left
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return False, None, 0
+    
+    def put(self, key:int, value, lease:float):
+        """
+        Caches value for lease seconds, evicting the least recently used keys over capacity
+        """
+        if not self.enabled or lease <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + lease)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, keys:list):
+        """
+        Drops the cached keys of keys
+        """
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "capacity": self.capacity,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
+
+class LeaseTable:
+    """
+    Leases given by an owner node to the caches of other nodes, by key.  
+    Expired leases are dropped when their key is taken and in a full sweep every prune_every grants.
+    """
+    
+    def __init__(self, prune_every:int=10000):
+        self.prune_every = prune_every
+        self._holders = {} # Key -> {holder id: lease expiration}
+        self._grants = 0
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._holders)
+    
+    def grant(self, key:int, holder_id:int, lease:float):
+        now = time.monotonic()
+        with self._lock:
+            self._holders.setdefault(key, {})[holder_id] = now + lease
+            self._grants += 1
+            if self._grants % self.prune_every == 0:
+                for key, holders in list(self._holders.items()):
+                    alive = {x: y for x, y in holders.items() if y > now}
+                    if alive:
+                        self._holders[key] = alive
+                    else:
+                        del self._holders[key]
+    
+    def take(self, keys:list):
+        """
+        Removes the leases of keys and returns {holder id: [keys]} with the ones not expired
+        """
+        if not self._holders:
+            return {}
+        now = time.monotonic()
+        holders = {}
+        with self._lock:
+            for key in keys:
+                for holder_id, expiration in self._holders.pop(key, {}).items():
+                    if expiration > now:
+                        holders.setdefault(holder_id, []).append(key)
+        return holders
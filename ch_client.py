@@ -1,49 +1,516 @@
 import Pyro4 as pyro
+import asyncio
+import bisect
+import logging as log
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from ch_cache import ReadCache
 from ch_coord import ChordCoordinator
 from ch_node import ChordNode
-from ch_shared import create_object_proxy
+from ch_shared import create_object_proxy, get_resolver, KeyHasher, ProxyPool
+from ch_transport import create_transport
 import plac
 
+class RingView:
+    """
+    Cached sorted view of the DHT nodes used to find the owner of a key locally.  
+    The view is refreshed from the coordinator when it's older than ttl seconds or invalidated.
+    """
+    
+    def __init__(self, fetch_nodes, ttl:float=10):
+        """
+        fetch_nodes: function returning a dict node id -> node uri  
+        ttl: seconds before the view is refreshed
+        """
+        self.fetch_nodes = fetch_nodes
+        self.ttl = ttl
+        self.ids = []
+        self.uris = {}
+        self._expiration = 0
+        self._lock = threading.Lock()
+    
+    def refresh(self):
+        """
+        Fetch the registered nodes again
+        """
+        nodes = self.fetch_nodes()
+        with self._lock:
+            self.uris = {int(x): y for x, y in nodes.items()}
+            self.ids = sorted(self.uris)
+            self._expiration = time.monotonic() + self.ttl
+    
+    def invalidate(self):
+        """
+        Force a refresh on the next owner lookup
+        """
+        self._expiration = 0
+    
+    def owner(self, key_id:int):
+        """
+        Returns the id of the node that owns key_id according to the view, None if the view is empty 
+        """
+        if time.monotonic() > self._expiration:
+            self.refresh()
+        with self._lock:
+            ids = self.ids
+        if not ids:
+            return None
+        index = bisect.bisect_left(ids, key_id)
+        return ids[index] if index < len(ids) else ids[0]
+    
+    def replicas(self, key_id:int, count:int):
+        """
+        Returns the ids of the owner of key_id and its count - 1 successors according to the view
+        """
+        owner_id = self.owner(key_id)
+        if owner_id is None:
+            return []
+        ids = self.ids
+        index = ids.index(owner_id)
+        return [ids[(index + i) % len(ids)] for i in range(min(count, len(ids)))]
+    
+    def uri(self, node_id:int):
+        """
+        Returns the cached uri of node_id or None
+        """
+        return self.uris.get(node_id)
+
 class ChordSimpleConsumer:
-    def __init__(self, ns_port, ns_host):
+    def __init__(self, ns_port, ns_host, timeout:float=None, ring_ttl:float=10, bootstrap_count:int=8, cache_size:int=0,
+                 owner_concurrency:int=16):
+        """
+        timeout: seconds before a call to the DHT fails, None waits forever  
+        ring_ttl: seconds between refreshes of the cached ring view and bootstrap nodes  
+        bootstrap_count: nodes asked to the coordinator to route calls through  
+        cache_size: values kept by lookup for the lease given by their owner, 0 disables the cache  
+        owner_concurrency: max amount of owners called in parallel by a batch
+        """
         self.ns_port = ns_port
         self.ns_host = ns_host
-        self.coordinator = create_object_proxy(ChordCoordinator.ADDRESS, self.ns_host, self.ns_port)
-        
-        
+        self.timeout = timeout
+        # Proxies are pooled per thread so the consumer can be used concurrently
+        self.proxy_pool = ProxyPool(self._create_proxy)
+        self.ring = RingView(lambda: self.coordinator.get_nodes(), ring_ttl)
+        self._hasher = None
+        self._replication_factor = None
+        self._transport = None
+        self.ring_ttl = ring_ttl
+        self.bootstrap_count = bootstrap_count
+        self.bootstrap = {} # Cached node id -> uri of the nodes used to route calls
+        self._bootstrap_expiration = 0
+        self.node_latency = {} # Node id -> moving average of the call latency in seconds
+        self.read_cache = ReadCache(cache_size)
+        self.executor = ThreadPoolExecutor(max_workers=owner_concurrency) # Calls the owners of a batch in parallel
+    
+    def close(self):
+        """
+        Release the threads and proxies of the consumer
+        """
+        self.executor.shutdown(wait=False)
+        self.proxy_pool.clear()
+    
+    @property
+    def coordinator(self):
+        return self.proxy_pool.get(ChordCoordinator.ADDRESS)
+    
+    @property
+    def hasher(self):
+        """
+        Hasher used by the DHT nodes
+        """
+        if self._hasher is None:
+            coordinator = self.coordinator
+            self._hasher = KeyHasher(coordinator.bits, coordinator.hash_algorithm)
+        return self._hasher
+    
+    def hash(self, value):
+        """
+        Hash function used by the DHT nodes
+        """
+        return self.hasher.hash(value)
+    
+    @property
+    def replication_factor(self):
+        """
+        Amount of nodes storing each key
+        """
+        if self._replication_factor is None:
+            self._replication_factor = self.coordinator.replication_factor
+        return self._replication_factor
+    
+    @property
+    def transport(self):
+        """
+        Transport used by the DHT nodes, the coordinator is always reached through Pyro
+        """
+        if self._transport is None:
+            self._transport = create_transport(self.coordinator.transport, ns_host=self.ns_host, ns_port=self.ns_port, timeout=self.timeout)
+        return self._transport
+    
+    @property
+    def errors(self):
+        """
+        Exceptions raised when a node can't be reached
+        """
+        return self.transport.errors + (pyro.errors.NamingError,)
+    
+    def _create_proxy(self, name):
+        if not name.startswith(ChordNode.CHORD_NODE_PREFIX):
+            proxy = create_object_proxy(name, self.ns_host, self.ns_port)
+            proxy._pyroTimeout = self.timeout
+            return proxy
+        node_id = int(name[len(ChordNode.CHORD_NODE_PREFIX):])
+        uri = self.ring.uri(node_id) or self.bootstrap.get(node_id)
+        if uri is not None:
+            return self.transport.connect(uri)
+        return self.transport.proxy(name, ChordNode.CHORD_NODE_PREFIX)
+    
     def get_chord_node(self):
-        id = self.coordinator.get_initial_node()
+        id = self.bootstrap_node()
         if id == None:
             print("Chord DHT is empty")
             return
-        node = create_object_proxy(ChordNode.node_name(id), self.ns_host, self.ns_port)
-        return node
+        return self.proxy_pool.get(ChordNode.node_name(id))
+    
+    def bootstrap_node(self):
+        """
+        Returns a random node id of the cached bootstrap nodes, None if the DHT is empty.  
+        The bootstrap nodes are asked to the coordinator when the cache is empty or expired.
+        """
+        if not self.bootstrap or time.monotonic() > self._bootstrap_expiration:
+            try:
+                nodes = self.coordinator.get_bootstrap_nodes(self.bootstrap_count)
+            except pyro.errors.CommunicationError:
+                self.invalidate(ChordCoordinator.ADDRESS)
+                raise
+            self.bootstrap = {int(x): y for x, y in nodes.items()}
+            self._bootstrap_expiration = time.monotonic() + self.ring_ttl
+        bootstrap = list(self.bootstrap)
+        return random.choice(bootstrap) if bootstrap else None
+    
+    def call_node(self, method:str, *args):
+        """
+        Calls method with args in a random node of the DHT and returns its result.  
+        Raise the call exceptions, ValueError if the DHT is empty.
+        """
+        id = self.bootstrap_node()
+        if id == None:
+            raise ValueError("Chord DHT is empty")
+        name = ChordNode.node_name(id)
+        node = self.proxy_pool.get(name)
+        try:
+            return getattr(node, method)(*args)
+        except self.transport.errors:
+            self.bootstrap.pop(id, None)
+            self.invalidate(name)
+            raise
+    
+    def call_owner(self, key_id:int, method:str, *args):
+        """
+        Calls method with args directly in the owner of key_id according to the ring view.  
+        If the owner can't be reached the ring view is refreshed and a random node routes the call. 
+        A stale view is also fine, the called node routes the keys it doesn't own.
+        """
+        owner_id = self.ring.owner(key_id)
+        if owner_id is not None:
+            name = ChordNode.node_name(owner_id)
+            try:
+                return getattr(self.proxy_pool.get(name), method)(*args)
+            except self.errors as exc:
+                log.info(f"Cached owner {owner_id} failed, routing through the DHT: {exc}")
+                self.invalidate(name)
+                self.ring.invalidate()
+        return self.call_node(method, *args)
+    
+    def call_replica(self, key_id:int, method:str, *args):
+        """
+        Calls method with args in the replica of key_id with the lowest latency, the owner or one of 
+        its successors. Nodes without latency measures are tried first.  
+        If the replica can't be reached the call goes to the owner.
+        """
+        replica_ids = self.ring.replicas(key_id, self.replication_factor)
+        if not replica_ids:
+            return self.call_owner(key_id, method, *args)
+        node_id = min(replica_ids, key=lambda x: self.node_latency.get(x, 0))
+        name = ChordNode.node_name(node_id)
+        start = time.monotonic()
+        try:
+            value = getattr(self.proxy_pool.get(name), method)(*args)
+        except self.errors as exc:
+            log.info(f"Replica {node_id} failed, calling the owner: {exc}")
+            self.node_latency.pop(node_id, None)
+            self.invalidate(name)
+            self.ring.invalidate()
+            return self.call_owner(key_id, method, *args)
+        latency = time.monotonic() - start
+        self.node_latency[node_id] = 0.8 * self.node_latency.get(node_id, latency) + 0.2 * latency
+        return value
+    
+    def invalidate(self, name):
+        """
+        Forget the proxies and cached name resolution of an object that failed
+        """
+        self.proxy_pool.discard(name)
+        get_resolver(self.ns_host, self.ns_port).invalidate(name)
+    
+    def lookup(self, key):
+        """
+        Returns the value associated with key. Raise the call exceptions
+        """
+        key_id = self.hash(key)
+        if self.read_cache.enabled:
+            # The owner can't invalidate the cache of a client, values live until the lease ends
+            found, value, _ = self.read_cache.get(key_id)
+            if not found:
+                value, lease = self.call_owner(key_id, "lookup_lease", key_id)
+                self.read_cache.put(key_id, value, lease)
+            return value
+        if self.replication_factor > 1:
+            return self.call_replica(key_id, "lookup", key_id)
+        return self.call_owner(key_id, "lookup", key_id)
+    
+    def insert(self, value, key:int=None):
+        """
+        Saves value in the DHT, with key if given. Raise the call exceptions
+        """
+        key_id = key if key != None else self.hash(value)
+        self.read_cache.invalidate([key_id])
+        self.call_owner(key_id, "insert", value, key_id)
+    
+    def lookup_many(self, keys:list):
+        """
+        Returns {"values": {key: value}, "errors": {key: error message}} for the given keys
+        """
+        key_ids = {}
+        for key, key_id in zip(keys, self.hasher.hash_many(keys)):
+            key_ids.setdefault(key_id, []).append(key)
+        
+        values, errors = {}, {}
+        for owner_key_ids, result in self._call_owners(list(key_ids), "get_values", lambda x: x):
+            if isinstance(result, Exception):
+                result = {"values": {}, "errors": {x: str(result) for x in owner_key_ids}}
+            for key_id, value in result["values"].items():
+                for key in key_ids[key_id]:
+                    values[key] = value
+            for key_id, error in result["errors"].items():
+                for key in key_ids[key_id]:
+                    errors[key] = error
+        return {"values": values, "errors": errors}
+    
+    def insert_many(self, items:list):
+        """
+        Saves the (value, key) pairs of items, key can be None.  
+        Returns {"keys": [keys of the items in order], "errors": {key: error message}}
+        """
+        items = list(items)
+        hashed_keys = iter(self.hasher.hash_many([value for value, key in items if key == None]))
+        keys = []
+        new_values = {}
+        for value, key in items:
+            key_id = key if key != None else next(hashed_keys)
+            keys.append(key_id)
+            new_values[key_id] = value
+        self.read_cache.invalidate(list(new_values))
+        
+        errors = {}
+        owner_values = lambda owner_key_ids: {x: new_values[x] for x in owner_key_ids}
+        for owner_key_ids, result in self._call_owners(list(new_values), "store_values", owner_values):
+            if isinstance(result, Exception):
+                result = {x: str(result) for x in owner_key_ids}
+            errors.update(result)
+        return {"keys": keys, "errors": errors}
+    
+    def scan(self, lower:int=0, upper:int=None, page_size:int=1000):
+        """
+        Yields the stored key values of the ring range [lower, upper], both included, in pages of up to 
+        page_size (key, value) pairs in ring order from lower, the whole ring by default.  
+        Each owner is called directly, starting from the owner in the ring view, and then its successor. 
+        Keys moved by joins and leaves while scanning may be missed or repeated. Raise the call exceptions
+        """
+        upper = self.hasher.max_nodes - 1 if upper == None else upper
+        position, after = lower, None
+        owner_id = self.ring.owner(position)
+        routed = False
+        while True:
+            if owner_id is None:
+                owner_id = self.call_node("find_successor", position)
+                routed = True
+            name = ChordNode.node_name(owner_id)
+            try:
+                page = self.proxy_pool.get(name).scan_page(position, upper, after, page_size)
+            except (ValueError,) + self.errors as exc:
+                if routed:
+                    raise
+                # Stale view or failed owner, a node of the DHT finds the owner of the rest of the range
+                log.info(f"Scan of node {owner_id} failed, routing through the DHT: {exc}")
+                if not isinstance(exc, ValueError):
+                    self.invalidate(name)
+                self.ring.invalidate()
+                owner_id = None
+                continue
+            routed = False
+            if page["items"]:
+                yield [tuple(x) for x in page["items"]]
+            after = page["next"]
+            if not page["done"]:
+                continue
+            if page["end"] == upper:
+                return
+            position, after = (page["end"] + 1) % self.hasher.max_nodes, None
+            owner_id = page["successor"]
+    
+    def _call_owners(self, key_ids:list, method:str, args):
+        """
+        Calls method(args(owner_key_ids)) in the cached owner of each group of key_ids, in parallel.  
+        Returns a list of (owner_key_ids, result or raised exception)
+        """
+        groups = {}
+        for key_id in key_ids:
+            groups.setdefault(self.ring.owner(key_id), []).append(key_id)
+        futures = [(x, self.executor.submit(self.call_owner, x[0], method, args(x))) for x in groups.values()]
+        results = []
+        for owner_key_ids, future in futures:
+            try:
+                result = future.result()
+            except Exception as exc:
+                result = exc
+            results.append((owner_key_ids, result))
+        return results
 
     def get_value(self, key):
-        node = self.get_chord_node()
         try:
-            value = node.lookup(key)
-            return value
+            return self.lookup(key)
         except Exception as exc:
             print(exc)
     
     def save_value(self, value, key):
-        node = self.get_chord_node()
         try:
-            node.insert(value, key)
+            self.insert(value, key)
+        except Exception as exc:
+            print(exc)
+    
+    def get_values(self, keys:list):
+        try:
+            return self.lookup_many(keys)
+        except Exception as exc:
+            print(exc)
+    
+    def save_values(self, items:list):
+        try:
+            return self.insert_many(items)
+        except Exception as exc:
+            print(exc)
+    
+    def print_range(self, lower:int, upper:int):
+        try:
+            for page in self.scan(lower, upper):
+                for key, value in page:
+                    print(f"{key}: {value}")
         except Exception as exc:
             print(exc)
 
+class AsyncChordConsumer:
+    """
+    asyncio consumer of the DHT.  
+    The blocking Pyro calls run in a thread pool so up to concurrency requests are in flight at once.
+    """
+    
+    def __init__(self, ns_port, ns_host, concurrency:int=16, timeout:float=None):
+        """
+        concurrency: max amount of requests in flight  
+        timeout: default seconds before a request fails with asyncio.TimeoutError, None waits forever
+        """
+        self.consumer = ChordSimpleConsumer(ns_port, ns_host, timeout)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._semaphore = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *args):
+        self.close()
+    
+    def close(self):
+        """
+        Release the threads and proxies of the consumer
+        """
+        self.executor.shutdown(wait=False)
+        self.consumer.close()
+    
+    async def _call(self, method:str, *args, timeout:float=None):
+        """
+        Runs the consumer method with args in the thread pool
+        """
+        if self._semaphore is None:
+            # Created here to bind it to the running loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = self.timeout if timeout is None else timeout
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, getattr(self.consumer, method), *args)
+            return await asyncio.wait_for(future, timeout)
+    
+    async def get(self, key, timeout:float=None):
+        """
+        Returns the value associated with key
+        """
+        return await self._call("lookup", key, timeout=timeout)
+    
+    async def put(self, value, key:int=None, timeout:float=None):
+        """
+        Saves value in the DHT, with key if given
+        """
+        await self._call("insert", value, key, timeout=timeout)
+    
+    async def get_many(self, keys:list, batch_size:int=None, timeout:float=None):
+        """
+        Returns {"values": {key: value}, "errors": {key: error message}} for the given keys.  
+        Keys are sent in batches of batch_size running concurrently, all in one batch if None.
+        """
+        batches = await asyncio.gather(*[self._call("lookup_many", x, timeout=timeout) for x in _split(keys, batch_size)])
+        result = {"values": {}, "errors": {}}
+        for batch in batches:
+            result["values"].update(batch["values"])
+            result["errors"].update(batch["errors"])
+        return result
+    
+    async def put_many(self, items:list, batch_size:int=None, timeout:float=None):
+        """
+        Saves the (value, key) pairs of items, key can be None.  
+        Items are sent in batches of batch_size running concurrently, all in one batch if None.  
+        Returns {"keys": [keys of the items in order], "errors": {key: error message}}
+        """
+        batches = await asyncio.gather(*[self._call("insert_many", x, timeout=timeout) for x in _split(items, batch_size)])
+        result = {"keys": [], "errors": {}}
+        for batch in batches:
+            result["keys"].extend(batch["keys"])
+            result["errors"].update(batch["errors"])
+        return result
+
+def _split(values:list, size:int=None):
+    """
+    Split values in lists of size elements
+    """
+    values = list(values)
+    if not size:
+        return [values]
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
 def main(ns_host:("Pyro name server host","option","nsh",str)=None,
          ns_port:("Pyro name server port","option","nsp",int)=None):
     client = ChordSimpleConsumer(ns_port, ns_host)
     import sys
-    help_msg = "commands:\n" + "\n".join(["- " + x for x in ["save", "get", "key", "exit"]])
+    help_msg = "commands:\n" + "\n".join(["- " + x for x in ["save", "get", "key", "msave", "mget", "scan", "exit"]])
     command = None
     print(help_msg)
     while True:
         command = input(">> ")
         if command == "exit":
+            client.close()
             break
         command_words = command.split()
         if len(command_words) > 0:
@@ -76,6 +543,24 @@ def main(ns_host:("Pyro name server host","option","nsh",str)=None,
                     continue
                 value = client.get_value(int(key))
                 print(value)
+            elif command_words[0] == "msave":
+                if len(command_words) < 2:
+                    print("Missing args: msave value [value ...]  Saves the values in the DHT in one batch")
+                    continue
+                print(client.save_values([(x, None) for x in command_words[1:]]))
+            elif command_words[0] == "mget":
+                if len(command_words) < 2:
+                    print("Missing args: mget value [value ...]  Get the values from the DHT in one batch")
+                    continue
+                print(client.get_values(command_words[1:]))
+            elif command_words[0] == "scan":
+                if len(command_words) == 2 or len(command_words) > 3:
+                    print("Wrong args: scan [lower upper]  Print the keys between lower and upper, both included, every key if not given")
+                    continue
+                if len(command_words) == 3:
+                    client.print_range(int(command_words[1]), int(command_words[2]))
+                else:
+                    client.print_range(0, None)
         else:
             print(help_msg)
                 
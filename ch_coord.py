@@ -2,24 +2,132 @@ import Pyro4 as pyro
 import random
 import logging as log
 import sys
+import threading
+import time
 from ch_shared import *
+from ch_transport import create_transport
 import plac
 from concurrent.futures import ThreadPoolExecutor, Future
 
+class LiveNodeSet:
+    """
+    Registered nodes as a list of ids indexed by a dict of positions, so adding, removing and 
+    sampling a random node are O(1). Removal moves the last id into the removed position.
+    """
+    
+    def __init__(self, seed:int=None):
+        """
+        seed: of the random sampling, for reproducible simulations
+        """
+        self._ids = []
+        self._positions = {} # Id -> position in _ids
+        self._addresses = {} # Id -> address
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def __contains__(self, node_id:int):
+        return node_id in self._positions
+    
+    def add(self, node_id:int, address):
+        with self._lock:
+            if node_id not in self._positions:
+                self._positions[node_id] = len(self._ids)
+                self._ids.append(node_id)
+            self._addresses[node_id] = address
+    
+    def remove(self, node_id:int):
+        """
+        Removes node_id, returns if it was in the set
+        """
+        with self._lock:
+            position = self._positions.pop(node_id, None)
+            if position is None:
+                return False
+            last_id = self._ids.pop()
+            if last_id != node_id:
+                self._ids[position] = last_id
+                self._positions[last_id] = position
+            del self._addresses[node_id]
+            return True
+    
+    def address(self, node_id:int):
+        return self._addresses.get(node_id)
+    
+    def sample(self, count:int=1):
+        """
+        Returns up to count distinct random (id, address) pairs
+        """
+        with self._lock:
+            size = len(self._ids)
+            if count >= size:
+                positions = range(size)
+            elif count == 1:
+                positions = [self._random.randrange(size)]
+            else:
+                positions = self._random.sample(range(size), count)
+            return [(self._ids[x], self._addresses[self._ids[x]]) for x in positions]
+    
+    def slice(self, start:int, count:int):
+        """
+        Returns up to count (id, address) pairs from position start, wrapping around the end
+        """
+        with self._lock:
+            size = len(self._ids)
+            return [(self._ids[x % size], self._addresses[self._ids[x % size]]) for x in range(start, start + min(count, size))]
+    
+    def items(self):
+        with self._lock:
+            return list(self._addresses.items())
+
 @pyro.expose
 @pyro.behavior(instance_mode='single')
 class ChordCoordinator:
     
     ADDRESS = "coordinator.chord"
     
-    def __init__(self, key_bits:int, dm_host:str, dm_port:int, ns_host:str, ns_port:int):
-        self.node_addresses = {}
+    def __init__(self, key_bits:int, dm_host:str, dm_port:int, ns_host:str, ns_port:int, hash_algorithm:str="sha1",
+                 replication_factor:int=1, replication_sync:bool=False, transport:str="pyro",
+                 health_interval:float=5, health_batch:int=64, health_timeout:float=2, health_failures:int=2,
+                 rebalance_interval:float=60):
+        """
+        health_interval: seconds between health checks  
+        health_batch: nodes checked in parallel by each health check, the registered nodes are checked in turns  
+        health_timeout: seconds before a health check call fails  
+        health_failures: consecutive failed checks before a node is unregistered  
+        rebalance_interval: seconds between the refreshes of the suggested node moves, 0 disables them
+        """
+        self.nodes = LiveNodeSet()
+        self.health_interval = health_interval
+        self.health_batch = health_batch
+        self.health_timeout = health_timeout
+        self.health_failures = health_failures
+        self.failed_checks = {} # Id -> consecutive failed health checks
+        self.next_check = 0 # Position in nodes of the next health check batch
+        self.rebalance_interval = rebalance_interval
+        self.rebalance_sample = 256 # Nodes asked for their load by each rebalance
+        self.rebalance_ratio = 2 # Keys over the mean of the most loaded node that trigger moves
+        self.rebalance_moves = 4 # Moves suggested by each rebalance
+        self.rebalance_suggestions = []
+        self.reservation_ttl = 60 # Seconds an id reserved by a joining node is kept until it registers
+        self.reservations = {} # Reserved id -> expiration
+        self.reservations_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor()
+        self.running = False
         self._daemon_host = dm_host
         self._daemon_port = dm_port
         self._name_server_host = ns_host
         self._name_server_port = ns_port
         self._bits = key_bits
-        log.info(f"Started Coordinator with {key_bits} bits")
+        self._hash_algorithm = hash_algorithm
+        self._replication_factor = replication_factor
+        self._replication_sync = replication_sync
+        self._transport = transport
+        self.node_transport = None # Transport used to check the nodes, created on first use
+        KeyHasher(key_bits, hash_algorithm) # Fail early with invalid algorithms
+        log.info(f"Started Coordinator with {key_bits} bits and {hash_algorithm} hash")
         print(key_bits)
         
     @property
@@ -29,6 +137,52 @@ class ChordCoordinator:
         """
         return self._bits
     
+    @property
+    def hash_algorithm(self):
+        """
+        Hash algorithm used to place nodes and keys in the ring
+        """
+        return self._hash_algorithm
+    
+    @property
+    def replication_factor(self):
+        """
+        Amount of nodes storing each key, the owner and its first successors
+        """
+        return self._replication_factor
+    
+    @property
+    def replication_sync(self):
+        """
+        If the owner waits for the replicas on writes
+        """
+        return self._replication_sync
+    
+    @property
+    def transport(self):
+        """
+        Transport used by the nodes to serve and call each other, one of TRANSPORTS
+        """
+        return self._transport
+    
+    def _get_node_transport(self):
+        """
+        Returns the transport used to check the nodes
+        """
+        if self.node_transport is None:
+            self.node_transport = create_transport(self._transport, ns_host=self.name_server_host, ns_port=self.name_server_port, timeout=self.health_timeout)
+        return self.node_transport
+    
+    def _call_node(self, address, call):
+        """
+        Returns call(proxy) with a new proxy of the node at address, which is released after the call
+        """
+        proxy = self._get_node_transport().connect(address)
+        try:
+            return call(proxy)
+        finally:
+            proxy._pyroRelease()
+    
     @property
     def daemon_host(self):
         return self._daemon_host
@@ -46,13 +200,15 @@ class ChordCoordinator:
         return self._name_server_port
     
     def cli_loop(self):
-        help_msg = "Commands\nnodes: prints the node's ids of the registered nodes"
+        help_msg = "Commands\nnodes: prints the node's ids of the registered nodes\nmoves: prints the suggested node moves"
         print(help_msg)
         
         while True:
             command = input()
             if command == "nodes":
-                print("\n".join([f"- ".join([str(x) for x in self.node_addresses])]))
+                print("\n".join([f"- {x}" for x, y in self.nodes.items()]))
+            elif command == "moves":
+                print("\n".join([f"- {x}" for x in self.rebalance_suggestions]))
             else:
                 print(help_msg)
     
@@ -61,9 +217,13 @@ class ChordCoordinator:
             coord_dir = daemon.register(self)
             with pyro.locateNS(self.name_server_host, self.name_server_port) as ns:
                 ns.register(ChordCoordinator.ADDRESS, coord_dir)
-            executor = ThreadPoolExecutor()
-            executor.submit(self.cli_loop)
+            self.executor.submit(self.cli_loop)
+            self.running = True
+            self.executor.submit(self.health_check_loop)
+            if self.rebalance_interval:
+                self.executor.submit(self.rebalance_loop)
             daemon.requestLoop()
+            self.running = False
 
     @method_logger
     def register(self, node_id, address):
@@ -74,7 +234,10 @@ class ChordCoordinator:
         address: Chord address  
         """
         log.info(f"Register node {node_id}: {address}")
-        self.node_addresses[node_id] = address
+        self.nodes.add(node_id, address)
+        with self.reservations_lock:
+            self.reservations.pop(node_id, None)
+        self.failed_checks.pop(node_id, None)
 
     @method_logger
     def unregister(self, node_id):
@@ -82,34 +245,150 @@ class ChordCoordinator:
         Unregister a Chord node.
         """
         log.info(f"Unregister node {node_id}")
-        self.node_addresses.__delitem__(node_id)
+        self.nodes.remove(node_id)
+        self.failed_checks.pop(node_id, None)
+    
+    @method_logger
+    def reserve_id(self, node_id:int):
+        """
+        Reserves node_id for a joining node for reservation_ttl seconds or until it registers.  
+        Returns False if node_id is registered or reserved already
+        """
+        now = time.monotonic()
+        with self.reservations_lock:
+            for expired in [x for x, y in self.reservations.items() if y < now]:
+                del self.reservations[expired]
+            if node_id in self.nodes or node_id in self.reservations:
+                return False
+            self.reservations[node_id] = now + self.reservation_ttl
+            return True
+    
+    @method_logger
+    def get_nodes(self):
+        """
+        Returns a dict with the registered nodes ids and their addresses
+        """
+        return {node_id: str(address) for node_id, address in self.nodes.items()}
     
     @method_logger
     def get_initial_node(self):
         """
-        Gets a random active node id from the registered nodes
+        Gets a random node id from the registered nodes, None if there are none.  
+        Dead nodes are removed by the health checks, not on this call.
+        """
+        sample = self.nodes.sample()
+        return sample[0][0] if sample else None
+    
+    @method_logger
+    def get_bootstrap_nodes(self, count:int):
+        """
+        Returns a dict with up to count random registered nodes ids and their addresses
+        """
+        return {node_id: str(address) for node_id, address in self.nodes.sample(count)}
+    
+    def health_check_loop(self):
+        """
+        Checks the next batch of nodes every health_interval seconds while running
         """
-        if self.node_addresses:
-            node_id, node_address = random.choice([x for x in self.node_addresses.items()])
+        while self.running:
             try:
-                node = pyro.Proxy(node_address)
-                log.info(f"Returned initial node {node_id} with address {node_address}")
-                return node.id
-            except pyro.errors.CommunicationError:
+                self.check_nodes()
+            except Exception as exc:
+                log.exception(exc)
+            time.sleep(self.health_interval)
+    
+    def check_nodes(self):
+        """
+        Checks in parallel whether the next health_batch nodes answer, nodes that failed 
+        health_failures checks in a row are unregistered. Returns the ids of the unregistered nodes
+        """
+        batch = self.nodes.slice(self.next_check, self.health_batch)
+        self.next_check = (self.next_check + len(batch)) % max(len(self.nodes), 1)
+        
+        def check(address):
+            try:
+                self._call_node(address, lambda node: node.id)
+                return True
+            except Exception:
+                return False
+        
+        removed = []
+        for (node_id, address), alive in zip(batch, self.executor.map(check, [y for x, y in batch])):
+            if alive:
+                self.failed_checks.pop(node_id, None)
+                continue
+            self.failed_checks[node_id] = self.failed_checks.get(node_id, 0) + 1
+            if self.failed_checks[node_id] >= self.health_failures and self.nodes.address(node_id) == address:
                 log.info(f"Node {node_id} offline")
                 self.unregister(node_id)
-                return self.get_initial_node()
-        log.info(f"No initial node found")
-        return None
+                removed.append(node_id)
+        return removed
+    
+    @method_logger
+    def get_rebalance_suggestions(self):
+        """
+        Returns the node moves suggested by the last rebalance, see suggest_moves
+        """
+        return self.rebalance_suggestions
+    
+    def rebalance_loop(self):
+        """
+        Refreshes the suggested node moves every rebalance_interval seconds while running
+        """
+        while self.running:
+            time.sleep(self.rebalance_interval)
+            try:
+                self.rebalance_suggestions = self.suggest_moves(self.rebalance_moves)
+                for move in self.rebalance_suggestions:
+                    log.info(f"Suggested move of node {move['node']} to {move['new_id']}, splitting node {move['splits']} with {move['split_keys']} keys")
+            except Exception as exc:
+                log.exception(exc)
+    
+    def suggest_moves(self, count:int=1):
+        """
+        Asks the load of up to rebalance_sample nodes and pairs the least loaded with the most loaded ones 
+        while these have rebalance_ratio times the mean keys and the move reduces the maximum.  
+        Returns up to count moves {"node", "keys", "new_id", "splits", "split_keys"}: the node leaves, 
+        handing its keys to its successor, and joins again as new_id, taking half of the keys of splits
+        """
+        def load(address):
+            try:
+                return self._call_node(address, lambda node: node.get_load())
+            except Exception:
+                return None
+        
+        sample = self.nodes.sample(self.rebalance_sample)
+        loads = sorted([x for x in self.executor.map(load, [y for x, y in sample]) if x != None], key=lambda x: (x["keys"], x["arc"]))
+        if len(loads) < 2:
+            return []
+        mean = sum(x["keys"] for x in loads) / len(loads)
+        moves = []
+        for light, heavy in zip(loads[:len(loads) // 2], reversed(loads)):
+            if len(moves) >= count or heavy["keys"] < self.rebalance_ratio * mean or heavy["split"] == None:
+                break
+            if light["keys"] + heavy["keys"] // 2 >= heavy["keys"]:
+                break
+            moves.append({"node": light["id"], "keys": light["keys"], "new_id": heavy["split"], "splits": heavy["id"], "split_keys": heavy["keys"]})
+        return moves
 
 # plac annotation (description, type of arg [option, flag, positional], abrev, type, choices)
 def main(bits:("Hash bits","option","b",int)=5,
          dm_host:("Pyro daemon host","option","ho",str)=None,
          dm_port:("Pyro daemon port","option","p",int)=0,
          ns_host:("Pyro name server host","option","nsh",str)=None,
-         ns_port:("Pyro name server port","option","nsp",int)=None):
-    log.basicConfig(level=log.DEBUG, format='[%(asctime)s] %(levelname)s - %(message)s')
-    coordinator = ChordCoordinator(bits, dm_host, dm_port, ns_host, ns_port)
+         ns_port:("Pyro name server port","option","nsp",int)=None,
+         hash_algorithm:("Key hash algorithm","option","ha",str,KeyHasher.ALGORITHMS)="sha1",
+         replication_factor:("Amount of nodes storing each key","option","r",int)=1,
+         replication_sync:("Wait for the replicas on writes","flag","rs",bool)=False,
+         transport:("Transport used by the nodes","option","tr",str,["pyro","tcp"])="pyro",
+         health_interval:("Seconds between node health checks","option","hi",float)=5,
+         health_batch:("Nodes checked by each health check","option","hb",int)=64,
+         rebalance_interval:("Seconds between suggested node moves, 0 disables them","option","ri",float)=60,
+         trace:("Log every method call for debugging","flag","t",bool)=False):
+    log.basicConfig(level=log.DEBUG if trace else log.INFO, format='[%(asctime)s] %(levelname)s - %(message)s')
+    set_tracing(trace)
+    coordinator = ChordCoordinator(bits, dm_host, dm_port, ns_host, ns_port, hash_algorithm, replication_factor, replication_sync, transport,
+                                   health_interval, health_batch, rebalance_interval=rebalance_interval)
     coordinator.start()
     
     
@@ -1,5 +1,7 @@
 from ch_coord import ChordCoordinator
-from ch_node import ChordNode
+from ch_node import ChordNode, ChordVirtualHost
+from ch_storage import LogStorage
+from ch_shared import set_tracing
 import logging as log
 import plac
 
@@ -18,10 +20,26 @@ def main(host:("Chord node host","option","ho",str)=None,
          ns_host:("Name server host","option","nsh",str)=None,
          ns_port:("Name server port","option","nsp",str)=None,
          forced_id:("Force the node id","option","id",int)=None,
-         not_stable:("If run stabilization algorithm","flag","s",bool)=False):
-    log.basicConfig(level=log.DEBUG,format='[%(asctime)s] %(levelname)s - %(message)s')
+         not_stable:("If run stabilization algorithm","flag","s",bool)=False,
+         vnodes:("Amount of virtual nodes hosted by the process","option","vn",int)=1,
+         storage_path:("Directory of the persistent node storage, in memory if not given","option","st",str)=None,
+         call_timeout:("Seconds before a call to another node fails","option","to",float)=None,
+         detector:("Failure detector mode","option","fd",str,["phi","timeout"])="phi",
+         routing:("Routing mode of lookups and inserts","option","rm",str,["iterative","recursive"])="iterative",
+         cache_size:("Keys of other nodes kept in the read cache, 0 disables it","option","cs",int)=0,
+         cache_lease:("Seconds the node keys can be cached by others","option","cl",float)=1,
+         placement:("How the node id is chosen if not forced","option","pl",str,["hash","load"])="hash",
+         metrics:("Record the node metrics from the start","flag","m",bool)=False,
+         trace:("Log every method call for debugging","flag","t",bool)=False):
+    log.basicConfig(level=log.DEBUG if trace else log.INFO,format='[%(asctime)s] %(levelname)s - %(message)s')
+    set_tracing(trace)
     try:
-        ch1 = ChordNode(host, port, ns_host, ns_port, forced_id, not not_stable)
+        storage = LogStorage(storage_path) if storage_path else None
+        if vnodes > 1:
+            ch1 = ChordVirtualHost(vnodes, host, port, ns_host, ns_port, forced_id, not not_stable, storage, call_timeout, detector, routing, cache_size, cache_lease, placement, metrics)
+        else:
+            ch1 = ChordNode(host, port, ns_host, ns_port, forced_id, not not_stable, storage=storage,
+                            call_timeout=call_timeout, detector=detector, routing=routing, cache_size=cache_size, cache_lease=cache_lease, placement=placement, metrics=metrics)
         ch1.register_listener(DummyListener())
         ch1.start(ChordCoordinator.ADDRESS)
     except Exception as exc:
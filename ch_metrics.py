@@ -0,0 +1,136 @@
+import functools
+import random
+import threading
+import time
+
+class Histogram:
+    """
+    Histogram with power of two buckets, bucket i counts the values in [2**(i-1), 2**i).  
+    Values are non negative integers, like latencies in microseconds or hop counts.
+    """
+    
+    __slots__ = ("buckets", "count", "total", "max")
+    
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+    
+    def observe(self, value:int):
+        self.buckets[min(value.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def percentile(self, fraction:float):
+        """
+        Returns the upper bound of the bucket holding the given fraction of the values
+        """
+        if not self.count:
+            return 0
+        target = fraction * self.count
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= target:
+                return min((1 << index) - 1, self.max)
+        return self.max
+    
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max
+        }
+
+class Metrics:
+    """
+    Counters and histograms of a node.  
+    When disabled, the default, nothing is recorded. When enabled every call is counted and the latency of  
+    a sample_rate fraction of the calls is recorded.
+    """
+    
+    def __init__(self, enabled:bool=False, sample_rate:float=1.0):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+    
+    def configure(self, enabled:bool=None, sample_rate:float=None):
+        """
+        Switch the metrics on or off and change the latency sample rate
+        """
+        if enabled is not None:
+            self.enabled = enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+    
+    def sampled(self):
+        """
+        Checks if the current call must record its latency
+        """
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+    
+    def count(self, name:str, value:int=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name:str, value:int):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+    
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+    
+    def snapshot(self):
+        """
+        Returns the counters and the summary of every histogram
+        """
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "counters": dict(self.counters),
+                "histograms": {x: y.summary() for x, y in self.histograms.items()}
+            }
+
+def instrumented(fun):
+    """
+    Decorator for methods of objects with a metrics attribute.  
+    Counts the calls and errors of the method and records the sampled latencies in microseconds.
+    """
+    calls = f"{fun.__name__}.calls"
+    errors = f"{fun.__name__}.errors"
+    latency = f"{fun.__name__}.latency_us"
+    
+    @functools.wraps(fun)
+    def ret_fun(self, *args, **kwargs):
+        metrics = self.metrics
+        if not metrics.enabled:
+            return fun(self, *args, **kwargs)
+        metrics.count(calls)
+        start = time.perf_counter() if metrics.sampled() else None
+        try:
+            return fun(self, *args, **kwargs)
+        except Exception:
+            metrics.count(errors)
+            raise
+        finally:
+            if start is not None:
+                metrics.observe(latency, int((time.perf_counter() - start) * 1e6))
+    return ret_fun
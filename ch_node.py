@@ -1,60 +1,483 @@
 import Pyro4 as pyro
 import Pyro4.util
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError, wait
 from ch_coord import ChordCoordinator
 import sys
 import logging as log
 from ch_shared import *
+from ch_storage import MemoryStorage
+from ch_cache import ReadCache, LeaseTable
+from ch_metrics import Metrics, instrumented
+from ch_transport import create_transport, remote_exception
 import time
-import random
+import threading
+import pickle
+import bisect
+import json
+import math
+import itertools
+import os
 sys.excepthook = Pyro4.util.excepthook
 
-def operate_id(id1, id2, total_bits, operator):
-    """
-    Operate id1 and id2 with function operator,  using arithmetic modulo 2**total_bits
-    """
-    return operator(id1,id2) % (1 << total_bits)
-
 def sum_id(id1, id2, total_bits):
     """
     Sum id1 and id2 using arithmetic modulo 2**total_bits
     """
-    return operate_id(id1, id2, total_bits, lambda x,y: x + y)
+    return (id1 + id2) % (1 << total_bits)
 
 def sub_id(id1, id2, total_bits):
     """
     Substract id1 and id2 using arithmetic modulo 2**total_bits
     """
-    return operate_id(id1, id2, total_bits, lambda x,y: x - y)
-
+    return (id1 - id2) % (1 << total_bits)
 
-class FingerTableEntry:
-    
-    def __init__(self, node_key:int, entry_bit:int, total_bits:int, successor:int=None):
-        self.is_predecessor = entry_bit == 0
-        
-        if entry_bit == 0: # Predecessor
-            entry_bit = 1 # To avoid negative shift
+def executor_workers(loops:int):
+    """
+    Returns the workers of an executor that keeps loops long-lived loops running, plus the workers 
+    of a default ThreadPoolExecutor left for the calls
+    """
+    return loops + min(32, (os.cpu_count() or 1) + 4)
 
-        self.start = sum_id(node_key, 1 << (entry_bit - 1), total_bits)
-        self.successor = successor
 
+class FingerTable:
+    """
+    Finger table of a node stored in parallel lists of starts and successors.  
+    Entry 0 is the predecessor and entry i in 1..bits is the successor of id + 2**(i-1).  
+    The distinct successors of the entries 1..bits are also kept as a sorted list of their distances 
+    from id + 1, so the closest preceding finger is found with a bisect instead of a scan.
+    """
+    
+    __slots__ = ("node_id", "bits", "max_nodes", "next_id", "starts", "successors", "_distances", "_counts", "_lock")
+    
+    def __init__(self, node_id:int, bits:int, successor:int=None):
+        """
+        successor: initial successor of every entry
+        """
+        self.node_id = node_id
+        self.bits = bits
+        self.max_nodes = 1 << bits
+        self.next_id = (node_id + 1) % self.max_nodes
+        self.starts = [self.next_id] + [(node_id + (1 << i)) % self.max_nodes for i in range(bits)]
+        self.successors = [successor] * (bits + 1)
+        self._distances = [] if successor is None else [(successor - self.next_id) % self.max_nodes]
+        self._counts = {} if successor is None else {successor: bits} # Successor -> entries pointing to it
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return self.bits + 1
+    
     def __str__(self):
-        return f"{self.start} -> {self.successor}" if not self.is_predecessor else f"Pred -> {self.successor}"
+        return str([f"Pred -> {self.successors[0]}"] + [f"{x} -> {y}" for x, y in zip(self.starts[1:], self.successors[1:])])
+    
+    def __repr__(self):
+        return str(self)
+    
+    def set(self, index:int, successor:int):
+        """
+        Set the successor of entry index
+        """
+        with self._lock:
+            old_successor = self.successors[index]
+            self.successors[index] = successor
+            if index == 0 or old_successor == successor:
+                return
+            # The distances list is replaced instead of modified so readers don't need the lock
+            distances = self._distances
+            if old_successor is not None:
+                self._counts[old_successor] -= 1
+                if not self._counts[old_successor]:
+                    del self._counts[old_successor]
+                    distances = distances.copy()
+                    distances.remove((old_successor - self.next_id) % self.max_nodes)
+            if successor is not None:
+                self._counts[successor] = self._counts.get(successor, 0) + 1
+                if self._counts[successor] == 1:
+                    distances = distances.copy() if distances is self._distances else distances
+                    bisect.insort(distances, (successor - self.next_id) % self.max_nodes)
+            self._distances = distances
+    
+    def closest_preceding(self, key:int, excluded=None):
+        """
+        Returns the finger successor closest to key in (id, key), or the node id if none.  
+        Fingers in the excluded set are skipped.
+        """
+        distances = self._distances
+        limit = (key - self.next_id) % self.max_nodes
+        # With limit 0 the range is the whole ring and every finger precedes key
+        index = bisect.bisect_left(distances, limit) - 1 if limit else len(distances) - 1
+        while index >= 0:
+            finger = (distances[index] + self.next_id) % self.max_nodes
+            if not excluded or finger not in excluded:
+                return finger
+            index -= 1
+        return self.node_id
+    
+    def distinct_successors(self):
+        """
+        Returns the distinct successors of the entries 1..bits ordered by distance from the node
+        """
+        return [(x + self.next_id) % self.max_nodes for x in self._distances]
 
+class SuccessorList:
+    """
+    The first successors of a node in ring order, used to fail over when the successor fails.  
+    Ids are kept as their sorted distances from the node, so a change costs O(log size + size), 
+    and the distances list is replaced instead of modified so readers don't need the lock.
+    """
+    
+    def __init__(self, node_id:int, bits:int, size:int):
+        self.node_id = node_id
+        self.max_nodes = 1 << bits
+        self.size = size
+        self._distances = []
+        self._lock = threading.Lock()
+    
+    def _distance(self, node_id:int):
+        # The node itself is the farthest id, every successor precedes it
+        return (node_id - self.node_id - 1) % self.max_nodes
+    
+    def _id(self, distance:int):
+        return (distance + self.node_id + 1) % self.max_nodes
+    
+    def __len__(self):
+        return len(self._distances)
+    
+    def __iter__(self):
+        return iter(self.ids())
+    
+    def __contains__(self, node_id:int):
+        distances = self._distances
+        distance = self._distance(node_id)
+        index = bisect.bisect_left(distances, distance)
+        return index < len(distances) and distances[index] == distance
+    
+    def __str__(self):
+        return str(self.ids())
+    
     def __repr__(self):
         return str(self)
+    
+    def ids(self):
+        """
+        Returns the successor ids in ring order
+        """
+        return [self._id(x) for x in self._distances]
+    
+    def first(self, excluded=None):
+        """
+        Returns the closest successor not in excluded, None if there is none
+        """
+        for distance in self._distances:
+            node_id = self._id(distance)
+            if not excluded or node_id not in excluded:
+                return node_id
+        return None
+    
+    def closest_preceding(self, key:int, excluded=None):
+        """
+        Returns the successor closest to key in (node id, key) not in excluded, or the node id if none
+        """
+        distances = self._distances
+        index = bisect.bisect_left(distances, self._distance(key)) - 1
+        while index >= 0:
+            node_id = self._id(distances[index])
+            if not excluded or node_id not in excluded:
+                return node_id
+            index -= 1
+        return self.node_id
+    
+    def set_successor(self, successor_id:int):
+        """
+        Makes successor_id the first successor, the entries preceding it are dropped
+        """
+        with self._lock:
+            if successor_id is None or successor_id == self.node_id:
+                self._distances = []
+                return
+            distances = self._distances
+            distance = self._distance(successor_id)
+            index = bisect.bisect_left(distances, distance)
+            if index < len(distances) and distances[index] == distance:
+                self._distances = distances[index:]
+            else:
+                self._distances = ([distance] + distances[index:])[:self.size]
+    
+    def update(self, successors:list, excluded=None):
+        """
+        Replaces the list with successors, the successor followed by its own successor list.  
+        Entries in excluded and entries wrapping around the ring up to the node are dropped.
+        """
+        distances = []
+        for node_id in successors:
+            distance = self._distance(node_id)
+            if distances and distance == distances[-1]:
+                continue
+            if distances and distance < distances[-1] or node_id == self.node_id:
+                break
+            if distances and excluded and node_id in excluded:
+                continue
+            distances.append(distance)
+            if len(distances) == self.size:
+                break
+        with self._lock:
+            self._distances = distances
+    
+    def remove(self, node_id:int):
+        """
+        Drops node_id from the list, returns if it was in it
+        """
+        with self._lock:
+            distances = self._distances
+            distance = self._distance(node_id)
+            index = bisect.bisect_left(distances, distance)
+            if index == len(distances) or distances[index] != distance:
+                return False
+            self._distances = distances[:index] + distances[index + 1:]
+            return True
+
+class TransferStats:
+    """
+    Throughput and peak memory of a key transfer.  
+    Memory is measured as the serialized size of the transferred chunks.
+    """
+    
+    def __init__(self, name:str):
+        self.name = name
+        self.start = time.monotonic()
+        self.keys = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.peak_chunk_bytes = 0
+    
+    def add_chunk(self, items:dict):
+        size = len(pickle.dumps(items))
+        self.keys += len(items)
+        self.chunks += 1
+        self.bytes += size
+        self.peak_chunk_bytes = max(self.peak_chunk_bytes, size)
+    
+    def summary(self):
+        seconds = time.monotonic() - self.start
+        return {
+            "transfer": self.name,
+            "keys": self.keys,
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "seconds": seconds,
+            "keys_per_second": self.keys / seconds if seconds else 0,
+            "peak_chunk_bytes": self.peak_chunk_bytes
+        }
+
+class AdaptiveScheduler:
+    """
+    Interval of a periodic maintenance task.  
+    The interval grows by backoff times up to max_interval while runs don't change anything and 
+    drops to min_interval when a run detects a change, fails or the scheduler is tightened.
+    """
+    
+    def __init__(self, name:str, min_interval:float=0.5, max_interval:float=30, backoff:float=2):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.runs = 0
+        self.changes = 0
+        self.failures = 0
+        self.stable_runs = 0 # Consecutive runs without changes
+        self.unstable_since = None # Time of the first change since the last stable run
+        self.last_convergence_seconds = None
+        self._wake = threading.Event()
+    
+    def report(self, changed:bool):
+        """
+        Report the result of a run
+        """
+        self.runs += 1
+        if changed:
+            self.changes += 1
+            self._unstable()
+        else:
+            self.stable_runs += 1
+            if self.unstable_since is not None:
+                self.last_convergence_seconds = time.monotonic() - self.unstable_since
+                self.unstable_since = None
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+    
+    def report_failure(self):
+        """
+        Report a failed run
+        """
+        self.runs += 1
+        self.failures += 1
+        self._unstable()
+    
+    def tighten(self):
+        """
+        Run the task soon, used when churn or routing failures are detected outside the task
+        """
+        if self.interval > self.min_interval:
+            self._unstable()
+            self._wake.set()
+    
+    def _unstable(self):
+        self.stable_runs = 0
+        self.interval = self.min_interval
+        if self.unstable_since is None:
+            self.unstable_since = time.monotonic()
+    
+    def wait(self):
+        """
+        Sleep the current interval or until tightened
+        """
+        self._wake.wait(self.interval)
+        self._wake.clear()
+    
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "changes": self.changes,
+            "failures": self.failures,
+            "stable_runs": self.stable_runs,
+            "converged": self.unstable_since is None,
+            "last_convergence_seconds": self.last_convergence_seconds
+        }
+
+class FailureDetector:
+    """
+    Suspicion level of the nodes this node talks to, from the arrival times of their heartbeats.  
+    In phi mode the suspicion is the phi accrual value of the time since the last heartbeat, given 
+    the mean and deviation of the last window intervals between heartbeats, with acceptable_pause 
+    added to the mean. Phi is 0 until min_samples intervals are known. In timeout mode a node 
+    is suspected when no heartbeat arrived for timeout seconds. A failed call makes the node 
+    suspected until its next heartbeat.
+    """
+    
+    MODES = ("phi", "timeout")
+    
+    def __init__(self, mode:str="phi", threshold:float=8, timeout:float=3, window:int=100, min_deviation:float=0.5,
+                 acceptable_pause:float=0, min_samples:int=5, clock=time.monotonic):
+        """
+        threshold: phi value from which a node is suspected  
+        timeout: seconds without heartbeats before a node is suspected in timeout mode  
+        window: amount of intervals kept by node  
+        min_deviation: minimum deviation of the intervals in seconds, avoids suspecting on small delays  
+        acceptable_pause: seconds a heartbeat can be late without raising phi, like a slow answer  
+        min_samples: intervals needed before phi can suspect a node  
+        clock: returns the current time in seconds, a simulation can replace it by a logical clock
+        """
+        if mode not in FailureDetector.MODES:
+            raise ValueError(f"Unknown failure detector mode {mode}, use one of {FailureDetector.MODES}")
+        self.mode = mode
+        self.threshold = threshold
+        self.timeout = timeout
+        self.window = window
+        self.min_deviation = min_deviation
+        self.acceptable_pause = acceptable_pause
+        self.min_samples = min_samples
+        self.clock = clock
+        self._last = {} # Node id -> time of the last heartbeat
+        self._intervals = {} # Node id -> last intervals between heartbeats
+        self._distribution = {} # Node id -> (mean, deviation) of the intervals
+        self._failed = set() # Nodes with a failed call since their last heartbeat
+        self._lock = threading.Lock()
+    
+    def heartbeat(self, node_id:int):
+        """
+        Record an answer of node_id
+        """
+        now = self.clock()
+        with self._lock:
+            last = self._last.get(node_id)
+            self._last[node_id] = now
+            self._failed.discard(node_id)
+            if last is not None:
+                intervals = self._intervals.setdefault(node_id, [])
+                intervals.append(now - last)
+                if len(intervals) > self.window:
+                    del intervals[0]
+                if len(intervals) >= self.min_samples:
+                    mean = sum(intervals) / len(intervals)
+                    deviation = math.sqrt(sum((x - mean) ** 2 for x in intervals) / len(intervals))
+                    self._distribution[node_id] = (mean + self.acceptable_pause, max(deviation, self.min_deviation))
+    
+    def failure(self, node_id:int):
+        """
+        Record a failed call to node_id
+        """
+        with self._lock:
+            self._failed.add(node_id)
+    
+    def forget(self, node_id:int):
+        with self._lock:
+            self._last.pop(node_id, None)
+            self._intervals.pop(node_id, None)
+            self._distribution.pop(node_id, None)
+            self._failed.discard(node_id)
+    
+    def phi(self, node_id:int):
+        """
+        Returns the suspicion level of node_id, 0 for unknown nodes and infinite after a failed call
+        """
+        if node_id in self._failed:
+            return math.inf
+        last = self._last.get(node_id)
+        distribution = self._distribution.get(node_id)
+        if last is None or distribution is None:
+            return 0
+        elapsed = self.clock() - last
+        mean, deviation = distribution
+        # Logistic approximation of the normal distribution tail, y is bounded to avoid overflows
+        y = max(-10, min(10, (elapsed - mean) / deviation))
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean:
+            return -math.log10(e / (1 + e))
+        return -math.log10(1 - 1 / (1 + e))
+    
+    def __contains__(self, node_id:int):
+        return self.suspected(node_id)
+    
+    def suspected(self, node_id:int):
+        if node_id in self._failed:
+            return True
+        if self.mode == "timeout":
+            last = self._last.get(node_id)
+            return last is not None and self.clock() - last > self.timeout
+        return self.phi(node_id) >= self.threshold
+    
+    def monitored(self):
+        """
+        Returns the node ids with heartbeats or failed calls
+        """
+        with self._lock:
+            return set(self._last) | self._failed
+    
+    def suspects(self):
+        """
+        Returns the suspected node ids
+        """
+        return {x for x in self.monitored() if self.suspected(x)}
+    
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "nodes": {x: {"phi": self.phi(x), "suspected": self.suspected(x)} for x in self.monitored()}
+        }
 
 @pyro.expose
 class ChordNode:
     
     CHORD_NODE_PREFIX = "chord.node."
+    ROUTING_MODES = ("iterative", "recursive")
+    PLACEMENTS = ("hash", "load")
+    LOOPS = 3 # stabilize, fix_fingers and failure detector loops kept running in the executor by a joined node
     
     def hash(self, value):
         """
         Hash function used by ChordNode
         """
-        return hash(value) % (self.max_nodes) 
+        return self.hasher.hash(value)
     
     @staticmethod
     def node_name(id):
@@ -64,20 +487,20 @@ class ChordNode:
         return f"{ChordNode.CHORD_NODE_PREFIX}{id}"
 
     def _get_successor(self):
-        return self.finger_table[1].successor
+        return self.finger_table.successors[1]
     
     def _set_successor(self, value):
-        self.add_successor_list(value)
-        self.finger_table[1].successor = value
+        self.successor_list.set_successor(value)
+        self.finger_table.set(1, value)
 
     successor = property(_get_successor, _set_successor)
 
     
     def _get_predecessor(self):
-        return self.finger_table[0].successor
+        return self.finger_table.successors[0]
     
     def _set_predecessor(self, value):
-        self.finger_table[0].successor = value
+        self.finger_table.set(0, value)
 
     predecessor = property(_get_predecessor, _set_predecessor)
     
@@ -94,7 +517,28 @@ class ChordNode:
     
     id = property(_get_id, _set_id)
     
-    def __init__(self, host=None, port=0, name_server_host=None, name_server_port=None, forced_id=None, stabilization=True):
+    def __init__(self, host=None, port=0, name_server_host=None, name_server_port=None, forced_id=None, stabilization=True,
+                 executor=None, proxy_pool=None, storage=None, local_nodes=None, transport=None,
+                 call_timeout:float=None, detector:str="phi", routing:str="iterative", cache_size:int=0, cache_lease:float=1,
+                 placement:str="hash", metrics:bool=False):
+        """
+        executor, proxy_pool, storage and local_nodes are given when the node shares them with other 
+        virtual nodes of the same process, local_nodes maps the ids of those nodes to the node objects.  
+        transport: how the node is served and reaches the others, taken from the coordinator on start if None  
+        call_timeout: seconds before a call to another node fails, None waits forever  
+        detector: failure detector mode, one of FailureDetector.MODES  
+        routing: how lookup and insert reach the owner, one of ROUTING_MODES. Iterative asks every hop 
+        from this node, recursive forwards the request hop by hop and the owner replies to this node.  
+        cache_size: keys of other nodes cached by lookup, 0 disables the cache  
+        cache_lease: seconds the keys of this node can be cached by others  
+        placement: how the id is chosen when it isn't forced, one of PLACEMENTS. Hash hashes the node 
+        address, load splits the most loaded range of a sample of nodes.  
+        metrics: record metrics from the start, they can be switched on later with configure_metrics
+        """
+        if routing not in ChordNode.ROUTING_MODES:
+            raise ValueError(f"Unknown routing mode {routing}, use one of {ChordNode.ROUTING_MODES}")
+        if placement not in ChordNode.PLACEMENTS:
+            raise ValueError(f"Unknown placement {placement}, use one of {ChordNode.PLACEMENTS}")
         self.listeners = []
         self.host = host
         self.port = port
@@ -103,38 +547,464 @@ class ChordNode:
         self._id = None
         self.id = forced_id
         self.bits = None
-        self.successor_list = []
+        self.successor_list = None
         self.stabilization = stabilization
         self.running = False
-        self.values = {}
-        self.executor = ThreadPoolExecutor()
+        self.storage = MemoryStorage() if storage is None else storage
+        # The loops of the node and its cli loop
+        self.executor = ThreadPoolExecutor(executor_workers(ChordNode.LOOPS + 1)) if executor is None else executor
+        self.proxy_pool = ProxyPool(self._create_node_proxy) if proxy_pool is None else proxy_pool
+        self.local_nodes = {} if local_nodes is None else local_nodes
+        self.transport = transport
+        self.owns_transport = True
+        self.call_timeout = call_timeout
+        self.ping_interval = 1
+        self.ping_timeout = 2 if call_timeout is None else call_timeout # Seconds before a ping fails
+        # A heartbeat is late by up to ping_timeout when the neighbour answers slowly, and pings aren't 
+        # sent at exact ping_interval periods
+        self.failure_detector = FailureDetector(detector, min_deviation=self.ping_interval / 2, acceptable_pause=self.ping_timeout)
+        self.ping_proxy_pool = ProxyPool(self._create_ping_proxy)
+        self.pings_in_flight = set() # Ids of the neighbours with a ping not answered yet
+        self.pings_lock = threading.Lock()
+        self.max_route_failures = 3 # Failed hops before a route fails
+        self.routing = routing
+        self.recursive_timeout = 5 # Seconds waiting the owner reply before routing iteratively
+        self.max_hops = None # Hop limit of recursive requests, 2 * bits if None
+        self.pending_requests = {} # Request id -> Future of the recursive requests started here
+        self.request_ids = itertools.count()
+        self.read_cache = ReadCache(cache_size)
+        self.cache_lease = cache_lease
+        self.leases = LeaseTable() # Keys of this node cached by other nodes
+        self.coordinator_address = ChordCoordinator.ADDRESS
+        self.bootstrap_count = 4 # Nodes asked to the coordinator to join through
+        self.placement = placement
+        self.placement_samples = 8 # Nodes asked for their load by the load placement
+        self.transfer_chunk_size = 1000
+        self.transfer_cursors = {} # (source id, lower bound, upper bound) -> (last acknowledged key, expiration) of an interrupted transfer
+        self.transfer_cursor_ttl = 60 # Seconds an interrupted transfer can be resumed
+        self.transfer_cursors_lock = threading.Lock()
+        self.last_transfer_stats = None
+        self.replication_factor = 1
+        self.replication_sync = False
+        self.replica_set = [] # Ids of the nodes holding replicas of this node's keys
+        self.replicas = {} # Owner node id -> storage with the replicas of its keys
+        self.routing_stats = {"routes": 0, "hops": 0}
+        self.routing_stats_lock = threading.Lock()
+        self.metrics = Metrics(metrics)
+        self.stabilize_scheduler = AdaptiveScheduler("stabilize")
+        self.fix_fingers_scheduler = AdaptiveScheduler("fix_fingers")
+        self.fix_fingers_batch = 8
+        self.next_finger = 2
+        self.observed_neighbours = None
+        self.join_started = None
+        self.join_task = None # Future of the last part of a join without stabilization
+        self.membership_stats = {} # Latency of the join and leave and the fingers copied or looked up at join
 
-    @method_logger
+    @instrumented
     def lookup(self, key):
         """
         Returns the value associated with the key 
         """
         key = self.hash(key)
-        if self.in_between(key, self.sum_id(self.predecessor, 1), self.sum_id(self.id, 1)):
-            return self.values[key]
+        if self.is_owner(key):
+            return self.storage[key]
+        found, value = self.replica_value(key)
+        if found:
+            return value
+        if self.read_cache.enabled:
+            found, value, _ = self.read_cache.get(key)
+            if not found:
+                value, lease = self.lookup_lease(key, self.id)
+                self.read_cache.put(key, value, lease)
+            return value
+        if self.routing == "recursive":
+            try:
+                return self.route_request("lookup", key)
+            except FutureTimeoutError:
+                log.info(f"Recursive lookup of {key} timed out, routing iteratively")
         successor_id = self.find_successor(key)
+        if successor_id == self.id:
+            # The predecessor isn't known yet, like after it failed or while joining
+            return self.storage[key]
         successor = self.get_node_proxy(successor_id)
         return successor.lookup(key)
     
-    @method_logger
+    @instrumented
     def insert(self, value, key:int=None):
         """
         Insert value into the DHT. If key is given then it will be inserted with it.
         """
         if key == None:
             key = self.hash(value)
+        if self.is_owner(key):
+            self.store_local({key: value})
+            return
+        self.read_cache.invalidate([key])
+        if self.routing == "recursive":
+            try:
+                return self.route_request("insert", key, value)
+            except FutureTimeoutError:
+                log.info(f"Recursive insert of {key} timed out, routing iteratively")
         successor_id = self.find_successor(key)
         if successor_id == self.id:
-            self.values[key] = value
+            self.store_local({key: value})
         else:
             successor = self.get_node_proxy(successor_id)
             successor.insert(value, key)
     
+    @instrumented
+    def lookup_many(self, keys:list):
+        """
+        Returns the values associated with keys, sending one batched call per owner node.  
+        Returns {"values": {key: value}, "errors": {key: error message}}
+        """
+        key_ids = {}
+        for key, key_id in zip(keys, self.hasher.hash_many(keys)):
+            key_ids.setdefault(key_id, []).append(key)
+        
+        values, errors = {}, {}
+        get = lambda node, owner_key_ids: node.get_values(owner_key_ids)
+        for owner_id, owner_key_ids, result in self._call_owners(list(key_ids), get):
+            if isinstance(result, Exception):
+                result = {"values": {}, "errors": {x: str(result) for x in owner_key_ids}}
+            for key_id, value in result["values"].items():
+                for key in key_ids[key_id]:
+                    values[key] = value
+            for key_id, error in result["errors"].items():
+                for key in key_ids[key_id]:
+                    errors[key] = error
+        return {"values": values, "errors": errors}
+    
+    @instrumented
+    def insert_many(self, items:list):
+        """
+        Insert many values into the DHT, sending one batched call per owner node.  
+        items: list of (value, key) pairs, key can be None to hash the value.  
+        Returns {"keys": [keys of the items in order], "errors": {key: error message}}
+        """
+        items = list(items)
+        hashed_keys = iter(self.hasher.hash_many([value for value, key in items if key == None]))
+        keys = []
+        new_values = {}
+        for value, key in items:
+            if key == None:
+                key = next(hashed_keys)
+            keys.append(key)
+            new_values[key] = value
+        
+        errors = {}
+        store = lambda node, owner_key_ids: node.store_values({x: new_values[x] for x in owner_key_ids})
+        for owner_id, owner_key_ids, result in self._call_owners(list(new_values), store):
+            if isinstance(result, Exception):
+                result = {x: str(result) for x in owner_key_ids}
+            errors.update(result)
+        return {"keys": keys, "errors": errors}
+    
+    @instrumented
+    def get_values(self, key_ids:list):
+        """
+        Returns the values of the already hashed key_ids.  
+        Keys owned by other nodes are looked up through the DHT.  
+        Returns {"values": {key: value}, "errors": {key: error message}}
+        """
+        values, errors = {}, {}
+        for key in key_ids:
+            try:
+                if self.is_owner(key):
+                    values[key] = self.storage[key]
+                else:
+                    values[key] = self.lookup(key)
+            except Exception as exc:
+                errors[key] = str(exc)
+        return {"values": values, "errors": errors}
+    
+    @instrumented
+    def store_values(self, new_values:dict):
+        """
+        Stores the already hashed keys of new_values.  
+        Keys owned by other nodes are inserted through the DHT.  
+        Returns {key: error message} with the failed keys
+        """
+        errors = {}
+        owned_values = {}
+        self.read_cache.invalidate(list(new_values))
+        for key, value in new_values.items():
+            try:
+                if self.is_owner(key):
+                    owned_values[key] = value
+                else:
+                    self.insert(value, key)
+            except Exception as exc:
+                errors[key] = str(exc)
+        self.store_local(owned_values)
+        return errors
+    
+    def group_by_owner(self, key_ids:list):
+        """
+        Groups key_ids by the id of the node that owns them, with one route per owner.  
+        Returns {owner_id: [key ids]}
+        """
+        groups = {}
+        pending = sorted(set(key_ids))
+        while pending:
+            pred_id, owner_id = self.find_route(pending[0])
+            lower, upper = self.sum_id(pred_id, 1), self.sum_id(owner_id, 1)
+            owned = [pending[0]] + [x for x in pending[1:] if self.in_between(x, lower, upper)]
+            groups.setdefault(owner_id, []).extend(owned)
+            owned = set(owned)
+            pending = [x for x in pending if x not in owned]
+        return groups
+    
+    def _call_owners(self, key_ids:list, call):
+        """
+        Calls call(owner_node, owner_key_ids) for every owner of key_ids in parallel.  
+        Returns a list of (owner_id, owner_key_ids, result or raised exception)
+        """
+        def owner_call(owner_id, owner_key_ids):
+            return call(self.get_node_proxy(owner_id), owner_key_ids)
+        
+        groups = self.group_by_owner(key_ids)
+        futures = []
+        for owner_id, owner_key_ids in groups.items():
+            if owner_id == self.id:
+                future = Future()
+                try:
+                    future.set_result(owner_call(owner_id, owner_key_ids))
+                except Exception as exc:
+                    future.set_exception(exc)
+            else:
+                future = self.executor.submit(owner_call, owner_id, owner_key_ids)
+            futures.append((owner_id, owner_key_ids, future))
+        
+        results = []
+        for owner_id, owner_key_ids, future in futures:
+            try:
+                result = future.result()
+            except Exception as exc:
+                log.error(f"Batched call to node {owner_id} failed: {exc}")
+                result = exc
+            results.append((owner_id, owner_key_ids, result))
+        return results
+    
+    @instrumented
+    def lookup_lease(self, key:int, holder_id:int=None):
+        """
+        Returns (value, lease) of the already hashed key, the value can be cached for lease seconds.  
+        The owner invalidates the cache of holder_id if the key changes before the lease ends.
+        """
+        if self.is_owner(key):
+            return self.leased_value(key, holder_id)
+        if self.routing == "recursive":
+            try:
+                return self.route_request("lookup_lease", key, holder_id)
+            except FutureTimeoutError:
+                log.info(f"Recursive lookup of {key} timed out, routing iteratively")
+        successor_id = self.find_successor(key)
+        if successor_id == self.id:
+            return self.leased_value(key, holder_id)
+        return self.get_node_proxy(successor_id).lookup_lease(key, holder_id)
+    
+    def leased_value(self, key:int, holder_id:int=None):
+        """
+        Returns (value, lease) of a key stored in this node, replicas aren't leased
+        """
+        if key not in self.storage:
+            found, value = self.replica_value(key)
+            if found:
+                return value, 0
+        value = self.storage[key]
+        if holder_id != None and holder_id != self.id and self.cache_lease > 0:
+            self.leases.grant(key, holder_id, self.cache_lease)
+        return value, self.cache_lease
+    
+    def invalidate_leases(self, keys:list):
+        """
+        Invalidates keys in the caches holding a lease of them, in the executor
+        """
+        for holder_id, holder_keys in self.leases.take(keys).items():
+            self.executor.submit(self._invalidate_cache, holder_id, holder_keys)
+    
+    def _invalidate_cache(self, holder_id:int, keys:list):
+        try:
+            self.get_node_proxy(holder_id).invalidate_cache(keys)
+        except Exception as exc:
+            # The lease expires anyway
+            log.error(f"Can't invalidate the cache of node {holder_id}: {exc}")
+    
+    def invalidate_cache(self, keys:list):
+        """
+        Drops keys from the read cache, called by their owner when they change
+        """
+        self.read_cache.invalidate(keys)
+    
+    def get_cache_stats(self):
+        """
+        Returns the read cache counters and the amount of keys of this node leased to other caches
+        """
+        stats = self.read_cache.stats()
+        stats["leased_keys"] = len(self.leases)
+        return stats
+    
+    def scan(self, lower:int=0, upper:int=None, page_size:int=1000):
+        """
+        Yields the stored key values of the ring range [lower, upper], both included, in pages of up to 
+        page_size (key, value) pairs in ring order from lower, the whole ring by default.  
+        The owners are walked through their successors and only one page is fetched at a time. 
+        Keys moved by joins and leaves while scanning may be missed or repeated.
+        """
+        upper = self.max_nodes - 1 if upper == None else upper
+        position, after = lower, None
+        owner_id = self.find_successor(position)
+        failures = 0
+        while True:
+            try:
+                page = self.get_node_proxy(owner_id).scan_page(position, upper, after, page_size)
+            except (ValueError,) + self.transport.errors as exc:
+                # The owner changed or failed, find the owner of the rest of the range again
+                failures += 1
+                if failures > self.max_route_failures:
+                    raise
+                log.info(f"Scan of node {owner_id} failed, routing to {position}: {exc}")
+                owner_id = self.find_successor(position)
+                continue
+            failures = 0
+            if page["items"]:
+                yield page["items"]
+            after = page["next"]
+            if not page["done"]:
+                continue
+            if page["end"] == upper:
+                return
+            position, after = self.sum_id(page["end"], 1), None
+            owner_id = page["successor"]
+    
+    @instrumented
+    def scan_page(self, lower:int, upper:int, after:int=None, limit:int=1000):
+        """
+        Returns a page of up to limit stored key values of the ring range [lower, upper], both included, 
+        following the key after in ring order. Raise ValueError if this node doesn't own lower.  
+        Only the keys of this node are returned, the range is cut at the node id.  
+        Returns {"items": [(key, value)], "next": cursor for the next page, "done": if it's the last page 
+        of this node, "end": last id of the range served by this node, "successor": node serving the rest}
+        """
+        if not self.is_owner(lower):
+            raise ValueError(f"Node {self.id} doesn't own {lower}")
+        end = self.id if self.in_between(self.id, lower, self.sum_id(upper, 1)) else upper
+        items = self.storage.items_range(lower, self.sum_id(end, 1), after, limit)
+        return {
+            "items": items,
+            "next": items[-1][0] if items else after,
+            "done": len(items) < limit,
+            "end": end,
+            "successor": self.successor
+        }
+    
+    def store_local(self, items:dict):
+        """
+        Stores items owned by this node and replicates them
+        """
+        if items:
+            self.storage.update(items)
+            self.invalidate_leases(list(items))
+            self.call_replicas("store_replicas", items)
+    
+    def call_replicas(self, method:str, *args):
+        """
+        Calls method(self.id, *args) in the nodes of the replica set.  
+        Calls run in the executor unless replication_sync is set.
+        """
+        if self.replication_factor < 2:
+            return
+        for node_id in list(self.replica_set):
+            if self.replication_sync:
+                self._call_replica(node_id, method, *args)
+            else:
+                self.executor.submit(self._call_replica, node_id, method, *args)
+    
+    def _call_replica(self, node_id:int, method:str, *args):
+        try:
+            node = self.get_node_proxy(node_id)
+            getattr(node, method)(self.id, *args)
+        except Exception as exc:
+            log.error(f"Replica {node_id} failed {method}: {exc}")
+            if isinstance(exc, self.transport.errors):
+                self.discard_node_proxy(node_id)
+    
+    @instrumented
+    def store_replicas(self, owner_id:int, items:dict, reset:bool=False):
+        """
+        Stores replicas of the owner_id node's items. If reset the previous replicas of owner_id are dropped.
+        """
+        if reset or owner_id not in self.replicas:
+            self.replicas[owner_id] = MemoryStorage()
+        self.replicas[owner_id].update(items)
+    
+    def delete_replicas(self, owner_id:int, keys:list):
+        """
+        Removes replicas of the owner_id node's keys
+        """
+        replicas = self.replicas.get(owner_id)
+        if replicas is not None:
+            replicas.delete_keys(keys)
+    
+    def drop_replicas(self, owner_id:int):
+        """
+        Removes every replica of the owner_id node
+        """
+        self.replicas.pop(owner_id, None)
+    
+    def replica_value(self, key:int):
+        """
+        Returns (True, value) if there is a replica of key, (False, None) otherwise
+        """
+        for replicas in list(self.replicas.values()):
+            if key in replicas:
+                return True, replicas[key]
+        return False, None
+    
+    def promote_replicas(self):
+        """
+        Moves the replicas of keys this node is now responsible for into its storage, 
+        which happens when the previous owner failed.
+        """
+        if self.predecessor == None:
+            return
+        lower, upper = self.sum_id(self.predecessor, 1), self.sum_id(self.id, 1)
+        for owner_id, replicas in list(self.replicas.items()):
+            if owner_id == self.id:
+                continue
+            promoted = replicas.pop_range(lower, upper)
+            if promoted:
+                log.info(f"Promoted {len(promoted)} replicas of node {owner_id}")
+                self.store_local({x: y for x, y in promoted.items() if x not in self.storage})
+    
+    def repair_replicas(self):
+        """
+        Updates the replica set with the first replication_factor - 1 nodes of the successor list, skipping 
+        the virtual nodes of this process, which would fail together with this node.  
+        New replicas receive every key of this node and removed replicas drop them.
+        """
+        new_replica_set = [x for x in self.successor_list if x != self.id and x not in self.local_nodes][:self.replication_factor - 1]
+        if new_replica_set == self.replica_set:
+            return
+        if self.predecessor == None:
+            return
+        old_replica_set = self.replica_set
+        self.replica_set = new_replica_set
+        log.info(f"Replica set changed from {old_replica_set} to {new_replica_set}")
+        for node_id in [x for x in old_replica_set if x not in new_replica_set]:
+            self._call_replica(node_id, "drop_replicas")
+        lower, upper = self.sum_id(self.predecessor, 1), self.sum_id(self.id, 1)
+        for node_id in [x for x in new_replica_set if x not in old_replica_set]:
+            after, reset = None, True
+            while True:
+                items = self.storage.items_range(lower, upper, after, self.transfer_chunk_size)
+                if items or reset:
+                    self._call_replica(node_id, "store_replicas", dict(items), reset)
+                if len(items) < self.transfer_chunk_size:
+                    break
+                after, reset = items[-1][0], False
+    
     @method_logger
     def register_listener(self, listener):
         """
@@ -157,73 +1027,120 @@ class ChordNode:
         """
         Command Line Interface to talk with ChordNode
         """
-        command = None
-        help_msg="ft: print finger table\nid: print node id\nkeys: print local key:value\nsl: print successor list\nexit: shutdown chord node"
-        while True:
-            command = input()
-            if command == "ft":
-                print(self.finger_table)
-            elif command == "id":
-                print(self.id)
-            elif command == "keys":
-                print("\n".join([f"- {x}:{self.values[x]}" for x in self.values]))
-            elif command == "sl":
-                print(self.successor_list)
-            elif command == "exit":
-                self.leave()
-                break
-            else:
-                print("Invalid command:\n", help_msg)
+        while self.cli_command(input()):
+            pass
+    
+    def cli_command(self, command:str):
+        """
+        Runs a Command Line Interface command, returns False if the node left
+        """
+        help_msg="ft: print finger table\nid: print node id\nkeys: print local key:value\nsl: print successor list\nroutes: print routing hop counters\nreplicas: print replica set and replicated keys count\ntransfer: print last key transfer stats\nsched: print stabilization scheduler stats\nfd: print failure detector stats\ncache: print read cache stats\nload: print the load of the owned range\nstats: print node metrics\nmetrics on|off [SAMPLE_RATE]: switch metrics\nexit: shutdown chord node"
+        if command == "ft":
+            print(self.finger_table)
+        elif command == "id":
+            print(self.id)
+        elif command == "keys":
+            if self.predecessor != None:
+                print("\n".join([f"- {x}:{y}" for x, y in self.owned_items()]))
+        elif command == "sl":
+            print(self.successor_list)
+        elif command == "routes":
+            print(self.get_routing_stats())
+        elif command == "transfer":
+            print(self.last_transfer_stats)
+        elif command == "stats":
+            print(json.dumps(self.stats(), indent=2, default=str))
+        elif command.startswith("metrics "):
+            words = command.split()
+            self.configure_metrics(words[1] == "on", float(words[2]) if len(words) > 2 else None)
+        elif command == "sched":
+            print(self.get_scheduler_stats())
+        elif command == "cache":
+            print(self.get_cache_stats())
+        elif command == "load":
+            print(self.get_load())
+        elif command == "fd":
+            print(json.dumps(self.get_failure_detector_stats(), indent=2))
+        elif command == "replicas":
+            print(f"replica set: {self.replica_set}")
+            print("\n".join([f"- owner {x}: {len(y)} keys" for x, y in list(self.replicas.items())]))
+        elif command == "exit":
+            self.leave()
+            return False
+        else:
+            print("Invalid command:\n", help_msg)
+        return True
     
     @method_logger
     def leave(self):
         """
         Leave DHT table
         """
+        start = time.monotonic()
         try:
             # Update predecessor and successor and transfer the current keys
             successor_node = self.get_node_proxy(self.successor)
             predecessor_node = self.get_node_proxy(self.predecessor)
             successor_node.predecessor = self.predecessor
             predecessor_node.successor = self.successor
-            successor_node.update_values(self.values)
+            if self.successor not in self.local_nodes:
+                self.push_keys(self.successor, self.sum_id(self.predecessor, 1), self.id)
             if not self.stabilization:
-                successor_node.update_leaving_node(self.id, successor_node.id)
+                self.update_others_on_leave(self.successor)
             else:
                 # Stabilization works for itself
                 pass
         except Exception as exc:
             log.exception(exc)
+        self.membership_stats["leave_seconds"] = time.monotonic() - start
         
         try:
-            coordinator = create_object_proxy(self.coordinator_address, self.name_server_host, self.name_server_port)
-            coordinator.unregister(self.id)
+            self.get_coordinator_proxy().unregister(self.id)
         except Exception as exc:
             log.exception(exc)
-            
-        self.daemon.shutdown()
+        
+        self.local_nodes.pop(self.id, None)
+        self.ping_proxy_pool.clear()
+        if self.owns_transport:
+            self.proxy_pool.clear()
+            self.transport.shutdown()
     
-    def update_leaving_node(self, node_id, new_successor_id):
+    def update_others_on_leave(self, successor_id:int):
         """
-        Update finger table having node_id with successor_id
+        Replace this node by successor_id in the finger tables pointing to it, the reverse of update_others
         """
-        for i in range(1, self.bits + 1):
-            finger_table_entry = self.finger_table[i]
-            if finger_table_entry.successor == node_id:
-                finger_table_entry.successor = new_successor_id
-            elif self.in_between(finger_table_entry.successor, self.id, node_id):
-                successor_id = self.find_successor(finger_table_entry.successor)
-                successor_node = self.get_node_proxy(successor_id)
-                successor_node.update_leaving_node(node_id, new_successor_id)
+        def replace(pred_node, i):
+            pred_node.replace_finger(self.id, successor_id, i)
+        self.call_finger_owners(replace)
     
-    @method_logger
+    @instrumented
+    def replace_finger(self, node_id:int, new_successor_id:int, i:int):
+        """
+        Replaces the leaving node_id by new_successor_id at finger i, and in the predecessor if it also points to node_id
+        """
+        if self.finger_table.successors[i] != node_id:
+            return
+        self.finger_table.set(i, new_successor_id)
+        if self.predecessor not in (None, node_id):
+            self.get_node_proxy(self.predecessor).replace_finger(node_id, new_successor_id, i)
+    
+    @instrumented
     def update_values(self, new_values:dict):
         """
-        Update the values dictionary with new_values
+        Update the storage with the new_values this node is responsible for.  
+        Returns the stored keys
+        """
+        lower, upper = self.sum_id(self.predecessor, 1), self.sum_id(self.id, 1)
+        owned_values = {x: y for x, y in new_values.items() if self.in_between(x, lower, upper)}
+        self.store_local(owned_values)
+        return list(owned_values)
+    
+    def owned_items(self):
+        """
+        Returns the (key, value) pairs this node is responsible for, in ring order
         """
-        for x in new_values:
-            if self.in_between(x, self.sum_id(self.predecessor, 1), self.sum_id(self.id, 1)):
-                self.values[x] = new_values[x]
+        lower, upper = self.sum_id(self.predecessor, 1), self.sum_id(self.id, 1)
+        return [(x, self.storage[x]) for x in self.storage.keys_range(lower, upper)]
         
     @method_logger
     def start(self, coordinator_address):
@@ -235,86 +1152,375 @@ class ChordNode:
         
         self.executor.submit(self.cli_loop)
         
-        with pyro.Daemon(self.host, self.port) as daemon:
-            self.daemon = daemon
-            
-            # Setting up node
-            coordinator = create_object_proxy(coordinator_address, self.name_server_host, self.name_server_port)
-            self.coordinator_address = coordinator_address
-            self.bits = coordinator.bits
-            self.max_nodes = 1 << self.bits
-            self.max_successor_list_count = self.bits
-            
-            # Getting initial node
-            initial_node_id = coordinator.get_initial_node()
-            if initial_node_id != None:
-                initial_node = self.get_node_proxy(initial_node_id)
-            else:
-                initial_node = None
-            
-            # Register node in pyro name server and deamon
-            self.dir = daemon.register(self)
-            self.id = self.hash(self.dir)
-            with pyro.locateNS(self.name_server_host, self.name_server_port) as ns:
-                ns.register(ChordNode.node_name(self.id), self.dir)
-            
-            # Joining DHT
-            self.join(initial_node)
-
-            daemon.requestLoop()
-            self.daemon = None
+        if self.transport is None:
+            self.transport = ChordNode.create_transport(coordinator_address, self.host, self.port, self.name_server_host, self.name_server_port, self.call_timeout)
+        self.transport.start()
+        try:
+            self.setup(coordinator_address)
+            self.transport.run()
+        finally:
+            self.transport.close()
         
         self.running = False
     
+    @staticmethod
+    def create_transport(coordinator_address, host, port, name_server_host, name_server_port, timeout=None):
+        """
+        Creates the transport used by the DHT of the coordinator, which is always reached through Pyro
+        """
+        coordinator = create_object_proxy(coordinator_address, name_server_host, name_server_port)
+        coordinator._pyroTimeout = timeout
+        return create_transport(coordinator.transport, host, port, name_server_host, name_server_port, timeout)
+    
+    @method_logger
+    def setup(self, coordinator_address):
+        """
+        Register the node in the transport, the name server and the coordinator and join the DHT
+        """
+        # Setting up node
+        self.coordinator_address = coordinator_address
+        coordinator = self.get_coordinator_proxy()
+        self.configure(coordinator)
+        
+        # Getting initial node
+        initial_node = self.choose_initial_node(coordinator.get_bootstrap_nodes(self.bootstrap_count))
+        
+        # Serve the node and publish it in the name server
+        self.dir = self.transport.register(self)
+        if self.id == None and self.placement == "load" and initial_node != None:
+            self.id = self.choose_load_id()
+        if self.id == None:
+            self.id = self.hash(self.dir)
+        self.local_nodes[self.id] = self
+        self.transport.publish(ChordNode.node_name(self.id), self.dir)
+        
+        # Joining DHT
+        self.join(initial_node)
+    
+    def choose_initial_node(self, bootstrap_nodes:dict):
+        """
+        Returns a proxy of the first node of bootstrap_nodes that answers, None if none does
+        """
+        for node_id in bootstrap_nodes:
+            node_id = int(node_id)
+            node = self.get_node_proxy(node_id)
+            try:
+                node.id
+                return node
+            except self.transport.errors:
+                log.info(f"Bootstrap node {node_id} offline")
+                self.discard_node_proxy(node_id)
+        return None
+    
+    def choose_load_id(self):
+        """
+        Returns the id splitting the most loaded range of placement_samples random nodes, the one with 
+        more keys or the largest one if they have the same keys. The node joining with that id takes 
+        the keys of the first half of the range.  
+        The id is reserved in the coordinator so concurrent joins don't choose it too. If it's taken the 
+        middles of the halves of the range are tried, then the next loaded ranges. None if no id is free.
+        """
+        coordinator = self.get_coordinator_proxy()
+        sample = coordinator.get_bootstrap_nodes(self.placement_samples)
+        
+        def load(node_id):
+            try:
+                return self.get_node_proxy(int(node_id)).get_load()
+            except self.transport.errors:
+                log.info(f"Node {node_id} didn't report its load")
+                return None
+        
+        loads = [x for x in self.executor.map(load, sample) if x != None and x["split"] != None]
+        known_ids = {int(x) for x in sample} | set(self.local_nodes)
+        for node_load in sorted(loads, key=lambda x: (x["keys"], x["arc"]), reverse=True):
+            node_id, split = node_load["id"], node_load["split"]
+            predecessor = self.sub_id(node_id, node_load["arc"])
+            candidates = [split, self.sum_id(split, self.sub_id(node_id, split) // 2), self.sum_id(predecessor, self.sub_id(split, predecessor) // 2)]
+            for candidate in dict.fromkeys(candidates):
+                if candidate in known_ids or not self.in_between(candidate, self.sum_id(predecessor, 1), node_id, equals=False):
+                    continue
+                if coordinator.reserve_id(candidate):
+                    log.info(f"Splitting the range of node {node_id} with {node_load['keys']} keys at {candidate}")
+                    return candidate
+        return None
+    
+    def get_load(self):
+        """
+        Returns the load of the range owned by this node, (predecessor, id]:  
+        {"id": node id, "keys": stored keys, "arc": ids in the range, "split": id splitting the range}.  
+        A node with id split would take half of the keys, or half of the arc if there are no keys. 
+        split is None if the range can't be split.
+        """
+        predecessor = self.predecessor
+        if predecessor == None:
+            return {"id": self.id, "keys": 0, "arc": 0, "split": None}
+        lower = self.sum_id(predecessor, 1)
+        arc = self.sub_id(self.id, predecessor) or self.max_nodes
+        # The node id itself can't be a split point
+        split = self.storage.median_key(lower, self.id)
+        if split == None and arc > 1:
+            split = self.sum_id(predecessor, arc // 2)
+        return {"id": self.id, "keys": self.storage.count_range(lower, self.sum_id(self.id, 1)), "arc": arc, "split": split}
+    
+    def configure(self, coordinator):
+        """
+        Takes the ring settings from the coordinator
+        """
+        self.bits = coordinator.bits
+        self.max_nodes = 1 << self.bits
+        self.hasher = KeyHasher(self.bits, coordinator.hash_algorithm)
+        self.replication_factor = coordinator.replication_factor
+        self.replication_sync = coordinator.replication_sync
+        self.max_successor_list_count = max(self.bits, self.replication_factor)
+    
+    def is_owner(self, key:int):
+        """
+        Checks if this node is responsible for key, the key is in (predecessor, id]
+        """
+        predecessor = self.predecessor
+        return predecessor != None and self.in_between(key, self.sum_id(predecessor, 1), self.sum_id(self.id, 1))
+    
     def in_between(self, key, lwb, upb, equals=True):
         """
         Checks if key is between lwb and upb with modulus 2**bits
         """
         if lwb == upb:
             return equals
-        elif lwb < upb:                   
-            return lwb <= key and key < upb
-        else:                             
-            return (lwb <= key and key < upb + self.max_nodes) or (lwb <= key + self.max_nodes and key < upb)                    
+        # Distance from lwb to key is smaller than to upb, both modulo 2**bits
+        return (key - lwb) % self.max_nodes < (upb - lwb) % self.max_nodes
    
-    @method_logger
+    @instrumented
     def find_successor(self, key):
         """
         Finds and returns the node's id for key successor
         """
-        pred_id = self.find_predecessor(key)
-        pred_node = self.get_node_proxy(pred_id)
-        return pred_node.successor
+        return self.find_route(key)[1]
     
-    @method_logger
+    @instrumented
     def find_predecessor(self, key):
         """
         Finds and returns the node's id for key predecessor
         """
-        current = self
-        
-        while not (self.in_between(key, self.sum_id(current.id, 1), self.sum_id(current.successor, 1))):
-            current_id = current.closest_preceding_finger(key)
-            current = self.get_node_proxy(current_id)
-            log.info(f"find_predecessor cycle: key:{key} current_id:{current.id}, current_successor:{current.successor}")
-        return current.id
+        return self.find_route(key)[0]
     
-    def closest_preceding_finger(self, key):
+    def find_route(self, key):
         """
-        Return the closest preceding finger node's id from key
+        Finds the key predecessor and successor ids with one route_step call per hop.  
+        Suspected nodes are skipped without calling them. When a hop is suspected or fails the route 
+        starts again from this node excluding it, up to max_route_failures times.  
+        Returns (predecessor_id, successor_id)
         """
-        for i in range(self.bits,0,-1):
-            if self.finger_table[i].successor != None and self.in_between(self.finger_table[i].successor, self.sum_id(self.id, 1), key):
-                return self.finger_table[i].successor
-        return self.id
+        excluded = set()
+        found, current_id, successor_id = self.route_step(key)
+        hops = 0
+        while not found:
+            try:
+                if current_id in self.failure_detector:
+                    raise self.transport.errors[0](f"Node {current_id} is suspected")
+                found, current_id, successor_id = self.get_node_proxy(current_id).route_step(key, list(excluded) or None)
+            except self.transport.errors:
+                # Stale routing state, refresh it sooner
+                self.stabilize_scheduler.tighten()
+                self.fix_fingers_scheduler.tighten()
+                if current_id not in self.failure_detector:
+                    self.discard_node_proxy(current_id)
+                excluded.add(current_id)
+                if len(excluded) > self.max_route_failures:
+                    raise
+                found, current_id, successor_id = self.route_step(key, excluded)
+            hops += 1
+            log.debug("find_route cycle: key:%s current_id:%s, current_successor:%s", key, current_id, successor_id)
+        with self.routing_stats_lock:
+            self.routing_stats["routes"] += 1
+            self.routing_stats["hops"] += hops
+        self.metrics.observe("route_hops", hops)
+        return current_id, successor_id
+    
+    def route_request(self, method:str, key:int, *args):
+        """
+        Runs the lookup or insert method for key in its owner with recursive routing and returns its result.  
+        Raises TimeoutError if the owner doesn't reply in recursive_timeout seconds.
+        """
+        request_id = next(self.request_ids)
+        future = Future()
+        self.pending_requests[request_id] = future
+        try:
+            self.forward_request(self.id, request_id, method, key, args, 0, [], False)
+            hops, result = future.result(self.recursive_timeout)
+        finally:
+            self.pending_requests.pop(request_id, None)
+        with self.routing_stats_lock:
+            self.routing_stats["routes"] += 1
+            self.routing_stats["hops"] += hops
+        self.metrics.observe("route_hops", hops)
+        return result
+    
+    @instrumented
+    def forward_request(self, origin_id:int, request_id:int, method:str, key:int, args:list, hops:int, visited:list, final:bool):
+        """
+        Recursive routing of a request started by the origin_id node.  
+        The request is forwarded to the closest preceding finger of key, or run here if final, and 
+        the result is delivered to the origin. The work is done in the executor, so the caller 
+        doesn't wait for the rest of the route.
+        """
+        self.executor.submit(self._forward_request, origin_id, request_id, method, key, args, hops, visited, final)
+    
+    def _forward_request(self, origin_id, request_id, method, key, args, hops, visited, final):
+        try:
+            if hops > (self.max_hops or 2 * self.bits):
+                raise RuntimeError(f"Request for key {key} exceeded {hops - 1} hops")
+            if self.id in visited:
+                raise RuntimeError(f"Request for key {key} looped through node {self.id}")
+            cached = False
+            if self.read_cache.enabled and method in ("lookup", "lookup_lease"):
+                cached, value, lease_left = self.read_cache.get(key)
+            if cached:
+                # Hot key answered by this routing node, the origin can cache it for the rest of the lease
+                result = value if method == "lookup" else (value, lease_left)
+            elif final or self.is_owner(key):
+                result = self.serve_request(method, key, args)
+            else:
+                # The next hop only acknowledges the request, failed hops are skipped like in find_route
+                excluded = set()
+                while True:
+                    found, next_id, successor_id = self.route_step(key, excluded)
+                    next_id = successor_id if found else next_id
+                    try:
+                        if next_id == self.id:
+                            result = self.serve_request(method, key, args)
+                        else:
+                            self.get_node_proxy(next_id).forward_request(origin_id, request_id, method, key, args, hops + 1, visited + [self.id], found)
+                            return
+                        break
+                    except self.transport.errors:
+                        self.discard_node_proxy(next_id)
+                        excluded.add(next_id)
+                        if len(excluded) > self.max_route_failures:
+                            raise
+            self._deliver(origin_id, request_id, hops, result, None)
+        except Exception as exc:
+            self._deliver(origin_id, request_id, hops, None, (type(exc).__name__, str(exc)))
+    
+    def serve_request(self, method:str, key:int, args:list):
+        """
+        Runs a recursive request in the node that owns key
+        """
+        if method == "lookup":
+            if key in self.storage:
+                return self.storage[key]
+            found, value = self.replica_value(key)
+            if found:
+                return value
+            return self.storage[key]
+        if method == "lookup_lease":
+            return self.leased_value(key, args[0])
+        if method == "insert":
+            self.store_local({key: args[0]})
+            return None
+        raise ValueError(f"Unknown request method {method}")
+    
+    def _deliver(self, origin_id, request_id, hops, result, error):
+        try:
+            if origin_id == self.id:
+                self.deliver(request_id, hops, result, error)
+            else:
+                self.get_node_proxy(origin_id).deliver(request_id, hops, result, error)
+        except Exception as exc:
+            log.error(f"Can't deliver request {request_id} to node {origin_id}: {exc}")
+    
+    def deliver(self, request_id:int, hops:int, result, error):
+        """
+        Receives the result of a recursive request started in this node.  
+        error is (exception name, message) if the request failed.
+        """
+        future = self.pending_requests.get(request_id)
+        if future is None or future.done():
+            return
+        if error:
+            future.set_exception(remote_exception(*error))
+        else:
+            future.set_result((hops, result))
+    
+    @instrumented
+    def route_step(self, key, excluded=None):
+        """
+        Single routing step for key.  
+        Returns (True, self.id, successor) if key is in (self.id, successor], otherwise 
+        (False, closest_preceding_finger, None). If no finger precedes key the successor is the best known answer.  
+        Suspected nodes and the excluded node ids are skipped, a skipped successor is replaced by the 
+        next one of the successor list, and successor list entries closer to key than the fingers are used.
+        """
+        excluded = set(excluded) | self.failure_detector.suspects() if excluded else self.failure_detector
+        successor = self.successor
+        if successor in excluded:
+            listed_id = self.successor_list.first(excluded)
+            successor = successor if listed_id is None else listed_id
+        if self.in_between(key, self.sum_id(self.id, 1), self.sum_id(successor, 1)):
+            return True, self.id, successor
+        next_id = self.finger_table.closest_preceding(key, excluded)
+        listed_id = self.successor_list.closest_preceding(key, excluded)
+        if self.sub_id(listed_id, self.id) > self.sub_id(next_id, self.id):
+            next_id = listed_id
+        if next_id == self.id:
+            return True, self.id, successor
+        return False, next_id, None
+    
+    def stats(self):
+        """
+        Returns the node metrics, routing, scheduling, storage and transfer stats
+        """
+        return {
+            "id": self.id,
+            "metrics": self.metrics.snapshot(),
+            "routing": self.get_routing_stats(),
+            "scheduler": self.get_scheduler_stats(),
+            "stored_keys": len(self.storage),
+            "replicated_keys": sum(len(x) for x in list(self.replicas.values())),
+            "last_transfer": self.last_transfer_stats,
+            "membership": self.membership_stats,
+            "cache": self.get_cache_stats(),
+            "failure_detector": self.get_failure_detector_stats()
+        }
+    
+    def configure_metrics(self, enabled:bool=None, sample_rate:float=None):
+        """
+        Switch the node metrics on or off and change the latency sample rate
+        """
+        self.metrics.configure(enabled, sample_rate)
+    
+    def get_scheduler_stats(self):
+        """
+        Returns the intervals and convergence metrics of the stabilization schedulers
+        """
+        return {x.name: x.stats() for x in [self.stabilize_scheduler, self.fix_fingers_scheduler]}
+    
+    def get_failure_detector_stats(self):
+        """
+        Returns the mode, suspected nodes and phi of the monitored nodes of the failure detector
+        """
+        return self.failure_detector.stats()
+    
+    def get_routing_stats(self):
+        """
+        Returns the amount of routed keys, remote hops and the mean of hops per route
+        """
+        with self.routing_stats_lock:
+            stats = dict(self.routing_stats)
+        stats["mean_hops"] = stats["hops"] / stats["routes"] if stats["routes"] else 0
+        return stats
+    
+    def closest_preceding_finger(self, key, excluded=None):
+        """
+        Return the closest preceding finger node's id from key, skipping the excluded ids
+        """
+        return self.finger_table.closest_preceding(key, excluded)
     
     @method_logger
     def register(self):
         """
         Register current node in DHT coordinator
         """
-        coordinator = create_object_proxy(ChordCoordinator.ADDRESS, self.name_server_host, self.name_server_port)
-        coordinator.register(self.id, self.dir)
+        self.get_coordinator_proxy().register(self.id, self.dir)
             
     @method_logger
     def join(self, initial_node):
@@ -323,125 +1529,253 @@ class ChordNode:
         If initial_node is None then the current node is the first in the DHT 
         """
 
+        self.join_started = time.monotonic()
         self.register()
         
+        self.successor_list = SuccessorList(self.id, self.bits, self.max_successor_list_count)
         if initial_node is None:
             # All finger_table entries are self
-            self.finger_table = [FingerTableEntry(self.id, i, self.bits, self.id) for i in range(self.bits+1)]
+            self.finger_table = FingerTable(self.id, self.bits, self.id)
         else:
             # All finger_table entries are None
-            self.finger_table = [FingerTableEntry(self.id, i, self.bits, None) for i in range(self.bits+1)]
+            self.finger_table = FingerTable(self.id, self.bits, None)
             
         if not self.stabilization and initial_node != None:
             # Full finger table initialization, doesn't do stabilization
             self.init_finger_table(initial_node)
-            self.executor.submit(self.init_node_last_part) # Let the current node accept RPC from now on
-        elif self.stabilization:
-            # More loose table initialization complemented with periodic calls to maintain the table
-            if initial_node != None:
-                self.successor = initial_node.find_successor(self.id)
+            self.join_task = self.executor.submit(self.init_node_last_part) # Let the current node accept RPC from now on
+        else:
+            if self.stabilization:
+                # More loose table initialization complemented with periodic calls to maintain the table
+                if initial_node != None:
+                    self.successor = initial_node.find_successor(self.id)
+            self.membership_stats["join_seconds"] = time.monotonic() - self.join_started
+        if self.stabilization:
             self.executor.submit(self.stabilize_loop)
             self.executor.submit(self.fix_fingers_loop)
+        self.executor.submit(self.failure_detector_loop)
+    
+    def ping(self):
+        """
+        Heartbeat of the failure detectors, returns the node id
+        """
+        return self.id
+    
+    def ping_neighbours(self, timeout:float=None):
+        """
+        Ping in parallel the predecessor, successor list and fingers in the executor. Each ping records its 
+        heartbeat or failure in the failure detector when it ends, and fails after ping_timeout seconds. 
+        Neighbours whose last ping didn't end yet aren't pinged again.  
+        Waits up to timeout seconds for the pings, forever if None, and returns the amount of failed pings by then.
+        """
+        targets = {self.predecessor, *self.successor_list, *self.finger_table.distinct_successors()}
+        targets -= {self.id, None}
+        for node_id in self.failure_detector.monitored() - targets:
+            self.failure_detector.forget(node_id)
+        
+        def ping(node_id):
+            try:
+                node = self.local_nodes.get(node_id)
+                (self.ping_proxy_pool.get(node_id) if node is None else node).ping()
+                self.failure_detector.heartbeat(node_id)
+                return False
+            except self.transport.errors:
+                self.ping_proxy_pool.discard(node_id)
+                self.discard_node_proxy(node_id)
+                return True
+            finally:
+                with self.pings_lock:
+                    self.pings_in_flight.discard(node_id)
+        
+        with self.pings_lock:
+            targets -= self.pings_in_flight
+            self.pings_in_flight |= targets
+        futures = [self.executor.submit(ping, x) for x in targets]
+        if timeout == 0:
+            return 0
+        done, _ = wait(futures, timeout)
+        return sum(x.result() for x in done)
+    
+    def failure_detector_loop(self):
+        """
+        Pings the neighbours each ping_interval seconds without waiting for the answers
+        """
+        while self.running:
+            try:
+                self.ping_neighbours(0)
+            except Exception as exc:
+                log.error(f"Failure detector error: {exc}")
+            time.sleep(self.ping_interval)
     
     @method_logger
     def stabilize_loop(self):
         """
-        Periodically calls stabilize method
+        Periodically calls stabilize method, with the interval of stabilize_scheduler
+        """
+        self.run_scheduled(self.stabilize, self.stabilize_scheduler)
+    
+    def run_scheduled(self, task, scheduler):
+        """
+        Runs task while the node is running, waiting the scheduler interval between calls.  
+        task returns if it changed the node state.
         """
-        interval_milliseconds = 2000
         while self.running:
             try:
-                self.stabilize()
+                scheduler.report(task())
             except Exception as exc:
                 log.exception(exc)
-            time.sleep(interval_milliseconds/1000)
+                scheduler.report_failure()
+            scheduler.wait()
     
-    @method_logger
+    @instrumented
     def stabilize(self):
         """
-        Verifies current node's immediate successor and notifies it about current node's existence
+        Verifies current node's immediate successor and notifies it about current node's existence.  
+        Returns if the node's neighbours, keys or replicas changed since the last call.
         """
+        replica_set = self.replica_set
+        old_successor_node = None
+        # Alone or isolated after a failed join, the ring is looked for again
+        isolated = self.successor == self.id and self.predecessor in (None, self.id)
+        if self.successor in self.failure_detector:
+            log.info(f"Successor {self.successor} suspected")
+        elif not isolated:
+            try:
+                old_successor_id = self.find_successor(self.successor)
+                successor_node = self.get_node_proxy(old_successor_id)
+                pred_old_successor_id = successor_node.predecessor
+                if pred_old_successor_id != None and self.in_between(pred_old_successor_id, self.sum_id(self.id, 1), self.successor, equals=False):
+                    self.successor = pred_old_successor_id
+                old_successor_node, notified_id = successor_node, old_successor_id
+            except self.transport.errors as exc:
+                log.error(f"{exc}")
+                self.discard_node_proxy(self.successor)
+        if old_successor_node is None:
+            # Fail over to the closest successor not suspected, probing only if there is none
+            successor_id = self.successor_list.first(self.failure_detector)
+            if successor_id is None:
+                successor_id = self.search_posible_successor().id
+            self.successor = successor_id
+            old_successor_node, notified_id = self.get_node_proxy(successor_id), successor_id
         try:
-            old_successor_id = self.find_successor(self.successor)
-            old_successor_node = self.get_node_proxy(old_successor_id)
-            pred_old_successor_id = old_successor_node.predecessor
-            if pred_old_successor_id != None and self.in_between(pred_old_successor_id, self.sum_id(self.id, 1), self.successor, equals=False):
-                self.successor = pred_old_successor_id
-        except pyro.errors.CommunicationError as exc:
-            log.error(f"{exc}")
-            new_successor = self.search_posible_successor()
-            self.successor = new_successor.id
-            old_successor_node = new_successor
-        old_successor_node.notify(self.id)
-        self.transfer_keys()
+            successors = old_successor_node.notify(self.id)
+        except self.transport.errors:
+            self.discard_node_proxy(notified_id)
+            raise
+        if self.successor != self.id:
+            self.successor_list.update([self.successor, notified_id] + successors, self.failure_detector)
+        moved_keys = self.transfer_keys()
+        if self.replication_factor > 1:
+            self.promote_replicas()
+            self.repair_replicas()
         
+        neighbours = (self.predecessor, self.successor)
+        changed = neighbours != self.observed_neighbours or bool(moved_keys) or replica_set != self.replica_set
+        self.observed_neighbours = neighbours
+        return changed
+
         
-    @method_logger
+    @instrumented
     def notify(self, node_id):
         """
-        Verifies if node_id is a better predecessor, if it is then the predecessor is updated. 
+        Verifies if node_id is a better predecessor, if it is then the predecessor is updated.  
+        Returns the successor list so the caller can copy it.
         """
         if self.predecessor != None:
             try:
                 predecessor_node = self.get_node_proxy(self.predecessor)
                 predecessor_node.id
-            except pyro.errors.CommunicationError as e:
+            except self.transport.errors:
                 log.info(f"Predecessor {self.predecessor} offline")
+                self.discard_node_proxy(self.predecessor)
                 self.predecessor = None
 
         if self.predecessor == None or self.in_between(node_id, self.sum_id(self.predecessor, 1), self.id):
+            if node_id != self.predecessor:
+                # Churn near this node
+                self.stabilize_scheduler.tighten()
             self.predecessor = node_id
             predecessor_node = self.get_node_proxy(node_id)
             predecessor_node.transfer_keys()
+        return self.successor_list.ids()
     
     @method_logger
     def fix_fingers_loop(self):
         """
-        Periodically calls fix_fingers method
+        Periodically calls fix_fingers method, with the interval of fix_fingers_scheduler
         """
-        interval_milliseconds = 2000
-        while self.running:
-            try:
-                self.fix_fingers()
-            except Exception as exc:
-                log.exception(exc)
-            time.sleep(interval_milliseconds/1000)
+        self.run_scheduled(self.fix_fingers, self.fix_fingers_scheduler)
     
-    @method_logger
+    @instrumented
     def fix_fingers(self):
         """
-        Randomly updates a finger table's entry
+        Updates the next fix_fingers_batch entries of the finger table, walking it in order.  
+        An entry whose start is between the previous entry start and successor has the same successor, 
+        so it's updated without routing.  
+        Returns if any entry changed.
         """
         if self.bits < 2:
-            return
-        update_index = random.randint(2, self.bits)
-        finger_table_entry = self.finger_table[update_index]
-        finger_table_entry.successor = self.find_successor(finger_table_entry.start)
+            return False
+        changed = False
+        starts, successors = self.finger_table.starts, self.finger_table.successors
+        for _ in range(min(self.fix_fingers_batch, self.bits - 1)):
+            index = self.next_finger
+            self.next_finger = index + 1 if index < self.bits else 2
+            previous = successors[index - 1]
+            if previous != None and self.in_between(starts[index], starts[index - 1], self.sum_id(previous, 1)):
+                successor = previous
+            else:
+                successor = self.find_successor(starts[index])
+            changed = changed or successor != successors[index]
+            self.finger_table.set(index, successor)
+        return changed
     
     @method_logger
     def init_finger_table(self, initial_node):
         """
-        Fill the node's finger_table using initial_node.
+        Fill the node's finger_table using initial_node.  
+        The successor's finger table is copied as hint: its finger j is the first node from its start j, 
+        so it's also the successor of every start in [start j, finger j]. Only the other starts are 
+        looked up, concurrently in the executor.
         """
-        self.finger_table = [FingerTableEntry(self.id, i, self.bits, None) for i in range(self.bits+1)]
+        self.finger_table = FingerTable(self.id, self.bits, None)
+        starts = self.finger_table.starts
         
-        self.successor = initial_node.find_successor(self.finger_table[1].start)
+        self.successor = initial_node.find_successor(starts[1])
         successor_node = self.get_node_proxy(self.successor)
         # Update predecessors
         self.predecessor = successor_node.predecessor
         successor_node.predecessor = self.id
-        # Update finger table
-        for i in range(1, self.bits):
-            upper_entry = self.finger_table[i+1]
-            current_entry = self.finger_table[i]
-            if self.in_between(upper_entry.start, self.id, current_entry.successor):
-                upper_entry.successor = current_entry.successor
-            else:
-                without_this_node_succ = initial_node.find_successor(upper_entry.start)
-                if self.in_between(self.id, upper_entry.start, without_this_node_succ, equals=False):
-                    upper_entry.successor = self.id
-                else:
-                    upper_entry.successor = without_this_node_succ
+        # Known ranges [lower, upper] of starts and their successor
+        known = [(starts[1], self.successor)]
+        hints = successor_node.get_finger_table()
+        for j in range(1, self.bits + 1):
+            if hints[j] != None:
+                known.append((self.sum_id(self.successor, 1 << (j - 1)), hints[j]))
+        
+        def known_successor(start):
+            for lower, upper in known:
+                if self.in_between(start, lower, self.sum_id(upper, 1)):
+                    return upper
+            return None
+        
+        fingers = {i: known_successor(starts[i]) for i in range(2, self.bits + 1)}
+        missing = [i for i, x in fingers.items() if x == None]
+        for i, successor_id in zip(missing, self.executor.map(lambda i: successor_node.find_successor(starts[i]), missing)):
+            fingers[i] = successor_id
+        for i, successor_id in fingers.items():
+            # The node isn't in the copied fingers yet
+            if self.in_between(self.id, starts[i], successor_id, equals=False):
+                successor_id = self.id
+            self.finger_table.set(i, successor_id)
+        self.membership_stats["join_copied_fingers"] = self.bits - 1 - len(missing)
+        self.membership_stats["join_looked_up_fingers"] = len(missing)
+    
+    def get_finger_table(self):
+        """
+        Returns the successors of the finger table entries, the predecessor first
+        """
+        return list(self.finger_table.successors)
     
     @method_logger
     def init_node_last_part(self):
@@ -451,46 +1785,169 @@ class ChordNode:
         """
         self.update_others()
         self.transfer_keys()
+        if self.replication_factor > 1:
+            self.repair_replicas()
+        self.membership_stats["join_seconds"] = time.monotonic() - self.join_started
     
     @method_logger
     def update_others(self):
         """
         Update finger tables of nodes that should include this node
         """
-        for i in range(1, self.bits + 1):
-            # In the paper the +1 at the of 2**(i-1) doesn't exist but try example CHORD 3 then CHORD 5 and the FT of 3 doesn't update properly
-            pred_id = self.find_predecessor(self.sub_id(self.id, (2 ** (i-1)) - 1))
-            pred_node = self.get_node_proxy(pred_id)
+        def update(pred_node, i):
             pred_node.update_finger_table(self.id, i)
+        self.call_finger_owners(update)
+    
+    def call_finger_owners(self, call):
+        """
+        Calls call(node, i) for every finger i, node is the predecessor of id - 2**(i-1) + 1, the first 
+        node whose finger i can be this node. Predecessors are looked up and called concurrently in the executor.
+        """
+        predecessor = self.predecessor
+        
+        def call_owner(i):
+            # In the paper the +1 at the of 2**(i-1) doesn't exist but try example CHORD 3 then CHORD 5 and the FT of 3 doesn't update properly
+            point = self.sub_id(self.id, (2 ** (i-1)) - 1)
+            if predecessor != None and self.in_between(point, self.sum_id(predecessor, 1), self.sum_id(self.id, 1)):
+                # No need to look up the points owned by this node
+                pred_id = predecessor
+            else:
+                pred_id = self.find_predecessor(point)
+            if pred_id != self.id:
+                call(self.get_node_proxy(pred_id), i)
+        
+        list(self.executor.map(call_owner, range(1, self.bits + 1)))
             
-    @method_logger
+    @instrumented
     def transfer_keys(self):
         """
-        Brings the successor key values for what this node is responsible.
+        Brings the successor key values for what this node is responsible.  
+        Returns the amount of moved keys.
         """
+        if self.predecessor == None:
+            # The range of this node isn't known yet
+            return 0
         successor_id = self.find_successor(self.successor)
-        successor_node = self.get_node_proxy(successor_id)
-        new_keys = successor_node.pop_keys(self.sum_id(self.predecessor, 1), self.id)
-        self.values.update(new_keys)
+        if successor_id == self.id or successor_id in self.local_nodes:
+            # Virtual nodes of this process share the storage, there's nothing to move
+            return 0
+        return self.pull_keys(successor_id, self.sum_id(self.predecessor, 1), self.id)
     
-    @method_logger
+    def pull_keys(self, source_id:int, lower_bound:int, upper_bound:int):
+        """
+        Moves the keys within lower_bound and upper_bound, both included, from the node source_id 
+        to this node in chunks of transfer_chunk_size keys. Each chunk is acknowledged after it's 
+        stored so the source deletes it only then.  
+        A transfer of the same source and range interrupted by a communication error in the last 
+        transfer_cursor_ttl seconds resumes from the last acknowledged chunk, then the range is exported 
+        again from the start to get the keys stored in the source meanwhile. Acknowledged keys aren't 
+        in the source anymore, so that pass only moves the new ones.  
+        Returns the amount of moved keys.
+        """
+        source_node = self.get_node_proxy(source_id)
+        transfer = (source_id, lower_bound, upper_bound)
+        now = time.monotonic()
+        with self.transfer_cursors_lock:
+            for expired in [x for x, y in self.transfer_cursors.items() if y[1] < now]:
+                del self.transfer_cursors[expired]
+            cursor = self.transfer_cursors.pop(transfer, (None,))[0]
+        resumed = cursor is not None
+        stats = TransferStats(f"pull from {source_id}")
+        try:
+            while True:
+                chunk = source_node.export_keys(lower_bound, upper_bound, cursor, self.transfer_chunk_size)
+                items = chunk["items"]
+                if items:
+                    self.store_local(items)
+                    source_node.ack_keys(list(items))
+                    stats.add_chunk(items)
+                cursor = chunk["next"]
+                if chunk["done"]:
+                    if not resumed:
+                        break
+                    cursor, resumed = None, False
+        except self.transport.errors:
+            if cursor is not None:
+                with self.transfer_cursors_lock:
+                    self.transfer_cursors[transfer] = (cursor, time.monotonic() + self.transfer_cursor_ttl)
+            raise
+        finally:
+            self.report_transfer(stats)
+        return stats.keys
+    
+    def push_keys(self, node_id:int, lower_bound:int, upper_bound:int):
+        """
+        Moves the keys within lower_bound and upper_bound, both included, from this node to the node 
+        node_id in chunks of transfer_chunk_size keys. Each chunk is deleted after the node stored it.
+        """
+        node = self.get_node_proxy(node_id)
+        upper = self.sum_id(upper_bound, 1)
+        stats = TransferStats(f"push to {node_id}")
+        while True:
+            items = dict(self.storage.items_range(lower_bound, upper, None, self.transfer_chunk_size))
+            if not items:
+                break
+            stored_keys = node.update_values(items)
+            self.ack_keys(stored_keys)
+            stats.add_chunk(items)
+            if len(stored_keys) < len(items):
+                log.error(f"Node {node_id} refused {len(items) - len(stored_keys)} keys")
+                break
+        self.report_transfer(stats)
+    
+    @instrumented
+    def export_keys(self, lower_bound:int, upper_bound:int, after:int=None, chunk_size:int=1000):
+        """
+        Returns a chunk of up to chunk_size keys within lower_bound and upper_bound, both included, 
+        following the key after. The keys aren't removed until they are acknowledged with ack_keys.  
+        Returns {"items": {key: value}, "next": cursor for the next chunk, "done": if it's the last chunk}
+        """
+        items = self.storage.items_range(lower_bound, self.sum_id(upper_bound, 1), after, chunk_size)
+        return {
+            "items": dict(items),
+            "next": items[-1][0] if items else after,
+            "done": len(items) < chunk_size
+        }
+    
+    @instrumented
+    def ack_keys(self, keys:list):
+        """
+        Removes keys already stored by another node
+        """
+        removed = self.storage.delete_keys(keys)
+        if removed:
+            self.invalidate_leases(removed)
+            self.executor.submit(self.notify_listeners, removed)
+            self.call_replicas("delete_replicas", removed)
+    
+    def report_transfer(self, stats):
+        """
+        Keeps and logs the stats of a finished key transfer
+        """
+        if stats.keys:
+            self.metrics.count("transfer_keys", stats.keys)
+            self.metrics.count("transfer_bytes", stats.bytes)
+            self.last_transfer_stats = stats.summary()
+            log.info(f"Transfer {self.last_transfer_stats}")
+    
+    @instrumented
     def pop_keys(self, lower_bound:int, upper_bound:int):
         """
         Remove associated values within lower_bound and upper_bound. Both limits included
         
         Return the removed part of the dictionary.
         """
-        keys = [x for x in self.values if self.in_between(x, lower_bound, self.sum_id(upper_bound, 1))]
-        values = [self.values[x] for x in keys]
-        for k in keys:
-            self.values.__delitem__(k)
+        popped = self.storage.pop_range(lower_bound, self.sum_id(upper_bound, 1))
         
-        if keys:
-            self.executor.submit(self.notify_listeners, keys)
+        if popped:
+            # The new owner doesn't know the leases
+            self.invalidate_leases(list(popped))
+            self.executor.submit(self.notify_listeners, list(popped))
+            self.call_replicas("delete_replicas", list(popped))
         
-        return {k:v for k,v in zip(keys, values)}
+        return popped
                 
-    @method_logger
+    @instrumented
     def update_finger_table(self, s:int, i:int):
         """
         Updates figer table at i if s is better suited
@@ -498,8 +1955,8 @@ class ChordNode:
         if self.id == s:
             return
         
-        if self.in_between(s, self.id, self.finger_table[i].successor):
-            self.finger_table[i].successor = s
+        if self.in_between(s, self.id, self.finger_table.successors[i]):
+            self.finger_table.set(i, s)
             pred_node = self.get_node_proxy(self.predecessor)
             pred_node.update_finger_table(s, i)
                 
@@ -507,38 +1964,64 @@ class ChordNode:
         """
         Returns a Chord Node proxy for the given id
         """
-        if id != self.id:
-            node = create_object_proxy(ChordNode.node_name(id), self.name_server_host, self.name_server_port)
-        else:
-            node = self
+        if id == self.id:
+            return self
+        node = self.local_nodes.get(id)
+        if node is None:
+            node = self.proxy_pool.get(id)
         return node
     
-    def add_successor_list(self, successor_id):
+    def _create_node_proxy(self, id:int):
+        """
+        Creates a new Chord Node proxy for the given id
+        """
+        return self.transport.proxy(ChordNode.node_name(id), ChordNode.CHORD_NODE_PREFIX)
+    
+    def _create_ping_proxy(self, id:int):
+        """
+        Creates a Chord Node proxy for the given id whose calls fail after ping_timeout seconds
+        """
+        return self.transport.proxy(ChordNode.node_name(id), ChordNode.CHORD_NODE_PREFIX, self.ping_timeout)
+    
+    def discard_node_proxy(self, id:int):
         """
-        Add successor_id to successor list
+        Drop the cached proxies and name resolution of the given id, used after a communication failure
         """
-        self.successor_list.append(successor_id)
-        self.successor_list = list(set(self.successor_list))
-        self.successor_list.sort(key=lambda x: x+(self.max_nodes) if x < self.id else x)
-        self.successor_list = self.successor_list[:self.max_successor_list_count]
+        self.failure_detector.failure(id)
+        if self.successor_list is not None:
+            self.successor_list.remove(id)
+        self.proxy_pool.discard(id)
+        self.transport.invalidate(ChordNode.node_name(id))
+    
+    def get_coordinator_proxy(self):
+        """
+        Returns a proxy of the DHT coordinator
+        """
+        return self.transport.coordinator_proxy(self.coordinator_address)
+    
+    def get_successor_list(self):
+        """
+        Returns the ids of the successor list in ring order
+        """
+        return self.successor_list.ids()
     
     def sum_id(self, id1, id2):
         """
         Sum id1 and id2 with arithmetic modulo 2**bits
         """
-        return sum_id(id1, id2, self.bits)
+        return (id1 + id2) % self.max_nodes
     
     def sub_id(self, id1, id2):
         """
         Substract id1 and id2 with arithmetic modulo 2**bits
         """
-        return sub_id(id1, id2, self.bits)
+        return (id1 - id2) % self.max_nodes
     
     def search_posible_successor(self):
         """
         Returns a possible new active successor.   
-        It looks to the successor_list and finger table entries.  
-        If any are active the only active si self. 
+        It looks to the successor_list and finger table entries and then asks the ring through the coordinator.  
+        If none are active the only active is self. 
         """
         
         def return_node(node_id):
@@ -546,28 +2029,134 @@ class ChordNode:
                 node = self.get_node_proxy(node_id)
                 testing_proxy = node.id
                 return node
-            except pyro.errors.CommunicationError as exc:
+            except self.transport.errors:
                 log.error(f"Node {node_id} offline.")
-                try:
-                    self.successor_list.remove(node_id)
-                except ValueError:
-                    pass
+                self.discard_node_proxy(node_id)
         
-        nodes_ids = self.successor_list.copy()
-        for node_id in nodes_ids: # Trying with successor list
+        # Trying with successor list and then with finger table, suspected nodes last
+        nodes_ids = self.successor_list.ids() + [x for x in self.finger_table.successors[2:] if x != None]
+        nodes_ids = sorted(dict.fromkeys(nodes_ids), key=lambda x: x in self.failure_detector)
+        for node_id in nodes_ids:
+            if node_id == self.id:
+                continue
             node = return_node(node_id)
             if node:
                 return node
         
-        for i in range(2, self.bits + 1): # Trying with finger table
-            finger_able_entry = self.finger_table[i]
-            successor_id = finger_able_entry.successor
-            if successor_id != None:
-                node = return_node(successor_id)
-                if node:
-                    return node
+        # Isolated, asking the ring again through the nodes known by the coordinator
+        try:
+            bootstrap_nodes = self.get_coordinator_proxy().get_bootstrap_nodes(self.bootstrap_count)
+            initial_node = self.choose_initial_node({x: y for x, y in bootstrap_nodes.items() if int(x) != self.id})
+            if initial_node is not None:
+                return self.get_node_proxy(initial_node.find_successor(self.id))
+        except self.transport.errors as exc:
+            log.error(f"Can't reach the ring: {exc}")
         
         # raise ValueError(f"No available successor node") 
-        return self.id
-                    
-                    
\ No newline at end of file
+        return self
+
+
+class ChordVirtualHost:
+    """
+    Hosts several ChordNode ring positions (virtual nodes) in one process and transport.  
+    The virtual nodes share the storage, proxy pool and executor, each one has its own 
+    finger table and stabilization and is registered in the coordinator and name server. 
+    Calls between virtual nodes of the host don't go through Pyro.
+    """
+    
+    def __init__(self, vnodes:int, host=None, port=0, name_server_host=None, name_server_port=None, forced_id=None, stabilization=True, storage=None,
+                 call_timeout:float=None, detector:str="phi", routing:str="iterative", cache_size:int=0, cache_lease:float=1,
+                 placement:str="hash", metrics:bool=False):
+        """
+        vnodes: amount of ring positions hosted  
+        forced_id: forced id of the first virtual node, the others ids are hashed  
+        storage: storage shared by the virtual nodes, in memory if None  
+        call_timeout: seconds before a call to another node fails, None waits forever  
+        detector: failure detector mode of the virtual nodes  
+        routing: routing mode of the virtual nodes  
+        cache_size, cache_lease: read cache of each virtual node  
+        placement: id placement of the virtual nodes without forced id, each one is placed after the previous ones joined  
+        metrics: record the metrics of the virtual nodes from the start
+        """
+        self.host = host
+        self.port = port
+        self.running = False
+        # The loops of every virtual node and the cli loop of the host
+        self.executor = ThreadPoolExecutor(executor_workers(ChordNode.LOOPS * vnodes + 1))
+        self.storage = MemoryStorage() if storage is None else storage
+        self.local_nodes = {}
+        self.name_server_host = name_server_host
+        self.name_server_port = name_server_port
+        self.call_timeout = call_timeout
+        self.transport = None
+        self.proxy_pool = ProxyPool(self._create_node_proxy)
+        self.nodes = [ChordNode(host, port, name_server_host, name_server_port, forced_id if i == 0 else None, stabilization,
+                                self.executor, self.proxy_pool, self.storage, self.local_nodes, call_timeout=call_timeout, detector=detector, routing=routing,
+                                cache_size=cache_size, cache_lease=cache_lease, placement=placement, metrics=metrics)
+                      for i in range(vnodes)]
+        for node in self.nodes:
+            node.owns_transport = False
+    
+    def _create_node_proxy(self, id:int):
+        return self.nodes[0]._create_node_proxy(id)
+    
+    def register_listener(self, listener):
+        """
+        Register listener in every virtual node
+        """
+        for node in self.nodes:
+            node.register_listener(listener)
+    
+    def start(self, coordinator_address):
+        """
+        Start every virtual node in a shared transport
+        """
+        self.running = True
+        for node in self.nodes:
+            node.running = True
+        
+        self.executor.submit(self.cli_loop)
+        
+        self.transport = ChordNode.create_transport(coordinator_address, self.host, self.port, self.name_server_host, self.name_server_port, self.call_timeout)
+        for node in self.nodes:
+            node.transport = self.transport
+        self.transport.start()
+        try:
+            for node in self.nodes:
+                node.setup(coordinator_address)
+            self.transport.run()
+        finally:
+            self.transport.close()
+        
+        for node in self.nodes:
+            node.running = False
+        self.running = False
+    
+    def leave(self):
+        """
+        Leave DHT table with every virtual node
+        """
+        for node in self.nodes:
+            node.leave()
+            node.running = False
+        self.proxy_pool.clear()
+        self.transport.shutdown()
+    
+    def cli_loop(self):
+        """
+        Command Line Interface to talk with the virtual nodes.  
+        Node commands are prefixed with the virtual node index
+        """
+        help_msg = "vnodes: print the virtual nodes ids\nINDEX COMMAND: run a node command in the virtual node INDEX\nexit: shutdown every virtual node"
+        while True:
+            command = input()
+            words = command.split(maxsplit=1)
+            if command == "vnodes":
+                print("\n".join([f"{i}: {node.id}" for i, node in enumerate(self.nodes)]))
+            elif command == "exit":
+                self.leave()
+                break
+            elif len(words) == 2 and words[0].isdigit() and int(words[0]) < len(self.nodes) and words[1] != "exit":
+                self.nodes[int(words[0])].cli_command(words[1])
+            else:
+                print("Invalid command:\n", help_msg)
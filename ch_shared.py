@@ -1,26 +1,297 @@
 import Pyro4 as pyro
 import logging as log
+import hashlib
+import reprlib
+import threading
+import time
+from collections import OrderedDict
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+_tracing = False
+
+def set_tracing(enabled:bool):
+    """
+    Switch the debug tracing of the method_logger decorated methods
+    """
+    global _tracing
+    _tracing = enabled
 
 def method_logger(fun):
     """
-    Decorator for logging methods calls
+    Decorator for debug tracing of methods calls, only logs when enabled with set_tracing.  
+    Arguments and returned values are shortened with reprlib.
     """
     def ret_fun(*args, **kwargs):
-        log.info(f"{fun.__name__} called with {args[1:]} and {kwargs}")
+        if not _tracing:
+            return fun(*args, **kwargs)
+        log.debug(f"{fun.__name__} called with {reprlib.repr(args[1:])} and {reprlib.repr(kwargs)}")
         try:
             value = fun(*args, **kwargs)
         except Exception as exc:
             log.exception(exc)
             raise exc
-        log.info(f"{fun.__name__} exited returning {value}")
+        log.debug(f"{fun.__name__} exited returning {reprlib.repr(value)}")
         return value
     return ret_fun
+
+class KeyHasher:
+    """
+    Stable hash of keys into a ring of 2**bits ids, equal in every process.  
+    Integers are taken as ids already, so forced keys and hashed keys map to themselves. 
+    Any other value is hashed by its str representation.
+    """
+    
+    ALGORITHMS = ("sha1", "blake2b", "xxhash")
+    DIGEST_BITS = {"sha1": 160, "blake2b": 512, "xxhash": 128} # Widest id each algorithm fills
+    
+    def __init__(self, bits:int, algorithm:str="sha1"):
+        if algorithm not in KeyHasher.ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm}, use one of {KeyHasher.ALGORITHMS}")
+        if algorithm == "xxhash" and xxhash is None:
+            raise ValueError("xxhash algorithm requires the xxhash package")
+        if bits > KeyHasher.DIGEST_BITS[algorithm]:
+            raise ValueError(f"{algorithm} hashes only {KeyHasher.DIGEST_BITS[algorithm]} bits, {bits} bits would leave part of the ring unused")
+        self.bits = bits
+        self.algorithm = algorithm
+        self.max_nodes = 1 << bits
+        if algorithm == "sha1":
+            self._digest = lambda data: hashlib.sha1(data).digest()
+        elif algorithm == "blake2b":
+            digest_size = min(64, max(1, (bits + 7) // 8))
+            self._digest = lambda data: hashlib.blake2b(data, digest_size=digest_size).digest()
+        else:
+            self._digest = lambda data: xxhash.xxh3_128_digest(data)
+    
+    def hash(self, value):
+        """
+        Returns the id of value
+        """
+        if isinstance(value, int):
+            return value % self.max_nodes
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        return int.from_bytes(self._digest(value), "big") % self.max_nodes
+    
+    def hash_many(self, values:list):
+        """
+        Returns the ids of values in order
+        """
+        digest, max_nodes, from_bytes = self._digest, self.max_nodes, int.from_bytes
+        ids = []
+        for value in values:
+            if isinstance(value, int):
+                ids.append(value % max_nodes)
+                continue
+            if not isinstance(value, bytes):
+                value = str(value).encode()
+            ids.append(from_bytes(digest(value), "big") % max_nodes)
+        return ids
+
+def create_object_proxy(name, ns_host:str, ns_port:int, bulk_prefix:str=None):
+    """
+    Create an object proxy from the given name.  
+    The name is resolved through the shared cached resolver of the name server. 
+    """
+    object_uri = get_resolver(ns_host, ns_port).lookup(name, bulk_prefix)
+    return pyro.Proxy(object_uri)
+
+def release_proxy(proxy):
+    """
+    Close the connection of proxy ignoring errors
+    """
+    try:
+        proxy._pyroRelease()
+    except Exception:
+        pass
+
+class ProxyPool:
+    """
+    Bounded pool of Pyro proxies keyed by node id.  
+    Each thread gets its own proxy for a node, because Pyro serializes the calls made through 
+    a single proxy. The least recently used proxies are released when the pool is full and 
+    proxies unused for max_idle seconds are released on the next access.
+    """
+    
+    def __init__(self, factory, max_size:int=128, max_idle:float=60):
+        """
+        factory: function that receives a key and returns a new proxy for it  
+        max_size: max amount of open proxies  
+        max_idle: seconds before an unused proxy is released  
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._proxies = OrderedDict() # (key, thread id) -> (proxy, last used time)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._proxies)
+    
+    def get(self, key):
+        """
+        Returns an open proxy for key, creating it if needed
+        """
+        pool_key = (key, threading.get_ident())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._proxies.pop(pool_key, None)
+            if entry is not None and now - entry[1] <= self.max_idle:
+                self._proxies[pool_key] = (entry[0], now)
+                return entry[0]
+        if entry is not None:
+            release_proxy(entry[0])
         
-def create_object_proxy(name, ns_host:str, ns_port:int):
+        proxy = self.factory(key)
+        with self._lock:
+            old_entry = self._proxies.pop(pool_key, None)
+            self._proxies[pool_key] = (proxy, now)
+            evicted = self._evict(now)
+        if old_entry is not None:
+            evicted.append(old_entry[0])
+        for old_proxy in evicted:
+            release_proxy(old_proxy)
+        return proxy
+    
+    def discard(self, key):
+        """
+        Release every proxy of key. Used when a call to the key failed.
+        """
+        with self._lock:
+            pool_keys = [x for x in self._proxies if x[0] == key]
+            evicted = [self._proxies.pop(x)[0] for x in pool_keys]
+        for proxy in evicted:
+            release_proxy(proxy)
+    
+    def clear(self):
+        """
+        Release all proxies
+        """
+        with self._lock:
+            evicted = [proxy for proxy, _ in self._proxies.values()]
+            self._proxies.clear()
+        for proxy in evicted:
+            release_proxy(proxy)
+    
+    def _evict(self, now):
+        """
+        Remove idle proxies and the least recently used ones over max_size.  
+        Must be called holding the lock, returns the removed proxies.
+        """
+        evicted = []
+        while self._proxies:
+            pool_key, (proxy, last_used) = next(iter(self._proxies.items()))
+            if now - last_used <= self.max_idle and len(self._proxies) <= self.max_size:
+                break
+            self._proxies.popitem(last=False)
+            evicted.append(proxy)
+        return evicted
+
+
+class NameResolver:
+    """
+    Caches the name server lookups for ttl seconds.  
+    Missing names are cached for negative_ttl seconds. Names can be resolved in bulk 
+    listing every name registered under a prefix with a single name server call.
+    """
+    
+    def __init__(self, ns_host:str, ns_port:int, ttl:float=30, negative_ttl:float=2):
+        self.ns_host = ns_host
+        self.ns_port = ns_port
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = {} # name -> (uri or None if missing, expiration time)
+        self._lock = threading.Lock()
+        self._ns_pool = ProxyPool(lambda _: pyro.locateNS(self.ns_host, self.ns_port), max_size=16)
+    
+    def lookup(self, name:str, bulk_prefix:str=None):
+        """
+        Returns the uri registered for name.  
+        If bulk_prefix is given and name isn't cached, all the names under bulk_prefix are refreshed.  
+        Raise NamingError if the name isn't registered. 
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(name)
+        if entry is None or entry[1] < now:
+            if bulk_prefix is not None and name.startswith(bulk_prefix):
+                self.refresh(bulk_prefix)
+                with self._lock:
+                    entry = self._cache.get(name)
+                if entry is None:
+                    entry = self._store(name, None)
+            else:
+                entry = self._lookup_name_server(name)
+        if entry[0] is None:
+            raise pyro.errors.NamingError(f"unknown name: {name}")
+        return entry[0]
+    
+    def refresh(self, prefix:str):
+        """
+        Updates every name registered under prefix with a single name server call.  
+        Returns the dict name -> uri of the registered names.
+        """
+        names = self._call_name_server(lambda ns: ns.list(prefix=prefix))
+        expiration = time.monotonic() + self.ttl
+        with self._lock:
+            for name in [x for x in self._cache if x.startswith(prefix) and x not in names]:
+                self._cache.__delitem__(name)
+            for name, uri in names.items():
+                self._cache[name] = (uri, expiration)
+        return names
+    
+    def invalidate(self, name:str=None, uri=None):
+        """
+        Removes the cached entry of name, or every entry resolved to uri. 
+        """
+        with self._lock:
+            if name is not None:
+                self._cache.pop(name, None)
+            if uri is not None:
+                uri = str(uri)
+                for cached_name in [x for x, y in self._cache.items() if y[0] is not None and str(y[0]) == uri]:
+                    self._cache.__delitem__(cached_name)
+    
+    def clear(self):
+        """
+        Removes all cached entries
+        """
+        with self._lock:
+            self._cache.clear()
+    
+    def _lookup_name_server(self, name:str):
+        try:
+            uri = self._call_name_server(lambda ns: ns.lookup(name))
+        except pyro.errors.NamingError:
+            uri = None
+        return self._store(name, uri)
+    
+    def _store(self, name:str, uri):
+        entry = (uri, time.monotonic() + (self.ttl if uri is not None else self.negative_ttl))
+        with self._lock:
+            self._cache[name] = entry
+        return entry
+    
+    def _call_name_server(self, call):
+        ns = self._ns_pool.get(None)
+        try:
+            return call(ns)
+        except pyro.errors.CommunicationError:
+            self._ns_pool.discard(None)
+            raise
+
+_resolvers = {}
+_resolvers_lock = threading.Lock()
+
+def get_resolver(ns_host:str, ns_port:int):
     """
-    Create an object proxy from the given name 
+    Returns the process wide NameResolver of the name server at ns_host:ns_port
     """
-    with pyro.locateNS(ns_host, ns_port) as ns:
-        object_uri = ns.lookup(name)
-        return pyro.Proxy(object_uri)
-    
\ No newline at end of file
+    with _resolvers_lock:
+        resolver = _resolvers.get((ns_host, ns_port))
+        if resolver is None:
+            resolver = NameResolver(ns_host, ns_port)
+            _resolvers[(ns_host, ns_port)] = resolver
+        return resolver
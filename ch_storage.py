@@ -0,0 +1,409 @@
+import bisect
+import logging as log
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+class MemoryStorage:
+    """
+    In memory storage of the node's key values, kept sorted by ring id.  
+    Ranges follow the ring order modulo 2**bits: range(lower, upper) are the keys in [lower, upper),  
+    wrapping around zero when lower > upper, and every key when lower == upper.  
+    Values live in a dict and the keys in a sorted list, so range operations cost O(log n + k).
+    """
+    
+    def __init__(self):
+        self._values = {}
+        self._keys = [] # Sorted keys of _values
+        self._lock = threading.RLock()
+    
+    def __len__(self):
+        return len(self._values)
+    
+    def __contains__(self, key:int):
+        return key in self._values
+    
+    def __iter__(self):
+        with self._lock:
+            return iter(self._keys.copy())
+    
+    def __getitem__(self, key:int):
+        return self._values[key]
+    
+    def __setitem__(self, key:int, value):
+        with self._lock:
+            if key not in self._values:
+                bisect.insort(self._keys, key)
+            self._values[key] = value
+    
+    def __delitem__(self, key:int):
+        with self._lock:
+            del self._values[key]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+    
+    def get(self, key:int, default=None):
+        return self._values.get(key, default)
+    
+    def items(self):
+        """
+        Returns a list of (key, value) sorted by key
+        """
+        with self._lock:
+            return [(x, self._values[x]) for x in self._keys]
+    
+    def update(self, new_values:dict):
+        """
+        Stores every key value of new_values
+        """
+        with self._lock:
+            new_keys = [x for x in new_values if x not in self._values]
+            self._values.update(new_values)
+            if len(new_keys) > 8:
+                # Cheaper to sort once than to insert one by one
+                self._keys.extend(new_keys)
+                self._keys.sort()
+            else:
+                for key in new_keys:
+                    bisect.insort(self._keys, key)
+    
+    def _slices(self, lower:int, upper:int, after:int=None):
+        """
+        Returns the index slices of _keys in the ring range [lower, upper), in ring order from lower.  
+        If after is given only the keys following after in the range are included.
+        """
+        keys = self._keys
+        start = bisect.bisect_left(keys, lower) if after is None else bisect.bisect_right(keys, after)
+        end = bisect.bisect_left(keys, upper)
+        if (lower if after is None else after) < upper:
+            return [(start, end)]
+        return [(start, len(keys)), (0, end)]
+    
+    def keys_range(self, lower:int, upper:int):
+        """
+        Returns the keys in the ring range [lower, upper) in ring order
+        """
+        with self._lock:
+            return [x for start, end in self._slices(lower, upper) for x in self._keys[start:end]]
+    
+    def items_range(self, lower:int, upper:int, after:int=None, limit:int=None):
+        """
+        Returns up to limit (key, value) pairs in the ring range [lower, upper) in ring order.  
+        If after is given only the keys following after in the range are returned.
+        """
+        with self._lock:
+            keys = []
+            for start, end in self._slices(lower, upper, after):
+                if limit is not None:
+                    end = min(end, start + limit - len(keys))
+                keys.extend(self._keys[start:end])
+            return [(x, self[x]) for x in keys]
+    
+    def delete_keys(self, keys:list):
+        """
+        Removes the stored keys of keys, returns the removed ones
+        """
+        with self._lock:
+            removed = [x for x in keys if x in self._values]
+            for key in removed:
+                del self[key]
+            return removed
+    
+    def count_range(self, lower:int, upper:int):
+        """
+        Returns the amount of keys in the ring range [lower, upper)
+        """
+        with self._lock:
+            return sum(end - start for start, end in self._slices(lower, upper))
+    
+    def has_range(self, lower:int, upper:int):
+        """
+        Checks if there is any key in the ring range [lower, upper)
+        """
+        if not self._values:
+            return False
+        with self._lock:
+            return any(end > start for start, end in self._slices(lower, upper))
+    
+    def median_key(self, lower:int, upper:int):
+        """
+        Returns the key in the middle of the ring range [lower, upper) in ring order, the lower one 
+        of the two middle keys if the amount is even. None if the range is empty
+        """
+        with self._lock:
+            slices = [(start, end) for start, end in self._slices(lower, upper) if end > start]
+            index = (sum(end - start for start, end in slices) - 1) // 2
+            for start, end in slices:
+                if index < end - start:
+                    return self._keys[start + index]
+                index -= end - start
+            return None
+    
+    def pop_range(self, lower:int, upper:int):
+        """
+        Removes the keys in the ring range [lower, upper) and returns them in a dict
+        """
+        with self._lock:
+            slices = self._slices(lower, upper)
+            popped = {x: self._values.pop(x) for start, end in slices for x in self._keys[start:end]}
+            # Delete the last slice first so the first slice indexes stay valid
+            for start, end in sorted(slices, reverse=True):
+                del self._keys[start:end]
+            return popped
+    
+class LogStorage(MemoryStorage):
+    """
+    Persistent storage of the node's key values in the directory path.  
+    Writes are appended to a log and periodically compacted into a snapshot sorted by key.  
+    Values are read from the files through mmap, only the index of keys to file locations is kept 
+    in memory. The index is rebuilt from the files on first use, so a restarted node serves its 
+    keys without waiting for transfers.
+    """
+    
+    SNAPSHOT_FILE = "snapshot.db"
+    LOG_FILE = "log.db"
+    _HEADER = struct.Struct(">BBI") # operation, key length, value length
+    _DELETE = 0
+    _PUT = 1
+    _SNAPSHOT = 0
+    _LOG = 1
+    
+    def __init__(self, path:str, compact_ratio:float=2, compact_min_records:int=10000, sync:bool=False):
+        """
+        path: directory of the storage files  
+        compact_ratio: the log is compacted when it has compact_ratio times more records than stored keys  
+        compact_min_records: log records needed before compacting  
+        sync: fsync the log after every write
+        """
+        super().__init__()
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.sync = sync
+        self._loaded = False
+        self._log = None
+        self._log_records = 0
+        self._maps = [None, None]
+    
+    def _file(self, file_id:int):
+        return os.path.join(self.path, LogStorage.SNAPSHOT_FILE if file_id == LogStorage._SNAPSHOT else LogStorage.LOG_FILE)
+    
+    def _load(self):
+        """
+        Rebuild the index from the snapshot and log files if it isn't loaded yet
+        """
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            index = {}
+            self._read_records(LogStorage._SNAPSHOT, index)
+            self._log_records = self._read_records(LogStorage._LOG, index)
+            self._values = index
+            self._keys = sorted(index)
+            self._log = open(self._file(LogStorage._LOG), "ab")
+            self._loaded = True
+    
+    def _read_records(self, file_id:int, index:dict):
+        """
+        Apply the records of file_id to index, returns the amount of records read.  
+        The file is walked through mmap, so only the index is kept in memory. 
+        A partially written record at the end of the file is truncated.
+        """
+        file_name = self._file(file_id)
+        if not os.path.exists(file_name) or os.path.getsize(file_name) == 0:
+            return 0
+        header_size = LogStorage._HEADER.size
+        count = 0
+        offset = 0
+        with open(file_name, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            while offset + header_size <= size:
+                operation, key_length, value_length = LogStorage._HEADER.unpack_from(data, offset)
+                value_offset = offset + header_size + key_length
+                if value_offset + value_length > size:
+                    break
+                key = int.from_bytes(data[offset + header_size:value_offset], "big")
+                if operation == LogStorage._PUT:
+                    index[key] = (file_id, value_offset, value_length)
+                else:
+                    index.pop(key, None)
+                offset = value_offset + value_length
+                count += 1
+        if offset < size:
+            log.warning(f"Truncating incomplete record at {offset} of {file_name}")
+            with open(file_name, "r+b") as file:
+                file.truncate(offset)
+        return count
+    
+    def _read_value(self, location):
+        file_id, offset, length = location
+        data = self._maps[file_id]
+        if data is None or len(data) < offset + length:
+            if file_id == LogStorage._LOG:
+                self._log.flush()
+            if data is not None:
+                data.close()
+            with open(self._file(file_id), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[file_id] = data
+        return pickle.loads(data[offset:offset + length])
+    
+    def _encode(self, operation:int, key:int, value:bytes=b""):
+        key_bytes = key.to_bytes(max(1, (key.bit_length() + 7) // 8), "big")
+        return LogStorage._HEADER.pack(operation, len(key_bytes), len(value)) + key_bytes + value, len(key_bytes)
+    
+    def _append(self, records:list):
+        """
+        Append (operation, key, value) records to the log and update the index
+        """
+        offset = self._log.tell()
+        chunks = []
+        for operation, key, value in records:
+            value = pickle.dumps(value) if operation == LogStorage._PUT else b""
+            record, key_length = self._encode(operation, key, value)
+            if operation == LogStorage._PUT:
+                self._values[key] = (LogStorage._LOG, offset + LogStorage._HEADER.size + key_length, len(value))
+            offset += len(record)
+            chunks.append(record)
+        self._log.write(b"".join(chunks))
+        self._log.flush()
+        if self.sync:
+            os.fsync(self._log.fileno())
+        self._log_records += len(records)
+        if self._log_records > self.compact_min_records and self._log_records > self.compact_ratio * len(self._values):
+            self.compact()
+    
+    def compact(self):
+        """
+        Write the stored keys into a new snapshot and empty the log
+        """
+        self._load()
+        with self._lock:
+            temp_name = self._file(LogStorage._SNAPSHOT) + ".tmp"
+            index = {}
+            offset = 0
+            with open(temp_name, "wb") as file:
+                for key in self._keys:
+                    value = pickle.dumps(self._read_value(self._values[key]))
+                    record, key_length = self._encode(LogStorage._PUT, key, value)
+                    index[key] = (LogStorage._SNAPSHOT, offset + LogStorage._HEADER.size + key_length, len(value))
+                    offset += len(record)
+                    file.write(record)
+                file.flush()
+                os.fsync(file.fileno())
+            for data in self._maps:
+                if data is not None:
+                    data.close()
+            self._maps = [None, None]
+            os.replace(temp_name, self._file(LogStorage._SNAPSHOT))
+            self._log.close()
+            self._log = open(self._file(LogStorage._LOG), "wb")
+            self._log_records = 0
+            self._values = index
+            log.info(f"Compacted storage {self.path} with {len(index)} keys")
+    
+    def close(self):
+        """
+        Close the storage files
+        """
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+            for data in self._maps:
+                if data is not None:
+                    data.close()
+            self._maps = [None, None]
+            self._loaded = False
+    
+    def __len__(self):
+        self._load()
+        return super().__len__()
+    
+    def __contains__(self, key:int):
+        self._load()
+        return super().__contains__(key)
+    
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+    
+    def __getitem__(self, key:int):
+        self._load()
+        with self._lock:
+            return self._read_value(self._values[key])
+    
+    def __setitem__(self, key:int, value):
+        self.update({key: value})
+    
+    def __delitem__(self, key:int):
+        self._load()
+        with self._lock:
+            super().__delitem__(key)
+            self._append([(LogStorage._DELETE, key, None)])
+    
+    def get(self, key:int, default=None):
+        self._load()
+        with self._lock:
+            location = self._values.get(key)
+            return default if location is None else self._read_value(location)
+    
+    def items(self):
+        self._load()
+        with self._lock:
+            return [(x, self._read_value(self._values[x])) for x in self._keys]
+    
+    def update(self, new_values:dict):
+        self._load()
+        with self._lock:
+            new_keys = [x for x in new_values if x not in self._values]
+            # Keys are indexed before appending because the append may compact the storage
+            if len(new_keys) > 8:
+                self._keys.extend(new_keys)
+                self._keys.sort()
+            else:
+                for key in new_keys:
+                    bisect.insort(self._keys, key)
+            self._append([(LogStorage._PUT, x, y) for x, y in new_values.items()])
+    
+    def keys_range(self, lower:int, upper:int):
+        self._load()
+        return super().keys_range(lower, upper)
+    
+    def items_range(self, lower:int, upper:int, after:int=None, limit:int=None):
+        self._load()
+        return super().items_range(lower, upper, after, limit)
+    
+    def delete_keys(self, keys:list):
+        self._load()
+        with self._lock:
+            removed = [x for x in keys if x in self._values]
+            for key in removed:
+                MemoryStorage.__delitem__(self, key)
+            if removed:
+                self._append([(LogStorage._DELETE, x, None) for x in removed])
+            return removed
+    
+    def count_range(self, lower:int, upper:int):
+        self._load()
+        return super().count_range(lower, upper)
+    
+    def has_range(self, lower:int, upper:int):
+        self._load()
+        return super().has_range(lower, upper)
+    
+    def median_key(self, lower:int, upper:int):
+        self._load()
+        return super().median_key(lower, upper)
+    
+    def pop_range(self, lower:int, upper:int):
+        self._load()
+        with self._lock:
+            locations = super().pop_range(lower, upper)
+            popped = {x: self._read_value(y) for x, y in locations.items()}
+            if popped:
+                self._append([(LogStorage._DELETE, x, None) for x in popped])
+            return popped
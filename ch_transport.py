@@ -0,0 +1,586 @@
+import Pyro4 as pyro
+import asyncio
+import builtins
+import itertools
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+import logging as log
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from ch_shared import create_object_proxy, get_resolver
+
+TRANSPORTS = ("pyro", "tcp", "inprocess")
+
+class CommunicationError(ConnectionError):
+    """
+    The remote object can't be reached, raised by the transports that don't use Pyro
+    """
+
+class RemoteError(Exception):
+    """
+    Exception raised by a remote call that has no local equivalent
+    """
+
+class Transport:
+    """
+    How nodes serve themselves and reach each other.
+    Objects are registered to get their address and published under a name, other processes
+    resolve the name and connect to the address to get a proxy. Every attribute read, write
+    or method call of a proxy is a remote call, which raises one of errors when the remote
+    object can't be reached. The coordinator is always reached with coordinator_proxy.
+    """
+
+    errors = ()
+
+    def start(self):
+        """
+        Start accepting calls, before registering objects
+        """
+
+    def run(self):
+        """
+        Serve calls until shutdown
+        """
+
+    def shutdown(self):
+        """
+        Stop run
+        """
+
+    def close(self):
+        """
+        Release the transport resources after run
+        """
+
+    def register(self, obj):
+        """
+        Serve obj, returns its address
+        """
+        raise NotImplementedError()
+
+    def publish(self, name:str, address):
+        """
+        Make address reachable by name
+        """
+        raise NotImplementedError()
+
+    def resolve(self, name:str, bulk_prefix:str=None):
+        """
+        Returns the address published as name
+        """
+        raise NotImplementedError()
+
+    def connect(self, address, timeout:float=None):
+        """
+        Returns a proxy of the object at address.  
+        timeout: seconds before a call of the proxy fails, the transport timeout if None
+        """
+        raise NotImplementedError()
+
+    def invalidate(self, name:str):
+        """
+        Forget the cached address of name, used after a communication failure
+        """
+
+    def proxy(self, name:str, bulk_prefix:str=None, timeout:float=None):
+        """
+        Returns a proxy of the object published as name, see connect
+        """
+        return self.connect(self.resolve(name, bulk_prefix), timeout)
+
+    def coordinator_proxy(self, name:str):
+        """
+        Returns a proxy of the DHT coordinator published as name
+        """
+        return self.proxy(name)
+
+class PyroTransport(Transport):
+    """
+    Objects served by a Pyro daemon and published in the Pyro name server
+    """
+
+    errors = (pyro.errors.CommunicationError,)
+
+    def __init__(self, host:str=None, port:int=0, ns_host:str=None, ns_port:int=None, timeout:float=None):
+        """
+        timeout: seconds before a call fails, None waits forever
+        """
+        self.host = host
+        self.port = port
+        self.ns_host = ns_host
+        self.ns_port = ns_port
+        self.timeout = timeout
+        self.daemon = None
+
+    def start(self):
+        self.daemon = pyro.Daemon(self.host, self.port)
+
+    def run(self):
+        self.daemon.requestLoop()
+
+    def shutdown(self):
+        if self.daemon is not None:
+            self.daemon.shutdown()
+
+    def close(self):
+        if self.daemon is not None:
+            self.daemon.close()
+            self.daemon = None
+
+    def register(self, obj):
+        return self.daemon.register(obj)
+
+    def publish(self, name:str, address):
+        with pyro.locateNS(self.ns_host, self.ns_port) as ns:
+            ns.register(name, address)
+
+    def resolve(self, name:str, bulk_prefix:str=None):
+        return get_resolver(self.ns_host, self.ns_port).lookup(name, bulk_prefix)
+
+    def connect(self, address, timeout:float=None):
+        proxy = pyro.Proxy(address)
+        proxy._pyroTimeout = self.timeout if timeout is None else timeout
+        return proxy
+
+    def invalidate(self, name:str):
+        get_resolver(self.ns_host, self.ns_port).invalidate(name)
+
+    def coordinator_proxy(self, name:str):
+        return create_object_proxy(name, self.ns_host, self.ns_port)
+
+class InProcessProxy:
+    """
+    Proxy of an object registered in an InProcessTransport.
+    Every attribute read or write is one call that goes straight to the object, or raises
+    CommunicationError if the object isn't registered anymore. The name is resolved on every call.
+    """
+
+    __slots__ = ("_transport", "_name")
+
+    def __init__(self, transport, name):
+        object.__setattr__(self, "_transport", transport)
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attribute):
+        obj, response_delay = self._transport.target(self._name, attribute)
+        value = getattr(obj, attribute)
+        if not response_delay:
+            return value
+        if not callable(value):
+            time.sleep(response_delay)
+            return value
+
+        def call(*args, **kwargs):
+            try:
+                return value(*args, **kwargs)
+            finally:
+                time.sleep(response_delay)
+        return call
+
+    def __setattr__(self, attribute, value):
+        obj, response_delay = self._transport.target(self._name, attribute)
+        setattr(obj, attribute, value)
+        if response_delay:
+            time.sleep(response_delay)
+
+    def _pyroRelease(self):
+        # Same name as the Pyro method so ProxyPool releases any proxy
+        pass
+
+class InProcessTransport(Transport):
+    """
+    Connects objects of the same process, like the nodes of a simulated ring, without Pyro.
+    Calls go straight to the objects and are counted by attribute name, so benchmarks can measure
+    the RPC cost of an operation. Each call can be delayed latency seconds plus up to jitter
+    seconds, half before reaching the object and half after like the request and response of a
+    network call, and fail with probability failure_rate.
+    """
+
+    errors = (CommunicationError,)
+
+    def __init__(self, latency:float=0, jitter:float=0, failure_rate:float=0, seed:int=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.objects = {} # Name or address -> object
+        self.calls = Counter()
+        self._addresses = itertools.count()
+        self._random = random.Random(seed)
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        self._stopped.wait()
+
+    def shutdown(self):
+        self._stopped.set()
+
+    def register(self, obj):
+        address = f"inprocess:{next(self._addresses)}"
+        self.objects[address] = obj
+        return address
+
+    def publish(self, name, address):
+        self.objects[name] = self.objects[address]
+
+    def unregister(self, name):
+        """
+        Remove the object published as name, the calls to it fail from now on
+        """
+        obj = self.objects.pop(name, None)
+        for key in [x for x, y in self.objects.items() if y is obj]:
+            self.objects.__delitem__(key)
+
+    def resolve(self, name, bulk_prefix:str=None):
+        return name
+
+    def connect(self, address, timeout:float=None):
+        # Calls only wait the injected latency, there's nothing to time out
+        return InProcessProxy(self, address)
+
+    def target(self, name, attribute:str):
+        """
+        Counts a call to attribute of the object name, waits the request delay and returns
+        (object, delay of the response)
+        """
+        with self._lock:
+            self.calls[attribute] += 1
+            fail = self.failure_rate and self._random.random() < self.failure_rate
+            delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay / 2)
+        obj = self.objects.get(name)
+        if obj is None or fail:
+            raise CommunicationError(f"Object {name} is unreachable")
+        return obj, delay / 2
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = Counter()
+
+# Binary codec of the TCP transport, a type tag followed by the value
+_NONE, _TRUE, _FALSE, _INT, _BIG_INT, _FLOAT, _STR, _BYTES, _LIST, _TUPLE, _DICT, _SET = range(12)
+_TAG = struct.Struct(">B")
+_LENGTH = struct.Struct(">I")
+_INT64 = struct.Struct(">q")
+_FLOAT64 = struct.Struct(">d")
+
+def encode(value):
+    """
+    Encodes None, bool, int, float, str, bytes and lists, tuples, sets and dicts of them
+    """
+    buffer = bytearray()
+    _encode(value, buffer)
+    return bytes(buffer)
+
+def _encode(value, buffer:bytearray):
+    if value is None:
+        buffer += _TAG.pack(_NONE)
+    elif value is True:
+        buffer += _TAG.pack(_TRUE)
+    elif value is False:
+        buffer += _TAG.pack(_FALSE)
+    elif isinstance(value, int):
+        if -(1 << 63) <= value < (1 << 63):
+            buffer += _TAG.pack(_INT) + _INT64.pack(value)
+        else:
+            data = value.to_bytes((value.bit_length() + 8) // 8, "big", signed=True)
+            buffer += _TAG.pack(_BIG_INT) + _LENGTH.pack(len(data)) + data
+    elif isinstance(value, float):
+        buffer += _TAG.pack(_FLOAT) + _FLOAT64.pack(value)
+    elif isinstance(value, str):
+        data = value.encode()
+        buffer += _TAG.pack(_STR) + _LENGTH.pack(len(data)) + data
+    elif isinstance(value, (bytes, bytearray)):
+        buffer += _TAG.pack(_BYTES) + _LENGTH.pack(len(value)) + value
+    elif isinstance(value, dict):
+        buffer += _TAG.pack(_DICT) + _LENGTH.pack(len(value))
+        for key, item in value.items():
+            _encode(key, buffer)
+            _encode(item, buffer)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        tag = _LIST if isinstance(value, list) else _TUPLE if isinstance(value, tuple) else _SET
+        buffer += _TAG.pack(tag) + _LENGTH.pack(len(value))
+        for item in value:
+            _encode(item, buffer)
+    else:
+        raise TypeError(f"Can't encode {type(value).__name__} values")
+
+def decode(data:bytes):
+    """
+    Decodes a value encoded with encode
+    """
+    return _decode(memoryview(data), 0)[0]
+
+def _decode(data, offset:int):
+    tag = data[offset]
+    offset += 1
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _INT:
+        return _INT64.unpack_from(data, offset)[0], offset + 8
+    if tag == _FLOAT:
+        return _FLOAT64.unpack_from(data, offset)[0], offset + 8
+    length = _LENGTH.unpack_from(data, offset)[0]
+    offset += 4
+    if tag == _BIG_INT:
+        return int.from_bytes(data[offset:offset + length], "big", signed=True), offset + length
+    if tag == _STR:
+        return str(data[offset:offset + length], "utf-8"), offset + length
+    if tag == _BYTES:
+        return bytes(data[offset:offset + length]), offset + length
+    if tag == _DICT:
+        value = {}
+        for _ in range(length):
+            key, offset = _decode(data, offset)
+            value[key], offset = _decode(data, offset)
+        return value, offset
+    items = []
+    for _ in range(length):
+        item, offset = _decode(data, offset)
+        items.append(item)
+    if tag == _LIST:
+        return items, offset
+    if tag == _TUPLE:
+        return tuple(items), offset
+    if tag == _SET:
+        return set(items), offset
+    raise ValueError(f"Unknown tag {tag}")
+
+class TcpProxy:
+    """
+    Proxy of an object served by a TcpTransport, with one connection opened on first use.
+    The public methods of the object are asked once per address, other attributes are read
+    and written remotely.
+    """
+
+    __slots__ = ("_transport", "_address", "_object_id", "_host", "_port", "_timeout", "_socket", "_lock")
+
+    def __init__(self, transport, address:str, timeout:float=None):
+        """
+        timeout: seconds before a call fails, None waits forever
+        """
+        object_id, location = address[len("PYRO:"):].split("@")
+        host, port = location.rsplit(":", 1)
+        for name, value in [("_transport", transport), ("_address", address), ("_object_id", object_id), ("_host", host),
+                            ("_port", int(port)), ("_timeout", timeout), ("_socket", None), ("_lock", threading.Lock())]:
+            object.__setattr__(self, name, value)
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        if attribute in self._transport.methods(self):
+            return lambda *args, **kwargs: self._call(TcpTransport._CALL, attribute, args, kwargs)
+        return self._call(TcpTransport._GET, attribute)
+
+    def __setattr__(self, attribute, value):
+        self._call(TcpTransport._SET, attribute, (value,))
+
+    def _call(self, operation:int, attribute:str, args=(), kwargs=None):
+        request = encode((self._object_id, operation, attribute, args, kwargs or {}))
+        with self._lock:
+            try:
+                if self._socket is None:
+                    sock = socket.create_connection((self._host, self._port), self._timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    object.__setattr__(self, "_socket", sock)
+                self._socket.sendall(_LENGTH.pack(len(request)) + request)
+                size = _LENGTH.unpack(self._receive(4))[0]
+                ok, value = decode(self._receive(size))
+            except OSError as exc:
+                self._pyroRelease()
+                raise CommunicationError(f"Call to {self._address} failed: {exc}") from exc
+        if ok:
+            return value
+        raise remote_exception(*value)
+
+    def _receive(self, size:int):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError("Connection closed")
+            data += chunk
+        return data
+
+    def _pyroRelease(self):
+        # Same name as the Pyro method so ProxyPool releases any proxy
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            object.__setattr__(self, "_socket", None)
+
+def remote_exception(name:str, message:str):
+    """
+    Returns the local exception for the exception name raised remotely
+    """
+    if name == CommunicationError.__name__:
+        return CommunicationError(message)
+    exception = getattr(builtins, name, None)
+    if isinstance(exception, type) and issubclass(exception, Exception):
+        return exception(message)
+    return RemoteError(f"{name}: {message}")
+
+class TcpTransport(Transport):
+    """
+    Lean RPC over TCP without Pyro.
+    Requests and responses are length prefixed frames of the binary codec, served by an asyncio
+    server in a background thread. Calls run in a thread pool because they can call back into
+    this process. Addresses use the Pyro URI format so they are published in the Pyro name server,
+    which is only used as directory. Like Pyro, only the methods and properties exposed with
+    pyro.expose can be reached.
+    """
+
+    errors = (CommunicationError,)
+    _CALL, _GET, _SET, _METHODS = range(4)
+
+    def __init__(self, host:str=None, port:int=0, ns_host:str=None, ns_port:int=None, timeout:float=None, workers:int=64):
+        """
+        timeout: seconds before a call fails, None waits forever
+        workers: max amount of calls served at the same time
+        """
+        self.host = host or "localhost"
+        self.port = port
+        self.ns_host = ns_host
+        self.ns_port = ns_port
+        self.timeout = timeout
+        self.workers = workers
+        self.objects = {} # Object id -> object
+        self._methods = {} # Address -> public method names of the object
+        self._executor = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._connections = {} # Task serving an open connection -> connection writer
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(self.workers)
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        log.info(f"TCP transport listening on {self.host}:{self.port}")
+
+    def run(self):
+        self._stopped.wait()
+
+    def shutdown(self):
+        self._stopped.set()
+
+    def close(self):
+        if self._loop is None:
+            return
+        async def stop():
+            self._server.close()
+            await self._server.wait_closed()
+            # Closing the connections ends their tasks once the running calls return
+            for writer in list(self._connections.values()):
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown(wait=False)
+        self._loop = None
+
+    def register(self, obj):
+        object_id = f"obj_{uuid.uuid4().hex}"
+        self.objects[object_id] = obj
+        return f"PYRO:{object_id}@{self.host}:{self.port}"
+
+    def publish(self, name:str, address):
+        with pyro.locateNS(self.ns_host, self.ns_port) as ns:
+            ns.register(name, address)
+
+    def resolve(self, name:str, bulk_prefix:str=None):
+        return str(get_resolver(self.ns_host, self.ns_port).lookup(name, bulk_prefix))
+
+    def connect(self, address, timeout:float=None):
+        return TcpProxy(self, str(address), self.timeout if timeout is None else timeout)
+
+    def invalidate(self, name:str):
+        get_resolver(self.ns_host, self.ns_port).invalidate(name)
+
+    def coordinator_proxy(self, name:str):
+        return create_object_proxy(name, self.ns_host, self.ns_port)
+
+    def methods(self, proxy):
+        """
+        Returns the exposed method names of the object of proxy
+        """
+        methods = self._methods.get(proxy._address)
+        if methods is None:
+            methods = self._methods[proxy._address] = frozenset(proxy._call(TcpTransport._METHODS, None))
+        return methods
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        self._connections[task] = writer
+        try:
+            while True:
+                size = _LENGTH.unpack(await reader.readexactly(4))[0]
+                request = await reader.readexactly(size)
+                response = await loop.run_in_executor(self._executor, self._dispatch, request)
+                writer.write(_LENGTH.pack(len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    def _dispatch(self, request:bytes):
+        """
+        Runs a request and returns the encoded (ok, value or (exception name, message))
+        """
+        try:
+            object_id, operation, attribute, args, kwargs = decode(request)
+            obj = self.objects.get(object_id)
+            if obj is None:
+                raise CommunicationError(f"Unknown object {object_id}")
+            # Only the members exposed to Pyro are served, the same surface as the Pyro transport
+            exposed = pyro.util.get_exposed_members(obj)
+            if operation == TcpTransport._METHODS:
+                value = list(exposed["methods"])
+            elif operation == TcpTransport._GET:
+                value = pyro.util.get_exposed_property_value(obj, attribute)
+            elif operation == TcpTransport._SET:
+                pyro.util.set_exposed_property_value(obj, attribute, args[0])
+                value = None
+            elif operation == TcpTransport._CALL and attribute in exposed["methods"]:
+                value = getattr(obj, attribute)(*args, **kwargs)
+            else:
+                raise AttributeError(f"Remote method {attribute} isn't exposed")
+            return encode((True, value))
+        except Exception as exc:
+            return encode((False, (type(exc).__name__, str(exc))))
+
+def create_transport(kind:str, host:str=None, port:int=0, ns_host:str=None, ns_port:int=None, timeout:float=None):
+    """
+    Returns a new transport of kind, one of TRANSPORTS
+    """
+    if kind == "pyro":
+        return PyroTransport(host, port, ns_host, ns_port, timeout)
+    if kind == "tcp":
+        return TcpTransport(host, port, ns_host, ns_port, timeout)
+    if kind == "inprocess":
+        return InProcessTransport()
+    raise ValueError(f"Unknown transport {kind}, use one of {TRANSPORTS}")
@@ -0,0 +1,128 @@
+import logging
+import pytest
+from ch_bench import SimulatedRing
+from ch_node import FailureDetector
+
+logging.disable(logging.ERROR)
+
+@pytest.fixture
+def ring():
+    ring = SimulatedRing(bits=16, seed=0)
+    yield ring
+    ring.close()
+
+def test_lookup_without_predecessor_serves_local_keys(ring):
+    ring.build(1)
+    node = ring.random_node()
+    node.storage[42] = "value"
+    node.predecessor = None
+    assert not node.is_owner(42)
+    assert node.lookup(42) == "value"
+
+def test_lookup_without_predecessor_raises_missing_keys(ring):
+    ring.build(1)
+    node = ring.random_node()
+    node.predecessor = None
+    with pytest.raises(KeyError):
+        node.lookup(42)
+
+def test_interrupted_pull_resumes_and_gets_keys_stored_meanwhile(ring):
+    from ch_transport import CommunicationError
+    ring.build(2)
+    target, source = ring.nodes.values()
+    target.transfer_chunk_size = 10
+    source.storage.update({x: x for x in range(100, 150)})
+    ack_keys = source.ack_keys
+    acks = []
+    
+    def failing_ack(keys):
+        acks.append(keys)
+        if len(acks) == 2:
+            raise CommunicationError("Lost connection")
+        ack_keys(keys)
+    
+    source.ack_keys = failing_ack
+    with pytest.raises(CommunicationError):
+        target.pull_keys(source.id, 100, 199)
+    assert (source.id, 100, 199) in target.transfer_cursors
+    source.ack_keys = ack_keys
+    # Stored in the source below the cursor after the failure
+    source.storage[101] = "new"
+    target.pull_keys(source.id, 100, 199)
+    assert not target.transfer_cursors
+    assert not source.storage.has_range(100, 200)
+    assert target.storage[101] == "new"
+    assert all(x in target.storage for x in range(100, 150))
+
+def test_failed_pull_without_progress_keeps_no_cursor(ring):
+    ring.build(2)
+    target, source = ring.nodes.values()
+    source.storage.update({x: x for x in range(100, 110)})
+    ring.fail(source)
+    with pytest.raises(Exception):
+        target.pull_keys(source.id, 100, 199)
+    assert not target.transfer_cursors
+
+def test_replicas_skip_virtual_nodes_of_the_same_process(ring):
+    ring.build(5)
+    ids = sorted(ring.nodes)
+    node, sibling = ring.nodes[ids[0]], ring.nodes[ids[1]]
+    node.storage[ids[0]] = "value"
+    # Virtual nodes of one process share local_nodes
+    node.local_nodes[sibling.id] = sibling
+    sibling.local_nodes = node.local_nodes
+    for x in ring.nodes.values():
+        x.replication_factor = 2
+        x.replication_sync = True
+    node.repair_replicas()
+    assert node.replica_set == [ids[2]]
+    assert ring.nodes[ids[2]].replica_value(ids[0]) == (True, "value")
+    assert sibling.replica_value(ids[0]) == (False, None)
+
+def churned_ring_calls(seed):
+    ring = SimulatedRing(bits=16, seed=seed)
+    try:
+        ring.build(30)
+        for node in ring.rng.sample(list(ring.nodes.values()), 5):
+            ring.fail(node)
+        for _ in range(5):
+            ring.join()
+        ring.converge()
+        return dict(ring.transport.calls), sorted(ring.nodes)
+    finally:
+        ring.close()
+
+def test_simulation_depends_only_on_the_seed():
+    assert churned_ring_calls(1) == churned_ring_calls(1)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+    
+    def __call__(self):
+        return self.now
+
+def test_phi_needs_min_samples_before_suspecting():
+    clock = FakeClock()
+    detector = FailureDetector(min_samples=5, clock=clock)
+    for _ in range(5):
+        detector.heartbeat(1)
+        clock.now += 1
+    clock.now += 100
+    # Only 4 intervals
+    assert detector.phi(1) == 0
+    assert not detector.suspected(1)
+    detector.failure(1)
+    assert detector.suspected(1)
+
+def test_phi_tolerates_acceptable_pause():
+    clock = FakeClock()
+    detector = FailureDetector(min_deviation=0.5, acceptable_pause=2, min_samples=5, clock=clock)
+    for _ in range(6):
+        detector.heartbeat(1)
+        clock.now += 1
+    # Regular heartbeats have no deviation, a late one is still within the pause
+    clock.now += 3
+    assert not detector.suspected(1)
+    clock.now += 3
+    assert detector.suspected(1)
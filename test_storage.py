@@ -0,0 +1,117 @@
+import os
+import pytest
+from ch_storage import MemoryStorage, LogStorage
+
+KEYS = [1, 3, 5, 90, 95]
+
+@pytest.fixture(params=["memory", "log"])
+def storage(request, tmp_path):
+    storage = MemoryStorage() if request.param == "memory" else LogStorage(str(tmp_path))
+    storage.update({x: f"v{x}" for x in KEYS})
+    yield storage
+    if request.param == "log":
+        storage.close()
+
+@pytest.mark.parametrize("lower, upper, expected", [
+    (3, 90, [3, 5]),              # Upper excluded
+    (0, 100, KEYS),
+    (6, 90, []),                  # Empty range between keys
+    (80, 4, [90, 95, 1, 3]),      # Wraps around zero
+    (96, 1, []),                  # Wraps without keys
+    (5, 5, [5, 90, 95, 1, 3]),    # Full ring from lower
+])
+def test_keys_range(storage, lower, upper, expected):
+    assert storage.keys_range(lower, upper) == expected
+    assert storage.count_range(lower, upper) == len(expected)
+    assert storage.has_range(lower, upper) == bool(expected)
+
+def test_items_range_pages_in_ring_order(storage):
+    pages, after = [], None
+    while True:
+        page = storage.items_range(80, 4, after, 2)
+        if not page:
+            break
+        pages.append([x for x, y in page])
+        after = page[-1][0]
+    assert pages == [[90, 95], [1, 3]]
+    assert storage.items_range(80, 4, 95, None) == [(1, "v1"), (3, "v3")]
+
+def test_median_key(storage):
+    assert storage.median_key(0, 100) == 5
+    assert storage.median_key(80, 10) == 1
+    assert storage.median_key(6, 80) is None
+
+def test_pop_range_wrapping(storage):
+    assert storage.pop_range(90, 4) == {90: "v90", 95: "v95", 1: "v1", 3: "v3"}
+    assert list(storage) == [5]
+    assert storage.pop_range(6, 80) == {}
+
+def test_empty_storage_ranges():
+    storage = MemoryStorage()
+    assert storage.keys_range(0, 0) == []
+    assert not storage.has_range(0, 0)
+    assert storage.median_key(0, 0) is None
+
+def test_log_replays_puts_and_deletes(tmp_path):
+    storage = LogStorage(str(tmp_path))
+    storage.update({x: f"v{x}" for x in range(100)})
+    storage.delete_keys([1, 2])
+    storage[3] = "new"
+    storage.close()
+    storage = LogStorage(str(tmp_path))
+    assert len(storage) == 98
+    assert 1 not in storage
+    assert storage[3] == "new"
+    assert storage.keys_range(0, 5) == [0, 3, 4]
+    storage.close()
+
+def test_log_truncates_partial_tail_record(tmp_path):
+    storage = LogStorage(str(tmp_path))
+    storage.update({1: "a", 2: "b"})
+    storage.close()
+    log_file = os.path.join(str(tmp_path), LogStorage.LOG_FILE)
+    size = os.path.getsize(log_file)
+    with open(log_file, "ab") as file:
+        file.write(b"\x01\x02\x00")
+    storage = LogStorage(str(tmp_path))
+    assert dict(storage.items()) == {1: "a", 2: "b"}
+    assert os.path.getsize(log_file) == size
+    storage[3] = "c"
+    storage.close()
+    storage = LogStorage(str(tmp_path))
+    assert dict(storage.items()) == {1: "a", 2: "b", 3: "c"}
+    storage.close()
+
+def test_log_compaction_keeps_values(tmp_path):
+    storage = LogStorage(str(tmp_path), compact_ratio=2, compact_min_records=10)
+    for turn in range(5):
+        storage.update({x: (turn, x) for x in range(10)})
+    # Compacted into the snapshot, with the log emptied
+    assert os.path.exists(os.path.join(str(tmp_path), LogStorage.SNAPSHOT_FILE))
+    assert not os.path.exists(os.path.join(str(tmp_path), LogStorage.SNAPSHOT_FILE + ".tmp"))
+    assert storage._log_records < 50
+    assert storage[7] == (4, 7)
+    storage.compact()
+    storage[0] = "after"
+    storage.close()
+    storage = LogStorage(str(tmp_path))
+    assert storage[0] == "after"
+    assert storage[9] == (4, 9)
+    assert len(storage) == 10
+    storage.close()
+
+def test_log_reads_values_appended_after_mapping(tmp_path):
+    storage = LogStorage(str(tmp_path))
+    storage[1] = "a"
+    assert storage[1] == "a"
+    # The log grew past the mapped size, the map is refreshed
+    storage[2] = "b" * 10000
+    assert storage[2] == "b" * 10000
+    assert storage.pop_range(0, 2) == {1: "a"}
+    storage.close()
+
+def test_log_empty_files(tmp_path):
+    open(os.path.join(str(tmp_path), LogStorage.LOG_FILE), "wb").close()
+    storage = LogStorage(str(tmp_path))
+    assert len(storage) == 0
+    storage.close()
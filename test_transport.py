@@ -0,0 +1,59 @@
+import Pyro4 as pyro
+import pytest
+from ch_transport import TcpTransport
+
+@pyro.expose
+class Exposed:
+    def __init__(self):
+        self.secret = "internal"
+        self._value = 1
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+    def add(self, x):
+        return self._value + x
+
+    def _hidden(self):
+        return "hidden"
+
+class Unexposed:
+    def call(self):
+        return "called"
+
+@pytest.fixture
+def transport():
+    transport = TcpTransport()
+    transport.start()
+    yield transport
+    transport.close()
+
+def test_tcp_serves_exposed_members(transport):
+    proxy = transport.connect(transport.register(Exposed()))
+    assert proxy.add(2) == 3
+    proxy.value = 5
+    assert proxy.value == 5
+    proxy._pyroRelease()
+
+def test_tcp_rejects_unexposed_members(transport):
+    obj = Exposed()
+    proxy = transport.connect(transport.register(obj))
+    with pytest.raises(AttributeError):
+        proxy.secret
+    with pytest.raises(AttributeError):
+        proxy.secret = "changed"
+    with pytest.raises(AttributeError):
+        proxy._call(TcpTransport._CALL, "_hidden")
+    with pytest.raises(AttributeError):
+        proxy._call(TcpTransport._CALL, "__init__")
+    assert obj.secret == "internal"
+    proxy._pyroRelease()
+    proxy = transport.connect(transport.register(Unexposed()))
+    with pytest.raises(AttributeError):
+        proxy.call()
+    proxy._pyroRelease()